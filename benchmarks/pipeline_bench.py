@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of the GAN pipeline stages on synthetic phantom volumes.
+
+Generates T1/FLAIR phantoms (ellipsoid head with CSF, grey and white matter, a
+planted FCD-like lesion with blurred grey/white matter junction and FLAIR
+hyperintensity, smooth bias field and noise) plus the lesion ROI, and times the
+pipeline stages on them:
+
+    nii_2_png         NIfTI to PNG slices (util/nii_2_png.py)
+    padding           mean paddings (preprocessing/create_mean_padding.py)
+    stacks_tfdata     multi-channel slice stacks via stack_loader.test_dataset() (tf.data)
+    stacks_slab       the same stacks from the PNGs, each decoded once into a slab ring (slab_inference.py)
+    stacks_numpy      the same stacks from memory (volume_ops.slice_stacks)
+    generator         inference of a randomly initialized Generator() (neuralnet/gan_models.py)
+    histo_png         histogram matching of the PNGs (create_synthetic_images.histo_matching)
+    histo_numpy       histogram matching in memory (volume_ops.histo_matching)
+    volume_png        volume assembly from PNGs (create_synthetic_images.to_nifti)
+    volume_numpy      volume assembly in memory (volume_ops.slices_to_volume)
+    metrics           cluster metrics of a phantom prediction (calculate_metrics.get_true_positives)
+
+No external data or GPU is needed (CUDA devices are hidden unless --gpu is
+given). Phantoms are seeded, i.e. every run works on the same data. Results are
+written as JSON; with --baseline, stages which got slower than the tolerance are
+reported and the exit code is 1, so the suite can be used for regression tracking.
+
+Example:
+    python3 benchmarks/pipeline_bench.py --json bench.json
+    python3 benchmarks/pipeline_bench.py --baseline bench.json --stages generator metrics
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import statistics
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for subdir in ('postprocessing', 'util', 'preprocessing', 'neuralnet'):
+    sys.path.insert(0, os.path.join(REPO, subdir))
+
+# tensorflow is only imported by the stages which need it (lazy in create_synthetic_images)
+import volume_ops
+import slab_inference
+import nii_2_png
+import calculate_metrics
+import create_mean_padding
+import create_synthetic_images as csi
+
+STAGES = ['nii_2_png', 'padding', 'stacks_tfdata', 'stacks_slab', 'stacks_numpy', 'generator', 'histo_png',
+          'histo_numpy', 'volume_png', 'volume_numpy', 'metrics']
+
+# -------- USER INPUT (defaults) ----------
+
+SHAPE = (256, 32, 256)  # x, slices (coronal, as nii_2_png.py), z
+IMG_SIZE = 256
+SUBJECTS = 1
+REPEATS = 3
+BATCH_SIZE = 8
+SEED = 42
+TOLERANCE = 0.2
+
+#-------------------------------
+
+
+def ellipsoid(shape, center, radii):
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    return sum(((g - c) / float(r)) ** 2 for g, c, r in zip(grid, center, radii)) <= 1
+
+
+def make_phantom(shape=SHAPE, seed=SEED):
+    """T1, FLAIR (float32) and lesion ROI (uint8) of one phantom subject"""
+    rng = np.random.RandomState(seed)
+    shape = tuple(shape)
+    center = np.array(shape) / 2.
+    radii = np.array(shape) * 0.42
+
+    head = ellipsoid(shape, center, radii)
+    brain = ellipsoid(shape, center, radii * 0.9)
+    white = ellipsoid(shape, center, radii * 0.75)
+    ventricles = ellipsoid(shape, center, radii * [0.15, 0.6, 0.25])
+
+    tissue = np.zeros(shape, np.uint8)
+    tissue[head] = 1                      # skin/skull
+    tissue[brain] = 2                     # grey matter
+    tissue[white] = 3                     # white matter
+    tissue[ventricles & white] = 4        # CSF
+
+    #             bg    skull gm    wm    csf
+    t1_lut = np.array([0.0, 0.35, 0.55, 0.85, 0.15], np.float32)
+    flair_lut = np.array([0.0, 0.30, 0.55, 0.45, 0.05], np.float32)
+    t1, flair = t1_lut[tissue], flair_lut[tissue]
+
+    # lesion at the grey/white matter boundary: blurred junction, FLAIR hyperintense
+    direction = rng.normal(size=3)
+    direction /= np.linalg.norm(direction)
+    lesion_center = center + direction * radii * 0.82
+    roi = ellipsoid(shape, lesion_center, [max(s * 0.05, 2) for s in shape]) & brain
+    t1_blur = ndimage.gaussian_filter(t1, 2)
+    t1[roi] = t1_blur[roi]
+    flair[roi] += 0.3
+
+    # smooth bias field and noise
+    bias = ndimage.zoom(rng.uniform(0.9, 1.1, (4, 4, 4)), np.array(shape) / 4., order=3)
+    bias = bias[tuple(slice(0, s) for s in shape)]
+    t1 = (t1 * bias + rng.normal(0, 0.02, shape) * head).clip(0, None) * 1000
+    flair = (flair * bias + rng.normal(0, 0.02, shape) * head).clip(0, None) * 1000
+    return t1.astype(np.float32), flair.astype(np.float32), roi.astype(np.uint8)
+
+
+def phantom_prediction(roi, seed=SEED):
+    """Cluster map of a simulated prediction: dilated lesion plus two false positive blobs"""
+    rng = np.random.RandomState(seed + 1)
+    pred = ndimage.binary_dilation(roi, iterations=1)
+    for _ in range(2):
+        center = [rng.randint(s // 4, 3 * s // 4) for s in roi.shape]
+        pred |= ellipsoid(roi.shape, center, [3, 2, 3])
+    clusters, _ = ndimage.label(pred)
+    return clusters
+
+
+def time_runs(func, repeats, setup=None):
+    """Runs func() repeats times (setup() before every run, not timed)"""
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'runs': times}
+
+
+class Bench:
+    """Phantom data and the stage functions working on it"""
+
+    def __init__(self, workdir, subjects, shape, batch_size, seed):
+        self.workdir = workdir
+        self.subjects = ['{:03d}'.format(100 + i) for i in range(subjects)]
+        self.batch_size = batch_size
+        self.nii_dir = os.path.join(workdir, 'nii')
+        self.png_dir = os.path.join(workdir, 'png')
+        self.data = {}
+        for i, sbj in enumerate(self.subjects):
+            t1, flair, roi = make_phantom(shape, seed + i)
+            self.data[sbj] = {'T1': t1, 'FLAIR': flair, 'roi': roi}
+            for name, vol in self.data[sbj].items():
+                os.makedirs(os.path.join(self.nii_dir, name), exist_ok=True)
+                nib.Nifti1Image(vol, np.eye(4)).to_filename(self.nii_path(name, sbj))
+
+    def nii_path(self, modality, sbj):
+        return os.path.join(self.nii_dir, modality, sbj + '_' + modality + '.nii.gz')
+
+    def slices(self, sbj, modality):
+        """uint8 slices (N, 256, 256) of a phantom, center padded/cropped like the PNGs"""
+        slices = volume_ops.volume_to_slices(self.data[sbj][modality])
+        out = np.zeros((len(slices), IMG_SIZE, IMG_SIZE), np.uint8)
+        src, dst = [], []
+        for size in slices.shape[1:]:
+            offset = abs(IMG_SIZE - size) // 2
+            n = min(size, IMG_SIZE)
+            src.append(slice(offset, offset + n) if size > IMG_SIZE else slice(0, n))
+            dst.append(slice(0, n) if size > IMG_SIZE else slice(offset, offset + n))
+        out[:, dst[0], dst[1]] = slices[:, src[0], src[1]]
+        return out
+
+    # ---- stages ----
+
+    def nii_2_png(self):
+        for sbj in self.subjects:
+            for modality in ('T1', 'FLAIR'):
+                nii_2_png.save_to_png(self.nii_path(modality, sbj), sbj, 'png', 256,
+                                      os.path.join(self.png_dir, modality), 0)
+
+    def padding(self):
+        for sbj in self.subjects:
+            create_mean_padding.main(self.png_dir, self.png_dir, sbj)
+
+    def setup_tfdata(self):
+        self.csi_args = csi.setup_options(['synth', '--png_p', self.png_dir, '--nii_p', self.nii_dir,
+                                           '--batch_size', str(self.batch_size)])
+        self.csi_dirs = csi.setup_dirs(self.csi_args)
+        csi.tf.constant(0)
+
+    def stacks_tfdata(self):
+        args, dir_dict = self.csi_args, self.csi_dirs
+        dataset = csi.stack_loader.test_dataset(sorted(glob.glob(dir_dict["INPUTPATH"] + dir_dict["INFILES"])),
+                                                dir_dict["INPUTPATH"], dir_dict["TARGETPATH"],
+                                                dir_dict["INPUT_PADDING_PATH"], args.INPUT_CHANNELS, args.IMG_HEIGHT,
+                                                args.IMG_WIDTH).batch(args.BATCH_SIZE)
+        for _ in dataset:
+            pass
+
+    def stacks_slab(self):
+        args, dir_dict = self.csi_args, self.csi_dirs
+        for sbj in self.subjects:
+            files = sorted(glob.glob(dir_dict["INPUTPATH"] + sbj + '_*.png'))
+            first, last = csi.read_paddings(dir_dict["INPUT_PADDING_PATH"], sbj)
+            for stacks in slab_inference.slab_batches((csi.read_slice(png) for png in files), first, last,
+                                                      args.INPUT_CHANNELS, self.batch_size):
+                volume_ops.to_generator_input(stacks)
+
+    def stacks_numpy(self):
+        self.stacks = {}
+        for sbj in self.subjects:
+            slices = self.slices(sbj, 'T1')
+            first, last = volume_ops.mean_paddings(slices)
+            self.stacks[sbj] = volume_ops.to_generator_input(volume_ops.slice_stacks(slices, first, last))
+
+    def setup_generator(self):
+        import tensorflow as tf
+        from gan_models import Generator
+        if getattr(self, 'generator', None) is None:
+            tf.random.set_seed(SEED)
+            self.generator = Generator()
+            self.stacks_numpy()
+            # first call traces the model, not part of the timing
+            self.generator(self.stacks[self.subjects[0]][:1], training=True)
+
+    def run_generator(self):
+        self.synth = {}
+        for sbj in self.subjects:
+            stacks = self.stacks[sbj]
+            outputs = [self.generator(stacks[i:i + self.batch_size], training=True).numpy()
+                       for i in range(0, len(stacks), self.batch_size)]
+            self.synth[sbj] = np.concatenate(outputs)[..., 0]
+
+    def setup_synth_pngs(self):
+        """PNG counterparts of the synthetic images (real FLAIR slices with an intensity shift)"""
+        from PIL import Image
+        self.synth_png_dir = os.path.join(self.png_dir, 'raw_synth_FLAIR')
+        if os.path.isdir(self.synth_png_dir):
+            return
+        os.makedirs(self.synth_png_dir)
+        for png in sorted(os.listdir(os.path.join(self.png_dir, 'FLAIR'))):
+            img = np.array(Image.open(os.path.join(self.png_dir, 'FLAIR', png)), dtype=np.float32)
+            Image.fromarray(np.uint8(np.clip(img * 0.8 + 20, 0, 255))).save(os.path.join(self.synth_png_dir, png))
+
+    def histo_png(self):
+        for png in sorted(os.listdir(self.synth_png_dir)):
+            csi.histo_matching(os.path.join(self.synth_png_dir, png), os.path.join(self.png_dir, 'FLAIR', png))
+
+    def histo_numpy(self):
+        for sbj in self.subjects:
+            real = self.slices(sbj, 'FLAIR')
+            synth = np.uint8(np.clip(real * 0.8 + 20, 0, 255))
+            volume_ops.histo_matching(synth, real)
+
+    def volume_png(self):
+        out_dir = os.path.join(self.nii_dir, 'bench_out')
+        os.makedirs(out_dir, exist_ok=True)
+        for sbj in self.subjects:
+            csi.to_nifti(sbj, self.nii_path('FLAIR', sbj), self.synth_png_dir,
+                         os.path.join(out_dir, sbj + '_synth_FLAIR.nii.gz'))
+
+    def volume_numpy(self):
+        for sbj in self.subjects:
+            slices = self.slices(sbj, 'FLAIR')
+            vol = volume_ops.slices_to_volume(slices)
+            nib.Nifti1Image(vol, np.eye(4)).to_filename(os.path.join(self.workdir, sbj + '_numpy.nii.gz'))
+
+    def setup_metrics(self):
+        self.predictions = {sbj: phantom_prediction(self.data[sbj]['roi']) for sbj in self.subjects}
+
+    def metrics(self):
+        for sbj in self.subjects:
+            calculate_metrics.get_true_positives(self.data[sbj]['roi'], self.predictions[sbj])
+
+
+def run_stage(bench, stage, repeats):
+    """Timing of one stage, setup (e.g. model building, inputs) is not included"""
+    png_done = os.path.isdir(os.path.join(bench.png_dir, 'T1'))
+    needs_png = stage not in ('nii_2_png', 'stacks_numpy', 'generator', 'histo_numpy', 'volume_numpy', 'metrics')
+    if needs_png and not png_done:
+        bench.nii_2_png()
+    if stage in ('stacks_tfdata', 'stacks_slab'):
+        if not os.path.isdir(os.path.join(bench.png_dir, 'T1_paddings')):
+            bench.padding()
+        bench.setup_tfdata()
+
+    if stage == 'nii_2_png':
+        return time_runs(bench.nii_2_png, repeats, setup=lambda: shutil.rmtree(bench.png_dir, ignore_errors=True))
+    if stage == 'generator':
+        bench.setup_generator()
+        return time_runs(bench.run_generator, repeats)
+    if stage in ('histo_png', 'volume_png'):
+        bench.setup_synth_pngs()
+    if stage == 'metrics':
+        bench.setup_metrics()
+    return time_runs(getattr(bench, stage), repeats)
+
+
+def compare(results, baseline, tolerance):
+    """Stages whose median got slower than (1 + tolerance) times the baseline median"""
+    regressions = []
+    for stage, res in results['stages'].items():
+        base = baseline.get('stages', {}).get(stage)
+        if base and res['median'] > base['median'] * (1 + tolerance):
+            regressions.append((stage, base['median'], res['median']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the GAN pipeline stages on phantom volumes')
+    parser.add_argument("--stages", nargs='+', default=STAGES, choices=STAGES, metavar="STAGE",
+                        help="stages to run (default: all): {}".format(', '.join(STAGES)))
+    parser.add_argument("--subjects", type=int, default=SUBJECTS,
+                        help="number of phantom subjects (default: {})".format(SUBJECTS))
+    parser.add_argument("--shape", type=int, nargs=3, default=SHAPE, metavar=('X', 'SLICES', 'Z'),
+                        help="phantom shape, slices along the 2nd axis (default: {} {} {})".format(*SHAPE))
+    parser.add_argument("-n", "--repeats", type=int, default=REPEATS,
+                        help="runs per stage (default: {})".format(REPEATS))
+    parser.add_argument("--batch_size", type=int, default=BATCH_SIZE,
+                        help="batch size of the generator (default: {})".format(BATCH_SIZE))
+    parser.add_argument("--seed", type=int, default=SEED, help="phantom seed (default: {})".format(SEED))
+    parser.add_argument("--gpu", action="store_true", help="allow tensorflow to use GPUs")
+    parser.add_argument("--workdir", help="directory for the phantom data (default: temporary directory)")
+    parser.add_argument("--json", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="relative slowdown reported as regression (default: {})".format(TOLERANCE))
+    args = parser.parse_args()
+
+    if not args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='fcd_bench_')
+    try:
+        bench = Bench(workdir, args.subjects, args.shape, args.batch_size, args.seed)
+        n_slices = args.shape[1] * args.subjects
+        results = {'host': socket.gethostname(), 'platform': platform.platform(),
+                   'python': sys.version.split()[0], 'numpy': np.__version__, 'cpus': os.cpu_count(),
+                   'params': {'subjects': args.subjects, 'shape': list(args.shape), 'repeats': args.repeats,
+                              'batch_size': args.batch_size, 'seed': args.seed, 'slices': n_slices},
+                   'stages': {}}
+
+        print('{:<16s}{:>10s}{:>10s}{:>14s}'.format('stage', 'min [s]', 'med [s]', 'slices/s'))
+        for stage in [s for s in STAGES if s in args.stages]:
+            res = run_stage(bench, stage, args.repeats)
+            res['slices_per_s'] = n_slices / res['median'] if res['median'] > 0 else float('inf')
+            results['stages'][stage] = res
+            print('{:<16s}{:>10.3f}{:>10.3f}{:>14.1f}'.format(stage, res['min'], res['median'], res['slices_per_s']))
+
+        if 'tensorflow' in sys.modules:
+            results['tensorflow'] = sys.modules['tensorflow'].__version__
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for stage, base, curr in regressions:
+            print('REGRESSION {}: {:.3f} s -> {:.3f} s (+{:.0%})'.format(stage, base, curr, curr / base - 1))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Startup-time benchmark for the postprocessing command line tools.
+
+Runs '<script> --help' (and optionally a cache-hit run) repeatedly in fresh
+interpreters and reports min/median wall times. For comparison, the import time
+of the heavy modules the scripts used to load at startup is measured as well.
+
+Example:
+    python3 benchmarks/startup_time.py -n 5 --json startup.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+POSTPROC = os.path.join(REPO, 'postprocessing')
+
+SCRIPTS = {'create_synthetic_images': ['create_synthetic_images.py', 'all', '--help'],
+           'create_synthetic_images-OLD_SKIMAGE': ['create_synthetic_images-OLD_SKIMAGE.py', 'all', '--help'],
+           'discriminator_output_test': ['discriminator_output_test.py', '--help']}
+HEAVY_MODULES = ['tensorflow', 'skimage.exposure', 'nibabel']
+
+
+def time_command(cmd, repeats, cwd=None):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'runs': times}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup-time benchmark of the postprocessing CLIs')
+    parser.add_argument("-n", "--repeats", type=int, default=5, help="runs per command (default: 5)")
+    parser.add_argument("--cache_hit", nargs='+', metavar="ARG",
+                        help="extra arguments for a create_synthetic_images.py run whose outputs exist "
+                             "(e.g. synth --png_p /data/png)")
+    parser.add_argument("--no_imports", action="store_true",
+                        help="skip timing the heavy module imports")
+    parser.add_argument("--json", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    results = {'python': sys.version.split()[0], 'repeats': args.repeats, 'cli': {}, 'imports': {}}
+
+    for name, cmd in SCRIPTS.items():
+        results['cli'][name] = time_command([sys.executable] + cmd, args.repeats, cwd=POSTPROC)
+
+    if args.cache_hit:
+        results['cli']['cache_hit'] = time_command([sys.executable, 'create_synthetic_images.py'] + args.cache_hit,
+                                                   args.repeats, cwd=POSTPROC)
+
+    if not args.no_imports:
+        for module in HEAVY_MODULES:
+            results['imports'][module] = time_command([sys.executable, '-c', 'import ' + module], args.repeats)
+
+    print('{:<45s}{:>10s}{:>10s}'.format('command', 'min [s]', 'med [s]'))
+    for section in ('cli', 'imports'):
+        for name, res in results[section].items():
+            label = name if section == 'cli' else 'import ' + name
+            print('{:<45s}{:>10.3f}{:>10.3f}'.format(label, res['min'], res['median']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Nearest neighbour reslicing of the ROIs onto the DeepMedic T1 grid, in place of
+
+    mri_convert -rl <deepmedic_input>/<sbj>_T1.nii.gz -rt nearest <roi_dir>/<sbj>_roi.nii.gz <out>
+
+in roi_mapping.sh, which starts FreeSurfer once per subject and runs serially.
+
+Every voxel v of the reference grid takes the value of the source voxel
+nint(inv(A_src) @ A_ref @ v), with the voxel-to-world affines A of both images
+(sform, else qform, as FreeSurfer reads them) and nint rounding halves away
+from zero like FreeSurfer's nint(); source voxels outside of the volume give 0.
+The coordinates are mapped for whole slabs of the grid at once and the values
+gathered with scipy.ndimage.map_coordinates (order=0). Subjects are processed
+by a pool of workers, the outputs are written as uint8 in the geometry of the
+reference.
+
+Example:
+    python3 resample_roi.py --ref_dir nii/deepmedic_input --roi_dir nii/ROI --out_dir nii/deepmedic_input \\
+            --processes 8 3022 3023
+
+@author: bdavid
+"""
+
+import os
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+# -------- USER INPUT (defaults) ----------
+
+PROCESSES = os.cpu_count() or 1
+REF_PATTERN = '{}_T1.nii.gz'
+ROI_PATTERN = '{}_roi.nii.gz'
+OUT_PATTERN = '{}_roi.nii.gz'
+
+#-------------------------------
+
+# reference slices (last axis) mapped at once, bounds the coordinate arrays to 3 x 8 bytes x slab voxels
+SLAB = 16
+
+
+def nint(x):
+    """FreeSurfer's nint(): nearest integer, halves rounded away from zero"""
+    return np.where(x < 0, np.ceil(x - 0.5), np.floor(x + 0.5))
+
+
+def reslice_nearest(data, src_affine, ref_shape, ref_affine, slab=SLAB):
+    """Nearest neighbour values of data (source grid) on the reference grid, 0 outside of the source
+
+    :param np.array data: 3D source volume
+    :param np.array src_affine: voxel-to-world affine of the source
+    :param tuple ref_shape: shape of the reference grid (first three axes are used)
+    :param np.array ref_affine: voxel-to-world affine of the reference
+    """
+    vox2vox = np.linalg.inv(src_affine).dot(ref_affine)
+    nx, ny, nz = ref_shape[:3]
+    out = np.zeros((nx, ny, nz), dtype=data.dtype)
+    i, j = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+    # source coordinates of the k = 0 plane, every further plane adds a multiple of the third column
+    plane = (vox2vox[:3, 0, None, None] * i + vox2vox[:3, 1, None, None] * j + vox2vox[:3, 3, None, None])
+    for k0 in range(0, nz, slab):
+        ks = np.arange(k0, min(k0 + slab, nz))
+        coords = nint(plane[..., None] + vox2vox[:3, 2, None, None, None] * ks)
+        out[:, :, k0:k0 + len(ks)] = ndimage.map_coordinates(data, coords, order=0, mode='constant', cval=0)
+    return out
+
+
+def to_uint8(data, name):
+    """Label volume as uint8, refuses values that uint8 cannot hold"""
+    if data.dtype == np.uint8:
+        return data
+    if data.size and (data.min() < 0 or data.max() > 255 or not np.array_equal(data, np.round(data))):
+        raise ValueError('{} holds values other than integers 0-255, not a uint8 label volume'.format(name))
+    return data.astype(np.uint8)
+
+
+def resample_subject(sbj, ref_dir, roi_dir, out_dir):
+    ref = nib.load(os.path.join(ref_dir, REF_PATTERN.format(sbj)))
+    roi_file = os.path.join(roi_dir, ROI_PATTERN.format(sbj))
+    roi = nib.load(roi_file)
+    data = np.asanyarray(roi.dataobj)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3])
+    data = to_uint8(data, roi_file)
+
+    out = reslice_nearest(data, roi.affine, ref.shape, ref.affine)
+    header = ref.header.copy()
+    header.set_data_dtype(np.uint8)
+    img = nib.Nifti1Image(out, ref.affine, header=header)
+    img.header.set_slope_inter(1, 0)
+    os.makedirs(out_dir, exist_ok=True)
+    img.to_filename(os.path.join(out_dir, OUT_PATTERN.format(sbj)))
+
+
+def _resample(job):
+    sbj = job[0]
+    try:
+        resample_subject(*job)
+        return sbj, None
+    except (IOError, ValueError) as e:
+        return sbj, str(e)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Nearest neighbour reslicing of ROIs onto reference grids')
+    parser.add_argument("subjects", nargs='+', help="subject IDs")
+    parser.add_argument("--ref_dir", required=True, help="reference images ({})".format(REF_PATTERN.format('<sbj>')))
+    parser.add_argument("--roi_dir", required=True, help="ROIs ({})".format(ROI_PATTERN.format('<sbj>')))
+    parser.add_argument("--out_dir", required=True, help="output directory ({})".format(OUT_PATTERN.format('<sbj>')))
+    parser.add_argument("--processes", type=int, default=PROCESSES,
+                        help="subjects resampled in parallel (default={})".format(PROCESSES))
+    args = parser.parse_args()
+
+    jobs = [(sbj, args.ref_dir, args.roi_dir, args.out_dir) for sbj in args.subjects]
+    if args.processes > 1 and len(jobs) > 1:
+        with Pool(min(args.processes, len(jobs))) as pool:
+            results = pool.imap(_resample, jobs)
+            failed = [(sbj, error) for sbj, error in results if error]
+    else:
+        failed = [(sbj, error) for sbj, error in map(_resample, jobs) if error]
+
+    for sbj, error in failed:
+        print('Skipped {}: {}'.format(sbj, error))
+    print('{} of {} subjects resampled'.format(len(jobs) - len(failed), len(jobs)))
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
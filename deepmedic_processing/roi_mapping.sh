@@ -17,9 +17,21 @@ DEEPMEDIC_INPUT=${OUTPUT_DIR}/deepmedic_input
 
 SUBJECTS=$(ls ${REAL_T1_DIR}| cut -d'_' -f1)
 
+# nearest neighbour reslicing in one python process with a pool of workers (resample_roi.py);
+# false: one mri_convert per subject, serially
+PY_RESAMPLER=true
+SCRIPT_DIR=$(dirname "$(readlink -f "$0")")
+cores=$(grep -c ^processor /proc/cpuinfo)
+
 
 # Run commands
-for sbj in $SUBJECTS; do
-    echo "Processing $sbj"
-    mri_convert -rl ${DEEPMEDIC_INPUT}/${sbj}_T1.nii.gz -rt nearest ${ROI_DIR}/${sbj}_roi.nii.gz ${DEEPMEDIC_INPUT}/${sbj}_roi.nii.gz
-done
\ No newline at end of file
+if $PY_RESAMPLER
+then
+  python3 ${SCRIPT_DIR}/resample_roi.py --ref_dir ${DEEPMEDIC_INPUT} --roi_dir ${ROI_DIR} \
+          --out_dir ${DEEPMEDIC_INPUT} --processes $cores $SUBJECTS
+else
+  for sbj in $SUBJECTS; do
+      echo "Processing $sbj"
+      mri_convert -rl ${DEEPMEDIC_INPUT}/${sbj}_T1.nii.gz -rt nearest ${ROI_DIR}/${sbj}_roi.nii.gz ${DEEPMEDIC_INPUT}/${sbj}_roi.nii.gz
+  done
+fi
\ No newline at end of file
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batched, in-graph random jitter of the training notebooks.
+
+random_jitter() does what resize() to 286 x 286 (nearest neighbour), random_crop()
+to 256 x 256 and the random mirroring did per example, for a whole batch at once:
+the resize, the crop offsets and the flip of every example are folded into one
+row and one column index map, which are applied to input stack and target with
+two tf.gather calls each. There is no intermediate 286 x 286 image and no
+concatenation of zero channels to crop input stack and target jointly.
+
+train_batches() builds the training pipeline around it: decoded (input, target)
+examples are optionally cached (Dataset.cache(), '' in memory or a file), then
+shuffled, batched and augmented/normalized per batch with AUTOTUNE parallelism.
+
+@author: bdavid
+"""
+
+import tensorflow as tf
+
+IMG_WIDTH = 256
+IMG_HEIGHT = 256
+JITTER_SIZE = 286
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def nearest_index(in_size, out_size):
+    """Source index of every output index of tf.image.resize(..., NEAREST_NEIGHBOR)"""
+    scale = tf.cast(in_size, tf.float32) / tf.cast(out_size, tf.float32)
+    index = tf.floor((tf.range(out_size, dtype=tf.float32) + 0.5) * scale)
+    return tf.minimum(tf.cast(index, tf.int32), in_size - 1)
+
+
+def random_jitter(input_images, real_images, height=IMG_HEIGHT, width=IMG_WIDTH, jitter_size=JITTER_SIZE):
+    """Random resize-crop and mirroring of input stacks (B, H, W, C) and targets (B, H, W, 1)
+
+    Every example gets its own crop offset and flip, applied identically to its input and target.
+    """
+    batch = tf.shape(input_images)[0]
+    rows_map = nearest_index(tf.shape(input_images)[1], jitter_size)
+    cols_map = nearest_index(tf.shape(input_images)[2], jitter_size)
+
+    offset_y = tf.random.uniform([batch, 1], 0, jitter_size - height + 1, dtype=tf.int32)
+    offset_x = tf.random.uniform([batch, 1], 0, jitter_size - width + 1, dtype=tf.int32)
+    flip = tf.random.uniform([batch, 1]) > 0.5
+
+    rows = tf.gather(rows_map, offset_y + tf.range(height)[tf.newaxis])
+    cols = tf.range(width)[tf.newaxis]
+    cols = tf.gather(cols_map, offset_x + tf.where(flip, width - 1 - cols, cols))
+
+    def crop(images):
+        images = tf.gather(images, rows, axis=1, batch_dims=1)
+        return tf.gather(images, cols, axis=2, batch_dims=1)
+
+    return crop(input_images), crop(real_images)
+
+
+def train_batches(decoded, batch_size, buffer_size, normalize=None, cache=None):
+    """Training batches from a dataset of decoded, un-augmented (input, target) examples
+
+    :param tf.data.Dataset decoded: (input stack, target) examples, e.g. list_files().map(load)
+    :param int batch_size: batch size
+    :param int buffer_size: shuffle buffer size
+    :param normalize: function (input, target) -> (input, target) applied after the jitter
+    :param str cache: None for no caching, '' to cache the decoded examples in memory, else a cache file
+    """
+    if cache is not None:
+        decoded = decoded.cache(cache)
+
+    def augment(input_images, real_images):
+        input_images, real_images = random_jitter(input_images, real_images)
+        if normalize is not None:
+            input_images, real_images = normalize(input_images, real_images)
+        return input_images, real_images
+
+    dataset = decoded.shuffle(buffer_size).batch(batch_size)
+    return dataset.map(augment, num_parallel_calls=AUTOTUNE).prefetch(AUTOTUNE)
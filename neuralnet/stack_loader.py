@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-channel input stacks of the PNG slices, shared by the training notebooks,
+create_synthetic_images.py and discriminator_output_test.py.
+
+A stack consists of the `channels` neighbouring slices centered on a slice
+(<sbj>_sliceNNN.png). Neighbours outside of the volume (i.e. missing PNGs at
+the lower/upper end of the window) are replaced by the subject's first/last
+mean padding (<sbj>_first_mean_padding.png, create_mean_padding.py), as the
+former load() functions did.
+
+The file names of every window are resolved once in Python, when the dataset
+is created (stack_windows(), one directory listing per directory). The dataset
+then only reads and decodes the window's PNGs and builds the stack with a single
+tf.stack, instead of a py_function per slice and a tf.concat with zero
+channels for every channel.
+
+cached_stack_dataset() is the opt-in variant for training over many epochs:
+every distinct slice PNG (slices, paddings and targets) is decoded once into a
+uint8 SliceStore (N, H, W) and the examples are gathered from it by index, so
+only the first epoch reads and decodes PNGs. The store is kept in memory if it
+fits memory_budget, otherwise it is a np.memmap in cache_dir. With a cache_dir
+the store is also kept on disk, keyed by the file names, sizes and mtimes, and
+reused by later runs. Storing slices instead of stacks keeps it INPUT_CHANNELS
+times smaller than a Dataset.cache() of the stacks.
+
+@author: bdavid
+"""
+
+import os
+import re
+import hashlib
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+IMG_WIDTH = 256
+IMG_HEIGHT = 256
+INPUT_CHANNELS = 7
+# bytes of decoded slices kept in memory by SliceStore, larger stores are memory mapped from disk
+MEMORY_BUDGET = 4 * 1024 ** 3
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+SLICE_PATTERN = re.compile(r'^(.*)([0-9]{3})(\.png)$')
+
+
+def padding_files(padding_path, subjid):
+    return (os.path.join(padding_path, subjid + '_first_mean_padding.png'),
+            os.path.join(padding_path, subjid + '_last_mean_padding.png'))
+
+
+def stack_windows(files, padding_path, channels=INPUT_CHANNELS):
+    """File names of the input stack of every slice file, array (N, channels)
+
+    Slices missing at the lower (upper) end of a window are replaced by the first (last)
+    mean padding of the subject.
+    """
+    available = {}
+    windows = np.empty((len(files), channels), dtype=object)
+    offsets = np.arange(channels) - channels // 2
+    for i, image_file in enumerate(files):
+        directory = os.path.dirname(image_file)
+        if directory not in available:
+            available[directory] = set(os.listdir(directory))
+        match = SLICE_PATTERN.match(image_file)
+        if match is None:
+            raise ValueError('No slice number in {}'.format(image_file))
+        prefix, mid_slice, suffix = match.group(1), int(match.group(2)), match.group(3)
+        names = [prefix + str(mid_slice + o).zfill(3) + suffix if mid_slice + o >= 0 else None for o in offsets]
+        exists = np.array([n is not None and os.path.basename(n) in available[directory] for n in names])
+        # leading/trailing missing slices of the window
+        lo_pad = np.cumprod(~exists).astype(bool)
+        hi_pad = np.cumprod(~exists[::-1])[::-1].astype(bool)
+        first, last = padding_files(padding_path, os.path.basename(image_file).split('_')[0])
+        windows[i] = np.where(lo_pad, first, np.where(hi_pad, last, names))
+    return windows.astype(str)
+
+
+def decode_u8(png):
+    return tf.image.decode_png(tf.io.read_file(png), channels=1)
+
+
+def decode(png):
+    return tf.image.convert_image_dtype(decode_u8(png), tf.float32)
+
+
+def load_stack(window, real_image_file, height=IMG_HEIGHT, width=IMG_WIDTH):
+    """Input stack (height, width, channels) of the window's files and the target image (height, width, 1)"""
+    channels = window.shape[0]
+    input_image = tf.stack([decode(window[i])[..., 0] for i in range(channels)], axis=-1)
+    input_image.set_shape([height, width, channels])
+    real_image = decode(real_image_file)
+    return input_image, real_image
+
+
+def target_files(files, input_path, target_path):
+    return [f.replace(input_path, target_path, 1) for f in files]
+
+
+def stack_dataset(files, input_path, target_path, padding_path, channels=INPUT_CHANNELS, height=IMG_HEIGHT,
+                  width=IMG_WIDTH, shuffle=False):
+    """Dataset of (input stack, target) for the given slice files, in file order unless shuffle
+
+    :param list files: input slice PNGs
+    :param str input_path: directory prefix of the input slices, replaced by target_path for the targets
+    :param str target_path: directory prefix of the target slices
+    :param str padding_path: directory of the mean paddings of the input modality
+    :param bool shuffle: reshuffle the examples every iteration (like list_files())
+    """
+    files = list(files)
+    windows = stack_windows(files, padding_path, channels)
+    dataset = tf.data.Dataset.from_tensor_slices((windows, target_files(files, input_path, target_path)))
+    if shuffle:
+        dataset = dataset.shuffle(max(len(files), 1), reshuffle_each_iteration=True)
+    return dataset.map(lambda window, real: load_stack(window, real, height, width), num_parallel_calls=AUTOTUNE)
+
+
+def load_stack_file(image_file, input_path, target_path, padding_path, channels=INPUT_CHANNELS,
+                    height=IMG_HEIGHT, width=IMG_WIDTH):
+    """Input stack and target of a single slice file (eager, e.g. for plots)"""
+    window = stack_windows([image_file], padding_path, channels)[0]
+    return load_stack(tf.constant(window), target_files([image_file], input_path, target_path)[0], height, width)
+
+
+def resize(input_image, real_image, height, width):
+    input_image = tf.image.resize(input_image, [height, width], method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+    real_image = tf.image.resize(real_image, [height, width], method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+    return input_image, real_image
+
+
+def normalize(input_image, real_image):
+    """[0, 1] images to the [-1, 1] range of the generator"""
+    return (input_image / 127.5) - 1, (real_image / 127.5) - 1
+
+
+def test_dataset(files, input_path, target_path, padding_path, channels=INPUT_CHANNELS, height=IMG_HEIGHT,
+                 width=IMG_WIDTH):
+    """stack_dataset() scaled like the test sets of the notebooks (generator input), in file order, unbatched"""
+    dataset = stack_dataset(files, input_path, target_path, padding_path, channels, height, width)
+    return dataset.map(lambda inp, tar: normalize(*resize(inp, tar, height, width)), num_parallel_calls=AUTOTUNE)
+
+
+def store_key(names):
+    """Hash of the file names, sizes and modification times of a store"""
+    digest = hashlib.sha1()
+    for name in names:
+        stat = os.stat(name)
+        digest.update('{}\t{}\t{}\n'.format(name, stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()[:16]
+
+
+class SliceStore:
+    """Decoded uint8 slices (N, height, width) of a list of PNG files
+
+    :param list names: PNG files, their position is the index into data
+    :param str cache_dir: directory of the on-disk store (reused if the files did not change), optional
+    :param int memory_budget: stores up to this size (bytes) are held in memory, larger ones are memory mapped
+    """
+
+    def __init__(self, names, height=IMG_HEIGHT, width=IMG_WIDTH, cache_dir=None, memory_budget=MEMORY_BUDGET):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.height, self.width = height, width
+        shape = (len(self.names), height, width)
+        in_memory = int(np.prod(shape)) <= memory_budget
+        if cache_dir is None and not in_memory:
+            cache_dir = tempfile.gettempdir()
+        self.path = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.path = os.path.join(cache_dir, 'slices_{}x{}_{}.u8'.format(height, width, store_key(self.names)))
+
+        if self.path is not None and os.path.exists(self.path):
+            self.data = self.open(shape, in_memory)
+            return
+
+        # filled under a temporary name, an interrupted run does not leave an incomplete store behind
+        tmp_path = None if self.path is None else '{}.{}.tmp'.format(self.path, os.getpid())
+        if in_memory:
+            self.data = np.empty(shape, dtype=np.uint8)
+            self.fill(self.data)
+            if self.path is not None:
+                self.data.tofile(tmp_path)
+                os.replace(tmp_path, self.path)
+        else:
+            data = np.memmap(tmp_path, dtype=np.uint8, mode='w+', shape=shape)
+            self.fill(data)
+            data.flush()
+            del data
+            os.replace(tmp_path, self.path)
+            self.data = self.open(shape, in_memory)
+
+    def open(self, shape, in_memory):
+        if in_memory:
+            return np.fromfile(self.path, dtype=np.uint8).reshape(shape)
+        return np.memmap(self.path, dtype=np.uint8, mode='r', shape=shape)
+
+    def fill(self, data):
+        """Decodes all files into data, in parallel with tf.data"""
+        decoded = tf.data.Dataset.from_tensor_slices(self.names).map(decode_u8, num_parallel_calls=AUTOTUNE)
+        for i, image in enumerate(decoded.as_numpy_iterator()):
+            if image.shape[:2] != (self.height, self.width):
+                raise ValueError('{} has shape {}, expected {}'.format(self.names[i], image.shape[:2],
+                                                                       (self.height, self.width)))
+            data[i] = image[..., 0]
+
+    def indices(self, names):
+        return np.vectorize(self.index.__getitem__, otypes=[np.int32])(names)
+
+    def gather(self, window, target):
+        """Input stack (H, W, C) and target (H, W, 1) by store indices"""
+        return np.moveaxis(self.data[window], 0, -1), self.data[target][..., np.newaxis]
+
+    def load_stack(self, window, target):
+        """Float input stack and target of the store indices, as load_stack() of the files"""
+        input_image, real_image = tf.numpy_function(self.gather, [window, target], [tf.uint8, tf.uint8])
+        input_image.set_shape([self.height, self.width, window.shape[0]])
+        real_image.set_shape([self.height, self.width, 1])
+        return (tf.image.convert_image_dtype(input_image, tf.float32),
+                tf.image.convert_image_dtype(real_image, tf.float32))
+
+
+def cached_stack_dataset(files, input_path, target_path, padding_path, channels=INPUT_CHANNELS, height=IMG_HEIGHT,
+                         width=IMG_WIDTH, shuffle=False, cache_dir=None, memory_budget=MEMORY_BUDGET):
+    """stack_dataset() served from a SliceStore: PNGs are only decoded once, not in every epoch
+
+    :param str cache_dir: directory of the on-disk store, reused across runs, optional for stores within memory_budget
+    :param int memory_budget: bytes of decoded slices held in memory, larger stores are memory mapped from cache_dir
+    """
+    files = list(files)
+    windows = stack_windows(files, padding_path, channels)
+    targets = target_files(files, input_path, target_path)
+    store = SliceStore(sorted(set(windows.ravel()) | set(targets)), height, width, cache_dir, memory_budget)
+    dataset = tf.data.Dataset.from_tensor_slices((store.indices(windows), store.indices(targets)))
+    if shuffle:
+        dataset = dataset.shuffle(max(len(files), 1), reshuffle_each_iteration=True)
+    return dataset.map(store.load_stack, num_parallel_calls=AUTOTUNE)
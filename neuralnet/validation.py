@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Quantitative validation during GAN training (used by the training notebooks).
+
+The test dataset is decoded once and cached in memory (re-batched with
+val_batch_size), every `every` epochs the generator is run on all cached
+batches and the mean L1 (in the [-1, 1] range of the loss), SSIM and PSNR
+(tf.image.ssim / tf.image.psnr on [0, 1] images) are computed in graph. The
+values are written to TensorBoard (val_l1, val_ssim, val_psnr) and appended
+to <best_dir>/validation.tsv. Whenever the selection metric improves, the
+checkpoint is saved to best_dir (a CheckpointManager keeping only the best
+one), so the best epoch does not need to be picked by inspecting samples.
+When training is resumed with the same best_dir, the best value and epoch are
+taken over from validation.tsv (if selected by the same metric), so only a
+better epoch replaces the kept checkpoint. The generator is evaluated in
+inference mode (training=False) by default, so the selection does not follow
+the noise of dropout and of BatchNorm batch statistics.
+
+Usage in the notebooks:
+    validator = Validator(test_dataset, generator, checkpoint, os.path.join(checkpoint_dir, 'best'),
+                          summary_writer, every=5)
+    ...
+    validator(epoch)  # at the end of every epoch
+
+    # restoring the best checkpoint
+    checkpoint.restore(tf.train.latest_checkpoint(os.path.join(checkpoint_dir, 'best')))
+
+@author: bdavid
+"""
+
+import os
+import time
+
+import tensorflow as tf
+
+EVERY = 5
+VAL_BATCH_SIZE = 16
+METRIC = 'ssim'
+# metrics where lower is better
+LOWER_IS_BETTER = ('l1',)
+LOG_COLUMNS = ['Epoch', 'L1', 'SSIM', 'PSNR', 'Metric', 'Best', 'Seconds']
+
+
+class Validator:
+    """Periodic validation of the generator on the cached test set
+
+    :param tf.data.Dataset dataset: (input, target) test dataset, batched or not
+    :param generator: generator model
+    :param tf.train.Checkpoint checkpoint: training checkpoint (saved when the metric improves)
+    :param str best_dir: directory of the best checkpoint and validation.tsv
+    :param summary_writer: TensorBoard summary writer, optional
+    :param int every: validate every n-th epoch
+    :param str metric: selection metric, 'ssim', 'psnr' or 'l1'
+    :param int val_batch_size: batch size of the validation runs
+    :param int max_examples: only validate on the first n examples
+    :param bool training: generator call mode, False (default): dropout off and BatchNorm with its moving
+                          statistics, so the metrics of an epoch do not vary from run to run; True like
+                          generate_images() and create_synthetic_images.py
+    """
+
+    def __init__(self, dataset, generator, checkpoint, best_dir, summary_writer=None, every=EVERY, metric=METRIC,
+                 val_batch_size=VAL_BATCH_SIZE, max_examples=None, training=False):
+        if metric not in ('ssim', 'psnr', 'l1'):
+            raise ValueError("Unknown validation metric '{}'".format(metric))
+        # the notebooks batch the test dataset, validation uses its own batch size
+        if len(dataset.element_spec[0].shape) == 4:
+            dataset = dataset.unbatch()
+        if max_examples:
+            dataset = dataset.take(max_examples)
+        self.dataset = dataset.batch(val_batch_size).cache().prefetch(tf.data.experimental.AUTOTUNE)
+        self.generator = generator
+        self.best_dir = best_dir
+        self.manager = tf.train.CheckpointManager(checkpoint, best_dir, max_to_keep=1)
+        self.summary_writer = summary_writer
+        self.every = every
+        self.metric = metric
+        self.training = training
+        os.makedirs(best_dir, exist_ok=True)
+        self.logfile = os.path.join(best_dir, 'validation.tsv')
+        self._init_logfile()
+        self.best, self.best_epoch = self.previous_best()
+
+    def _init_logfile(self):
+        """Creates validation.tsv, adds the Metric column to files written without it"""
+        rows = []
+        if os.path.exists(self.logfile):
+            with open(self.logfile) as f:
+                header = f.readline().rstrip('\n').split('\t')
+                if header == LOG_COLUMNS:
+                    return
+                rows = [dict(zip(header, line.rstrip('\n').split('\t'))) for line in f]
+        with open(self.logfile, 'w') as f:
+            f.write('\t'.join(LOG_COLUMNS) + '\n')
+            for row in rows:
+                f.write('\t'.join(row.get(column, '') for column in LOG_COLUMNS) + '\n')
+
+    def previous_best(self):
+        """Metric and epoch of the best checkpoint kept from an earlier run, (None, None) if there is none
+
+        The kept checkpoint is the one of the last row marked Best in validation.tsv, its value
+        is only taken over if it was selected by the same metric.
+        """
+        if self.manager.latest_checkpoint is None:
+            return None, None
+        best = None, None
+        with open(self.logfile) as f:
+            header = f.readline().rstrip('\n').split('\t')
+            for line in f:
+                row = dict(zip(header, line.rstrip('\n').split('\t')))
+                if row.get('Best') == '1':
+                    # a best epoch selected by another metric is no reference for this one
+                    same = row.get('Metric') == self.metric
+                    best = (float(row[self.metric.upper()]), int(row['Epoch'])) if same else (None, None)
+        return best
+
+    @tf.function
+    def _batch_metrics(self, inp, tar):
+        prediction = self.generator(inp, training=self.training)
+        l1 = tf.reduce_mean(tf.abs(tar - prediction), axis=[1, 2, 3])
+        pred01 = tf.clip_by_value(prediction * 0.5 + 0.5, 0., 1.)
+        tar01 = tf.clip_by_value(tar * 0.5 + 0.5, 0., 1.)
+        return l1, tf.image.ssim(tar01, pred01, max_val=1.0), tf.image.psnr(tar01, pred01, max_val=1.0)
+
+    def evaluate(self):
+        """Mean L1, SSIM and PSNR over the cached test set"""
+        sums = {'l1': 0., 'ssim': 0., 'psnr': 0.}
+        n = 0
+        for inp, tar in self.dataset:
+            values = self._batch_metrics(inp, tar)
+            for key, value in zip(('l1', 'ssim', 'psnr'), values):
+                sums[key] += float(tf.reduce_sum(value))
+            n += int(inp.shape[0])
+        return {key: value / max(n, 1) for key, value in sums.items()}
+
+    def improved(self, value):
+        if self.best is None:
+            return True
+        return value < self.best if self.metric in LOWER_IS_BETTER else value > self.best
+
+    def __call__(self, epoch, force=False):
+        """Validates (every n-th epoch or if force), returns the metrics or None if skipped"""
+        if not force and (epoch + 1) % self.every != 0:
+            return None
+        start = time.time()
+        results = self.evaluate()
+        best = self.improved(results[self.metric])
+        if best:
+            self.best, self.best_epoch = results[self.metric], epoch + 1
+            self.manager.save(checkpoint_number=epoch + 1)
+        seconds = time.time() - start
+
+        if self.summary_writer is not None:
+            with self.summary_writer.as_default():
+                for key, value in results.items():
+                    tf.summary.scalar('val_' + key, value, step=epoch)
+        with open(self.logfile, 'a') as f:
+            f.write('{}\t{:.6f}\t{:.6f}\t{:.4f}\t{}\t{}\t{:.1f}\n'.format(
+                epoch + 1, results['l1'], results['ssim'], results['psnr'], self.metric, int(best), seconds))
+        print('Validation epoch {}: L1 {:.4f}, SSIM {:.4f}, PSNR {:.2f}{} ({:.1f} sec)'.format(
+            epoch + 1, results['l1'], results['ssim'], results['psnr'],
+            ' (best {})'.format(self.metric) if best else '', seconds))
+        return results
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sharded cohort runner for the GAN -> DeepMedic input pipeline.
+
+run_gan.sh and wrapper_preproc_deepmedic.sh process all subjects of a cohort on
+one machine. Here the subjects are split into shards of --shard_size subjects,
+which are handed out to the workers whenever one becomes free (a slow shard
+does not hold back a static split). A worker is either a local process
+(--worker local or local:CORES) or a machine reachable by ssh
+(--worker [user@]host[:CORES]); several local workers get disjoint core sets
+(cut along the NUMA nodes, see synth_replicas.py).
+
+Every shard runs 'cohort_runner.py work' on its worker, which processes the
+shard's subjects with the steps (--steps)
+    padding   mean paddings of the input slices (create_mean_padding.py)
+    gan       synthetic/diff/GAN niftis (synth_replicas.py run --stage all)
+    preproc   DeepMedic inputs (stage graph of preprocessing_for_deepmedic.py)
+and reports the status of every subject; a subject failing a step is not
+passed on to the next one. As in run_gan.sh, the input slices are read from
+--input_png_dir (<input_dir>/../png) and the real T1/FLAIR niftis from
+--input_dir, paddings and GAN outputs are written to --png_dir
+(<output_dir>/../png) and --output_dir.
+
+Workers have to see the cohort directories under the same paths (shared file
+system, like the /input and /output mounts of the Docker image) and DeepFCD in
+--script_dir. Subject outputs are written in place; the output of every shard
+goes to <output_dir>/log/cohort/<shard>.log and its metrics log
+(util/instrumentation.py) is merged into <output_dir>/log/metrics.jsonl when the
+shard has finished.
+
+The manifest <output_dir>/log/cohort_manifest.tsv holds status, shard, worker,
+failed step and shard wall time of every subject and is rewritten whenever a
+shard starts or finishes. A rerun skips the subjects done already (unless
+--force), i.e. it resumes an interrupted cohort or retries the failed subjects.
+A worker whose command fails without reporting any subject (e.g. host not
+reachable) is dropped and its shard is handed to another worker, once.
+
+Example:
+    python3 cohort_runner.py run --worker local:16 --worker node2:32 --worker node3:32 \\
+            --input_dir /input/data/berlin/analyses/FCD/nii --output_dir /output/data/berlin/analyses/FCD/nii
+
+@author: bdavid
+"""
+
+import os
+import sys
+import glob
+import time
+import queue
+import shlex
+import argparse
+import threading
+import subprocess
+from collections import OrderedDict
+
+import synth_replicas
+import preprocessing_for_deepmedic as pfd
+
+# -------- USER INPUT (defaults) ----------
+
+INPUT_DIR = pfd.INPUT_DIR
+OUTPUT_DIR = pfd.OUTPUT_DIR
+SCRIPT_DIR = pfd.SCRIPT_DIR
+MODEL = '/output/models/T1_2_FLAIR_cor/generator'
+SHARD_SIZE = 4
+STEPS = 'padding,gan,preproc'
+REMOTE_PYTHON = 'python3'
+
+#-------------------------------
+
+STEP_NAMES = ['padding', 'gan', 'preproc']
+COLUMNS = ['Subject', 'Status', 'Shard', 'Worker', 'Step', 'Seconds', 'Updated']
+RESULT = 'RESULT'
+SCRIPT_PATH = os.path.abspath(__file__)
+SCRIPT_ROOT = os.path.dirname(os.path.dirname(SCRIPT_PATH))
+
+
+def parse_steps(value):
+    steps = [step for step in value.split(',') if step]
+    unknown = set(steps) - set(STEP_NAMES)
+    if unknown:
+        raise argparse.ArgumentTypeError('unknown steps {}, choose from {}'.format(', '.join(sorted(unknown)),
+                                                                                  ', '.join(STEP_NAMES)))
+    return [step for step in STEP_NAMES if step in steps]
+
+
+def png_dir(args):
+    """Like ${OUTPUT_DIR:0:-4}/png in run_gan.sh"""
+    return args.png_dir or os.path.join(os.path.dirname(os.path.normpath(args.output_dir)), 'png')
+
+
+def input_png_dir(args):
+    """Like ${INPUT_DIR:0:-4}/png in run_gan.sh"""
+    return args.input_png_dir or os.path.join(os.path.dirname(os.path.normpath(args.input_dir)), 'png')
+
+
+def cohort_log_dir(args):
+    return os.path.join(args.output_dir, 'log', 'cohort')
+
+
+# ---------------- worker side ----------------
+
+def padding_step(args, subjects, script_dir, metrics_log):
+    """Mean paddings of every subject, returns {subject: error}"""
+    script = os.path.join(script_dir, 'preprocessing', 'create_mean_padding.py')
+    timer = [sys.executable, os.path.join(script_dir, 'util', 'instrumentation.py'), 'run', '--log', metrics_log]
+    failed = {}
+    for sbj in subjects:
+        try:
+            pfd.run_cmd([sys.executable, script, png_dir(args), input_png_dir(args), sbj], timer=timer + ['--stage', 'padding',
+                                                                                 '--subject', sbj, '--'])
+        except RuntimeError as e:
+            failed[sbj] = str(e)
+    return failed
+
+
+def gan_step(args, subjects, cpus, metrics_log):
+    """Synthetic images and niftis with generator replicas on the worker's cpus, returns {subject: error}"""
+    input_png = input_png_dir(args)
+    failed = {sbj: 'no input slices in {}'.format(os.path.join(input_png, 'T1'))
+              for sbj in subjects if not glob.glob(os.path.join(input_png, 'T1', sbj + '_*.png'))}
+    subjects = [sbj for sbj in subjects if sbj not in failed]
+    if not subjects:
+        return failed
+    sr_args = synth_replicas.setup_options(
+        ['run', '--stage', 'all', '--png_p', png_dir(args), '--nii_p', args.output_dir, '--input', input_png,
+         '--model', args.model, '--batch_size', str(args.batch_size), '--metrics_log', metrics_log,
+         '--subjects'] + subjects)
+    for sbj in synth_replicas.run(sr_args, cpus):
+        failed[sbj] = 'synth_replicas.py failed, see the replica messages above'
+    return failed
+
+
+def preproc_step(args, subjects, cpus, script_dir, metrics_log):
+    """Stage graph of preprocessing_for_deepmedic.py with the worker's cpus as budget, returns {subject: error}"""
+    pre_args = pfd.setup_options(subjects + ['--input_dir', args.input_dir, '--output_dir', args.output_dir,
+                                             '--script_dir', script_dir, '--cores', str(len(cpus)),
+                                             '--metrics_log', metrics_log] + shlex.split(args.preproc_options))
+    failed = {}
+    for stage in pfd.run(pre_args):
+        failed.setdefault(stage.sbj, 'stage {} failed, see {}'.format(
+            stage.name, os.path.join(args.output_dir, 'log', stage.sbj, 'fcd_gan.log')))
+    return failed
+
+
+def work(args):
+    """Processes the subjects of one shard, prints a RESULT line per subject"""
+    cpus = sorted(synth_replicas.parse_cpulist(args.cpus) if args.cpus else os.sched_getaffinity(0))
+    if args.cores:
+        cpus = cpus[:args.cores]
+    os.sched_setaffinity(0, cpus)
+    os.makedirs(cohort_log_dir(args), exist_ok=True)
+    metrics_log = os.path.join(cohort_log_dir(args), args.shard + '.jsonl')
+    script_dir = args.script_dir or SCRIPT_ROOT
+    print('Shard {}: {} on cpus {}'.format(args.shard, ' '.join(args.subjects), ','.join(map(str, cpus))))
+
+    failed_step = OrderedDict((sbj, None) for sbj in args.subjects)
+    for step in args.steps:
+        active = [sbj for sbj, failed in failed_step.items() if failed is None]
+        if not active:
+            break
+        print('Step {}: {}'.format(step, ' '.join(active)))
+        sys.stdout.flush()
+        try:
+            if step == 'padding':
+                errors = padding_step(args, active, script_dir, metrics_log)
+            elif step == 'gan':
+                errors = gan_step(args, active, cpus, metrics_log)
+            else:
+                errors = preproc_step(args, active, cpus, script_dir, metrics_log)
+        except Exception as e:  # the whole step failed, e.g. a missing model
+            errors = {sbj: repr(e) for sbj in active}
+        for sbj, error in errors.items():
+            print('{} failed in step {}: {}'.format(sbj, step, error))
+            failed_step[sbj] = step
+
+    for sbj, step in failed_step.items():
+        print('\t'.join([RESULT, sbj, 'failed' if step else 'done', step or '']))
+    sys.stdout.flush()
+    if any(failed_step.values()):
+        sys.exit(1)
+
+
+# ---------------- driver side ----------------
+
+class Manifest:
+    """Per subject status of the cohort, a tab separated file rewritten on every update"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.rows = OrderedDict()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                header = f.readline().rstrip('\n').split('\t')
+                for line in f:
+                    row = dict(zip(header, line.rstrip('\n').split('\t')))
+                    self.rows[row['Subject']] = row
+
+    def status(self, sbj):
+        return self.rows.get(sbj, {}).get('Status')
+
+    def update(self, subjects, **values):
+        with self.lock:
+            for sbj in subjects:
+                row = self.rows.setdefault(sbj, {column: '' for column in COLUMNS})
+                row.update(Subject=sbj, Updated=time.strftime('%Y-%m-%d %H:%M:%S'),
+                           **{key.capitalize(): str(value) for key, value in values.items()})
+            self.write()
+
+    def write(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\t'.join(COLUMNS) + '\n')
+            for row in self.rows.values():
+                f.write('\t'.join(row.get(column, '') for column in COLUMNS) + '\n')
+        os.replace(tmp, self.filename)
+
+    def counts(self, subjects):
+        counts = OrderedDict()
+        for sbj in subjects:
+            counts[self.status(sbj)] = counts.get(self.status(sbj), 0) + 1
+        return counts
+
+
+class Worker:
+    """A local process or ssh host running the 'work' command of a shard
+
+    :param str spec: 'local[:CORES]' or '[user@]host[:CORES]'
+    """
+
+    def __init__(self, spec):
+        host, _, cores = spec.partition(':')
+        self.host = host
+        self.cores = int(cores) if cores else None
+        self.cpus = None  # core set of a local worker
+        self.name = spec
+
+    @property
+    def local(self):
+        return self.host == 'local'
+
+    def command(self, argv, args):
+        if self.local:
+            return [sys.executable, SCRIPT_PATH] + argv + ['--cpus', ','.join(map(str, self.cpus))]
+        script = os.path.join(args.script_dir or SCRIPT_ROOT, 'postprocessing', os.path.basename(SCRIPT_PATH))
+        if self.cores:
+            argv = argv + ['--cores', str(self.cores)]
+        return ['ssh', '-o', 'BatchMode=yes', self.host, ' '.join(shlex.quote(a) for a in [args.remote_python, script] + argv)]
+
+
+def assign_local_cpus(workers, cpus):
+    """Core sets of the local workers: CORES each if given, the rest shared equally
+
+    The core sets are disjoint unless the local workers ask for more cores than available,
+    then they wrap around and overlap.
+    """
+    local = [w for w in workers if w.local]
+    fixed = sum(w.cores for w in local if w.cores)
+    shared = [w for w in local if not w.cores]
+    counts = [w.cores or 1 for w in local]
+    if fixed + len(shared) > len(cpus):
+        print('Local workers need more than the {} available cpus, their cpus overlap'.format(len(cpus)))
+    elif shared:
+        rest = synth_replicas.split(list(range(len(cpus) - fixed)), len(shared))
+        for w, part in zip(shared, rest):
+            counts[local.index(w)] = len(part)
+    # cores in NUMA order, every worker gets a contiguous part
+    ordered = [cpu for node in synth_replicas.numa_nodes(cpus) for cpu in node]
+    start = 0
+    for w, count in zip(local, counts):
+        w.cpus = sorted({ordered[(start + i) % len(ordered)] for i in range(count)})
+        start += count
+
+
+def work_argv(args, shard, subjects):
+    # option=value, as values may start with '-' (e.g. --preproc_options=--disc)
+    options = [('--shard', shard), ('--input_dir', args.input_dir), ('--output_dir', args.output_dir),
+               ('--model', args.model), ('--batch_size', str(args.batch_size)), ('--steps', ','.join(args.steps)),
+               ('--png_dir', args.png_dir), ('--input_png_dir', args.input_png_dir),
+               ('--script_dir', args.script_dir), ('--preproc_options', args.preproc_options)]
+    return ['work'] + [option + '=' + value for option, value in options if value] + subjects
+
+
+def merge_metrics(args, shard, lock):
+    """Appends the shard's metrics log to the cohort's"""
+    shard_log = os.path.join(cohort_log_dir(args), shard + '.jsonl')
+    if not os.path.exists(shard_log):
+        return
+    with lock, open(shard_log) as src, open(os.path.join(args.output_dir, 'log', 'metrics.jsonl'), 'a') as dst:
+        dst.write(src.read())
+    os.remove(shard_log)
+
+
+def run_shard(worker, shard, subjects, args):
+    """Runs a shard on the worker, returns its exit code and the reported {subject: (status, step)}"""
+    results = {}
+    with open(os.path.join(cohort_log_dir(args), shard + '.log'), 'a') as log:
+        log.write('# {} on {}, {}\n'.format(shard, worker.name, time.ctime()))
+        log.flush()
+        proc = subprocess.Popen(worker.command(work_argv(args, shard, subjects), args), stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, universal_newlines=True, stdin=subprocess.DEVNULL)
+        for line in proc.stdout:
+            log.write(line)
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == RESULT and len(fields) == 4:
+                results[fields[1]] = (fields[2], fields[3])
+        return proc.wait(), results
+
+
+def dispatch(workers, shards, manifest, args):
+    """Hands the shards out to the workers until all are done or no worker is left"""
+    tasks = queue.Queue()
+    for shard in shards:
+        tasks.put(shard + (0,))
+    metrics_lock, count_lock = threading.Lock(), threading.Lock()
+    # shards not finished yet, a free worker waits for them as long as they might be handed back
+    unfinished = [len(shards)]
+
+    def finish():
+        with count_lock:
+            unfinished[0] -= 1
+
+    def serve(worker):
+        while unfinished[0] > 0:
+            try:
+                shard, subjects, attempt = tasks.get(timeout=1)
+            except queue.Empty:
+                continue
+            manifest.update(subjects, status='running', shard=shard, worker=worker.name, step='', seconds='')
+            start = time.time()
+            returncode, results = run_shard(worker, shard, subjects, args)
+            seconds = '{:.0f}'.format(time.time() - start)
+            merge_metrics(args, shard, metrics_lock)
+            if returncode != 0 and not results:
+                print('{} failed on {} (exit code {}), dropping the worker'.format(shard, worker.name, returncode))
+                if attempt == 0:
+                    manifest.update(subjects, status='pending', worker='', seconds=seconds)
+                    tasks.put((shard, subjects, attempt + 1))
+                else:
+                    manifest.update(subjects, status='failed', step='worker', seconds=seconds)
+                    finish()
+                return
+            for sbj in subjects:
+                status, step = results.get(sbj, ('failed', 'worker'))
+                manifest.update([sbj], status=status, step=step, seconds=seconds)
+            print('{} on {}: {} of {} subjects done ({} s)'.format(
+                shard, worker.name, sum(results.get(s, ('',))[0] == 'done' for s in subjects), len(subjects), seconds))
+            finish()
+
+    threads = [threading.Thread(target=serve, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def list_subjects(args):
+    """Like $(ls ${REAL_T1_DIR} | cut -d'_' -f1)"""
+    return sorted({name.split('_')[0] for name in os.listdir(os.path.join(args.input_dir, 'T1'))})
+
+
+def run(args):
+    subjects = args.subjects or list_subjects(args)
+    os.makedirs(cohort_log_dir(args), exist_ok=True)
+    manifest = Manifest(args.manifest or os.path.join(args.output_dir, 'log', 'cohort_manifest.tsv'))
+    todo = [sbj for sbj in subjects if args.force or manifest.status(sbj) != 'done']
+    print('{} subjects, {} done already, {} to process'.format(len(subjects), len(subjects) - len(todo), len(todo)))
+    if not todo:
+        return True
+
+    workers = [Worker(spec) for spec in args.workers or ['local']]
+    assign_local_cpus(workers, sorted(os.sched_getaffinity(0)))
+    shards = [('shard_{:03d}'.format(i), todo[start:start + args.shard_size])
+              for i, start in enumerate(range(0, len(todo), args.shard_size))]
+    manifest.update(todo, status='pending', shard='', worker='', step='', seconds='')
+    print('{} shards on {} workers: {}'.format(len(shards), len(workers), ', '.join(
+        w.name + (' (cpus {})'.format(','.join(map(str, w.cpus))) if w.local else '') for w in workers)))
+    dispatch(workers, shards, manifest, args)
+
+    counts = manifest.counts(subjects)
+    print(', '.join('{} {}'.format(count, status) for status, count in counts.items()) +
+          ', see {}'.format(manifest.filename))
+    return counts.get('done', 0) == len(subjects)
+
+
+def setup_options(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--input_dir", default=INPUT_DIR, help="input nii directory (default: {})".format(INPUT_DIR))
+    common.add_argument("--output_dir", default=OUTPUT_DIR,
+                        help="output nii directory (default: {})".format(OUTPUT_DIR))
+    common.add_argument("--png_dir", default=None, help="PNG directory of the GAN (default: <output_dir>/../png)")
+    common.add_argument("--input_png_dir", default=None,
+                        help="PNG directory of the input slices (default: <input_dir>/../png)")
+    common.add_argument("--script_dir", default=None,
+                        help="DeepFCD directory on the workers (default: the directory of this script's checkout)")
+    common.add_argument("--model", default=MODEL, help="generator (default: {})".format(MODEL))
+    common.add_argument("--batch_size", type=int, default=1, help="generator batch size (default=1)")
+    common.add_argument("--steps", type=parse_steps, default=parse_steps(STEPS),
+                        help="steps run per shard (default: {})".format(STEPS))
+    common.add_argument("--preproc_options", default='',
+                        help="further options of preprocessing_for_deepmedic.py, e.g. '--no_map --disc'")
+
+    parser = argparse.ArgumentParser(description='GAN and pre-DeepMedic processing of a cohort on several workers')
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", parents=[common], help="process the cohort with the workers")
+    run_parser.add_argument("subjects", nargs='*', help="subject IDs (default: all subjects in <input_dir>/T1)")
+    run_parser.add_argument("--worker", dest="workers", action="append", default=None,
+                            help="local[:CORES] or [user@]host[:CORES], repeat for several workers (default: local)")
+    run_parser.add_argument("--shard_size", type=int, default=SHARD_SIZE,
+                            help="subjects per shard (default={})".format(SHARD_SIZE))
+    run_parser.add_argument("--manifest", default=None,
+                            help="manifest file (default: <output_dir>/log/cohort_manifest.tsv)")
+    run_parser.add_argument("--force", action="store_true", default=False,
+                            help="also process the subjects marked done in the manifest")
+    run_parser.add_argument("--remote_python", default=REMOTE_PYTHON,
+                            help="python of the ssh workers (default: {})".format(REMOTE_PYTHON))
+
+    work_parser = subparsers.add_parser("work", parents=[common], help="process one shard (run by the workers)")
+    work_parser.add_argument("subjects", nargs='+', help="subject IDs of the shard")
+    work_parser.add_argument("--shard", required=True, help="shard name")
+    work_parser.add_argument("--cpus", default=None, help="cpu list, e.g. 0-15 (default: affinity of the process)")
+    work_parser.add_argument("--cores", type=int, default=0, help="use only the first n cpus (default: all)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = setup_options(argv)
+    if args.command == 'work':
+        work(args)
+    elif not run(args):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
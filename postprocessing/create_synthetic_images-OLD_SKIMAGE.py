@@ -18,22 +18,30 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 # disable messages from tensorflow on startup (i.e INFO and WARNINGS are filtered with 2)
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-import tensorflow as tf
 
-import os
-import numpy as np
+import sys
 import glob
-from PIL import Image, ImageChops
-# from skimage.exposure import match_histograms
-from skimage.transform import match_histograms
-import nibabel as nib
 from tqdm import tqdm
 import argparse
 
+from lazy_import import lazy_import
+
+# heavy modules are only imported once a stage actually uses them
+tf = lazy_import('tensorflow')
+np = lazy_import('numpy')
+nib = lazy_import('nibabel')
+Image = lazy_import('PIL.Image')
+ImageChops = lazy_import('PIL.ImageChops')
+# from skimage.exposure import match_histograms
+transform = lazy_import('skimage.transform')
+# multi-channel input stacks, shared with the training notebooks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'neuralnet'))
+stack_loader = lazy_import('stack_loader')
+
 
 def setup_options():
     # -------- USER INPUT ----------
-    parser = argparse.ArgumentParser(description='Synthetic Image Generation with GAN')
+    parser = argparse.ArgumentParser(add_help=False)
 
     parser.add_argument(
         "--model",
@@ -149,8 +157,22 @@ def setup_options():
         help="Number of input channels to use. Only odd no. of slices is supported (Default=7)",
         default=7, type=int,
     )
+
+    parser.add_argument(
+        "--overwrite",
+        dest="OVERWRITE", action="store_true", default=False,
+        help="Rerun stages even if their outputs already exist.",
+    )
     # -------------------------------
-    return parser.parse_args()
+
+    cli = argparse.ArgumentParser(description='Synthetic Image Generation with GAN')
+    subparsers = cli.add_subparsers(dest="STAGE", metavar="STAGE")
+    subparsers.required = True
+    subparsers.add_parser("synth", parents=[parser], help="run the generator and save raw synthetic PNGs")
+    subparsers.add_parser("postproc", parents=[parser], help="histogram matching and difference images")
+    subparsers.add_parser("nifti", parents=[parser], help="create niftis (implies --nii)")
+    subparsers.add_parser("all", parents=[parser], help="run synth, postproc and (with --nii) nifti stages")
+    return cli.parse_args()
 
 
 def setup_dirs():
@@ -183,123 +205,6 @@ def setup_dirs():
     return args, dir_dict
 
 
-def file_exists(image_file, slicenum, slice_of_interest):
-    return tf.io.gfile.exists(
-        tf.strings.regex_replace(image_file, slicenum, str(slice_of_interest.numpy()).zfill(3) + '.').numpy())
-
-
-def load_padding(padding_path, subjid, first):
-    if first:
-        return tf.io.read_file(padding_path + subjid + '_first_mean_padding.png')
-    else:
-        return tf.io.read_file(padding_path + subjid + '_last_mean_padding.png')
-
-
-def load_curr_slice(image_file, slicenum, curr_slice):
-    return tf.io.read_file(tf.strings.regex_replace(image_file, slicenum, str(curr_slice.numpy()).zfill(3) + '.'))
-
-
-def load(image_file, dir_dict, args):
-    real_image_file = tf.strings.regex_replace(image_file, dir_dict["INPUTPATH"], dir_dict["TARGETPATH"])
-    # create 3D image stack for multi-channel input with mean padding
-    # input_imagelist,real_imagelist = tf.zeros((IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS), tf.float32), tf.zeros((IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS), tf.float32)
-    input_imagelist = tf.zeros((args.IMG_WIDTH, args.IMG_HEIGHT, args.INPUT_CHANNELS), tf.float32)
-    slicenum = "([0-9]{3})\."
-    subjid = tf.strings.split(tf.strings.split(image_file, sep='/')[-1], sep='_')[0]
-    mid_slice = int(tf.strings.substr(image_file, -7, 3))
-    halfstack = lo_idx = hi_idx = args.INPUT_CHANNELS // 2
-    min_slice = mid_slice - lo_idx
-    max_slice = mid_slice + hi_idx
-    num_curr_slice = 0
-
-    while not tf.py_function(file_exists, [image_file, slicenum, min_slice], Tout=tf.bool):
-        lo_idx -= 1
-        min_slice += 1
-
-    while not tf.py_function(file_exists, [image_file, slicenum, max_slice], Tout=tf.bool):
-        hi_idx -= 1
-        max_slice -= 1
-
-    if halfstack - lo_idx != 0:
-
-        # input_image = tf.io.read_file(INPUT_PADDING_PATH+subjid+'_first_mean_padding.png')
-        input_image = tf.py_function(load_padding, [dir_dict["INPUT_PADDING_PATH"], subjid, True], Tout=tf.string)
-        input_image = tf.image.decode_png(input_image, channels=1)
-        input_image = tf.image.convert_image_dtype(input_image, tf.float32)
-
-        #     real_image = tf.py_function(load_padding, [TARGET_PADDING_PATH,subjid,True],Tout=tf.string)
-        #     real_image = tf.image.decode_png(real_image,channels=1)
-        #     real_image = tf.image.convert_image_dtype(real_image, tf.float32)
-
-        for i in range(halfstack - lo_idx):
-            input_imagelist = tf.concat([input_imagelist[..., :num_curr_slice],
-                                         input_image,
-                                         tf.zeros((args.IMG_WIDTH, args.IMG_HEIGHT, args.INPUT_CHANNELS - num_curr_slice - 1),
-                                                  tf.float32)], axis=2)
-            #       real_imagelist=tf.concat([real_imagelist[...,:num_curr_slice],
-            #                                 real_image, tf.zeros((IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS-num_curr_slice-1),
-            #                                                      tf.float32)], axis=2)
-            num_curr_slice += 1
-
-            input_imagelist.set_shape([args.IMG_WIDTH, args.IMG_HEIGHT, args.INPUT_CHANNELS])
-    #       real_imagelist.set_shape([IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS])
-
-    for curr_slice in range(min_slice, max_slice + 1):
-        # input_image = tf.io.read_file(tf.strings.regex_replace(image_file,slicenum,str(curr_slice).zfill(3)+'.'))
-        input_image = tf.py_function(load_curr_slice,
-                                     [image_file, slicenum, curr_slice],
-                                     Tout=tf.string)
-        input_image = tf.image.decode_png(input_image, channels=1)
-        input_image = tf.image.convert_image_dtype(input_image, tf.float32)
-
-        # real_image = tf.io.read_file(tf.strings.regex_replace(real_image_file,slicenum,str(curr_slice).zfill(3)+'.'))
-        #     real_image = tf.py_function(load_curr_slice,
-        #                                 [real_image_file,slicenum,curr_slice],
-        #                                 Tout=tf.string)
-        #     real_image = tf.image.decode_png(real_image,channels=1)
-        #     real_image = tf.image.convert_image_dtype(real_image, tf.float32)
-
-        input_imagelist = tf.concat([input_imagelist[..., :num_curr_slice],
-                                     input_image, tf.zeros((args.IMG_WIDTH, args.IMG_HEIGHT, args.INPUT_CHANNELS - num_curr_slice - 1),
-                                                           tf.float32)], axis=2)
-        #     real_imagelist=tf.concat([real_imagelist[...,:num_curr_slice],
-        #                               real_image, tf.zeros((IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS-num_curr_slice-1),
-        #                                                    tf.float32)], axis=2)
-        num_curr_slice += 1
-
-        input_imagelist.set_shape([args.IMG_WIDTH, args.IMG_HEIGHT, args.INPUT_CHANNELS])
-    #     real_imagelist.set_shape([IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS])
-
-    if halfstack - hi_idx != 0:
-
-        input_image = tf.py_function(load_padding, [dir_dict["INPUT_PADDING_PATH"], subjid, False], Tout=tf.string)
-        input_image = tf.image.decode_png(input_image, channels=1)
-        input_image = tf.image.convert_image_dtype(input_image, tf.float32)
-
-        #     real_image = tf.py_function(load_padding, [TARGET_PADDING_PATH,subjid,False],Tout=tf.string)
-        #     real_image = tf.image.decode_png(real_image,channels=1)
-        #     real_image = tf.image.convert_image_dtype(real_image, tf.float32)
-
-        for i in range(halfstack - hi_idx):
-            input_imagelist = tf.concat([input_imagelist[..., :num_curr_slice],
-                                         input_image,
-                                         tf.zeros((args.IMG_WIDTH, args.IMG_HEIGHT, args.INPUT_CHANNELS - num_curr_slice - 1),
-                                                  tf.float32)], axis=2)
-            #       real_imagelist=tf.concat([real_imagelist[...,:num_curr_slice],
-            #                                 real_image, tf.zeros((IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS-num_curr_slice-1),
-            #                                                      tf.float32)], axis=2)
-            num_curr_slice += 1
-            input_imagelist.set_shape([args.IMG_WIDTH, args.IMG_HEIGHT, args.INPUT_CHANNELS])
-    #       real_imagelist.set_shape([IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS])
-
-    real_image = tf.io.read_file(real_image_file)
-    real_image = tf.image.decode_png(real_image, channels=1)
-    real_image = tf.image.convert_image_dtype(real_image, tf.float32)
-
-    #   return input_imagelist, real_imagelist
-    return input_imagelist, real_image
-
-
 def resize(input_image, real_image, height, width):
     input_image = tf.image.resize(input_image, [height, width],
                                   method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
@@ -318,8 +223,7 @@ def normalize(input_image, real_image):
     return input_image, real_image
 
 
-def load_image_test(image_file, args, dir_dict):
-    input_image, real_image = load(image_file, args=args, dir_dict=dir_dict)
+def load_image_test(input_image, real_image, args):
     input_image, real_image = resize(input_image, real_image,
                                      args.IMG_HEIGHT, args.IMG_WIDTH)
     input_image, real_image = normalize(input_image, real_image)
@@ -346,7 +250,7 @@ def histo_matching(synth_img, real_img):
     real_img = np.array(Image.open(real_img))
     synth_img = np.array(Image.open(synth_img))
 
-    synth_img_scaled = match_histograms(synth_img, real_img)
+    synth_img_scaled = transform.match_histograms(synth_img, real_img)
 
     return Image.fromarray(np.uint8(synth_img_scaled))
 
@@ -384,11 +288,22 @@ def to_nifti(subjid, realnii, inputdir, outname):
     #print(f"Successfully saved {subjid} from {inputdir} and {realnii} as {outname}")
 
 
-def main():
-    args, var_dict = setup_dirs()
+def outputs_exist(outfiles):
+    return len(outfiles) > 0 and all(os.path.exists(f) for f in outfiles)
+
+
+def run_synth(args, var_dict):
+    input_files = sorted(glob.glob(var_dict["INPUTPATH"] + var_dict["INFILES"]))
+    raw_files = [os.path.join(var_dict["RAW_OUTPATH"], os.path.basename(f)) for f in input_files]
+    if not args.OVERWRITE and outputs_exist(raw_files):
+        print("Raw synthetic images already exist in {}, skipping synth stage".format(var_dict["RAW_OUTPATH"]))
+        return
+
     print(var_dict["INPUTPATH"] + var_dict["INFILES"])
-    test_dataset = tf.data.Dataset.list_files(var_dict["INPUTPATH"] + var_dict["INFILES"], shuffle=False)
-    test_dataset = test_dataset.map(lambda x: load_image_test(x, args, var_dict))
+    test_dataset = stack_loader.stack_dataset(input_files, var_dict["INPUTPATH"], var_dict["TARGETPATH"],
+                                              var_dict["INPUT_PADDING_PATH"], args.INPUT_CHANNELS,
+                                              args.IMG_HEIGHT, args.IMG_WIDTH)
+    test_dataset = test_dataset.map(lambda inp, tar: load_image_test(inp, tar, args))
     test_dataset = test_dataset.batch(args.BATCH_SIZE)
 
     generator = tf.keras.models.load_model(args.MODEL)
@@ -406,9 +321,17 @@ def main():
         # print('\rwriting '+outfile.numpy().decode("utf-8").split('/')[-1], end='')
         tf.keras.preprocessing.image.save_img(outfile.numpy(), prediction[0], file_format='png')
 
+
+def run_postproc(args, var_dict):
     raw_synth_list = sorted(glob.glob(os.path.join(var_dict["RAW_OUTPATH"], var_dict["INFILES"])))
     real_list = sorted(glob.glob(os.path.join(var_dict["TARGETPATH"], var_dict["INFILES"])))
 
+    out_files = [os.path.join(d, os.path.basename(f)) for f in raw_synth_list
+                 for d in (var_dict["OUTPATH"], var_dict["DIFF_OUTPATH"])]
+    if not args.OVERWRITE and outputs_exist(out_files):
+        print("Synthetic and diff images already exist, skipping postproc stage")
+        return
+
     os.makedirs(os.path.join(var_dict["OUTPATH"]), exist_ok=True)
     os.makedirs(os.path.join(var_dict["DIFF_OUTPATH"]), exist_ok=True)
 
@@ -423,30 +346,44 @@ def main():
         diff_img = subtract_images(synth_img_histo_scaled, real_img, args.DIRECTION)
         synth_img_histo_scaled.save(os.path.join(var_dict["OUTPATH"], synth_img.split('/')[-1]))
         diff_img.save(os.path.join(var_dict["DIFF_OUTPATH"], synth_img.split('/')[-1]))
-    #print("#############################NIFTI", args.CREATE_NIFTI)
-    if args.CREATE_NIFTI:
 
-        os.makedirs(os.path.join(var_dict["SYNTH_NII"]), exist_ok=True)
-        os.makedirs(os.path.join(var_dict["DIFF_NII"]), exist_ok=True)
-        os.makedirs(os.path.join(var_dict["GAN_INPUT_NII"]), exist_ok=True)
-        os.makedirs(os.path.join(var_dict["GAN_TARGET_NII"]), exist_ok=True)
 
-        subjids = set([os.path.basename(img).split('/')[-1].split('_')[0]
-                   for img in glob.glob(os.path.join(var_dict["INPUTPATH"], var_dict["INFILES"]))])
+def run_nifti(args, var_dict):
+    os.makedirs(os.path.join(var_dict["SYNTH_NII"]), exist_ok=True)
+    os.makedirs(os.path.join(var_dict["DIFF_NII"]), exist_ok=True)
+    os.makedirs(os.path.join(var_dict["GAN_INPUT_NII"]), exist_ok=True)
+    os.makedirs(os.path.join(var_dict["GAN_TARGET_NII"]), exist_ok=True)
+
+    subjids = set([os.path.basename(img).split('/')[-1].split('_')[0]
+               for img in glob.glob(os.path.join(var_dict["INPUTPATH"], var_dict["INFILES"]))])
+
+    for sbj in tqdm(subjids):
+        jobs = [(var_dict["TARGET_NII"] + sbj + '_' + args.TARGET_MODALITY + '.nii.gz',
+                 var_dict["OUTPATH"], var_dict["SYNTH_NII"] + sbj + '_synth_' + args.TARGET_MODALITY),
+                (var_dict["TARGET_NII"] + sbj + '_' + args.TARGET_MODALITY + '.nii.gz',
+                 var_dict["DIFF_OUTPATH"], var_dict["DIFF_NII"] + sbj + '_diff'),
+                (var_dict["INPUT_NII"] + sbj + '_' + args.INPUT_MODALITY + '.nii.gz',
+                 var_dict["INPUTPATH"], var_dict["GAN_INPUT_NII"] + sbj + '_gan-input_' + args.INPUT_MODALITY),
+                (var_dict["TARGET_NII"] + sbj + '_' + args.TARGET_MODALITY + '.nii.gz',
+                 var_dict["TARGETPATH"], var_dict["GAN_TARGET_NII"] + sbj + '_gan-target_' + args.TARGET_MODALITY)]
 
-        for sbj in tqdm(subjids):
-            to_nifti(sbj, var_dict["TARGET_NII"] + sbj + '_' + args.TARGET_MODALITY + '.nii.gz',
-                     var_dict["OUTPATH"], var_dict["SYNTH_NII"] + sbj + '_synth_' + args.TARGET_MODALITY)
+        for realnii, inputdir, outname in jobs:
+            if not args.OVERWRITE and glob.glob(outname + '*'):
+                continue
+            to_nifti(sbj, realnii, inputdir, outname)
 
-            to_nifti(sbj, var_dict["TARGET_NII"] + sbj + '_' + args.TARGET_MODALITY + '.nii.gz',
-                     var_dict["DIFF_OUTPATH"], var_dict["DIFF_NII"] + sbj + '_diff')
 
-            to_nifti(sbj, var_dict["INPUT_NII"] + sbj + '_' + args.INPUT_MODALITY + '.nii.gz',
-                     var_dict["INPUTPATH"], var_dict["GAN_INPUT_NII"] + sbj + '_gan-input_' + args.INPUT_MODALITY)
+def main():
+    args, var_dict = setup_dirs()
 
-            to_nifti(sbj, var_dict["TARGET_NII"] + sbj + '_' + args.TARGET_MODALITY + '.nii.gz',
-                     var_dict["TARGETPATH"], var_dict["GAN_TARGET_NII"] + sbj + '_gan-target_' + args.TARGET_MODALITY)
+    if args.STAGE in ("synth", "all"):
+        run_synth(args, var_dict)
+    if args.STAGE in ("postproc", "all"):
+        run_postproc(args, var_dict)
+    #print("#############################NIFTI", args.CREATE_NIFTI)
+    if args.STAGE == "nifti" or (args.STAGE == "all" and args.CREATE_NIFTI):
+        run_nifti(args, var_dict)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -11,209 +11,261 @@ intensity scaling for best results.
 IMPORTANT: Saving and loading the keras model with CPU at the moment only works
 with the tf.nightly build! GPU version should also work with the stable 2.1.0 version
 
+The processing is split into stages, which can be run separately as subcommands:
+    synth     run the generator and save the raw synthetic PNGs
+    postproc  histogram matching and difference PNGs
+    nifti     assemble the PNGs to NIfTI volumes
+    all       all of the above (default behaviour of the old script)
+    both      both directions (--model: input->target, --model_rev: target->input)
+              in one pass: the PNGs of both modalities are read once per subject,
+              both generators run on these shared slices and the synthetic, diff
+              and GAN input/target volumes of both directions are written as NIfTI
+              directly, without the intermediate PNGs
+Heavy modules (tensorflow, skimage, nibabel) are only imported once a stage
+actually needs them. Stages whose outputs already exist are skipped, unless
+--overwrite is given.
+With --metrics_log (or $FCD_METRICS_LOG), time and resources of every stage and
+of its steps (stack loading, generator, histogram matching, PNG/NIfTI I/O) are
+recorded, see util/instrumentation.py.
+
+All USER INPUT defaults below are options, e.g. for sweeps and cluster runs:
+    --batch_size                     generator batch size
+    --intra_threads, --inter_threads tensorflow thread pools (0: tensorflow default)
+    --shard i/n                      only process shard i (0 <= i < n) of the subjects,
+                                     e.g. --shard $SLURM_ARRAY_TASK_ID/8
+    --format nii|nii.gz              NIfTI output format
+    --input PNG_DIR                  real slices from PNG_DIR and real NIfTIs from its sibling
+                                     nii directory instead of --png_p/--nii_p, e.g. a read-only
+                                     input tree as with the OLD_SKIMAGE script
+    --config FILE                    JSON file with option defaults, keyed by the
+                                     USER INPUT or option names, e.g. {"BATCH_SIZE": 8};
+                                     options given on the command line take precedence
+
 @author: bdavid
 """
 
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import tensorflow as tf
-
 import os
-import numpy as np
+import sys
 import glob
-from PIL import Image, ImageChops
-from skimage.exposure import match_histograms
-import nibabel as nib
+import json
+import argparse
+from itertools import groupby
 from tqdm import tqdm
 
-# -------- USER INPUT ----------
+from lazy_import import lazy_import
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'util'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'neuralnet'))
+import instrumentation
+
+tf = lazy_import('tensorflow')
+np = lazy_import('numpy')
+nib = lazy_import('nibabel')
+Image = lazy_import('PIL.Image')
+ImageChops = lazy_import('PIL.ImageChops')
+exposure = lazy_import('skimage.exposure')
+# multi-channel input stacks, shared with the training notebooks
+stack_loader = lazy_import('stack_loader')
+volume_ops = lazy_import('volume_ops')
+slab_inference = lazy_import('slab_inference')
+
+# -------- USER INPUT (defaults) ----------
 
 MODEL = '../models/T1_2_FLAIR_cor/generator'
+MODEL_REV = '../models/FLAIR_2_T1_cor/generator' # target -> input generator of the 'both' stage
 DIRECTION = 'real-fake'
 INPUT_MODALITY = 'T1'
 TARGET_MODALITY = 'FLAIR'
 DATAPATH = '/home/bdavid/Deep_Learning/data/bonn/FCD/iso_FLAIR/png'
 NIIPATH = '/home/bdavid/Deep_Learning/data/bonn/FCD/iso_FLAIR/nii'
 SUBJID = '' # just single subject? if none given, all files are processed
-CREATE_NIFTI = True # create niftis for input, synthetic and diff images?
 DATASET = '' # test or train? just some directory prefix
 
-#-------------------------------
-
-
-INFILES= SUBJID+'*.png' 
-TARGETPATH = os.path.join(DATAPATH,TARGET_MODALITY,DATASET,'')
-INPUTPATH = os.path.join(DATAPATH,INPUT_MODALITY,DATASET,'')
-TARGET_PADDING_PATH= os.path.join(DATAPATH,TARGET_MODALITY+'_paddings',DATASET,'')
-INPUT_PADDING_PATH=os.path.join(DATAPATH,INPUT_MODALITY+'_paddings',DATASET,'')
-
-RAW_OUTPATH=os.path.join(DATAPATH,'raw_synth_'+TARGET_MODALITY,DATASET,'')
-if DIRECTION == 'real-fake':
-    DIFF_OUTPATH=os.path.join(DATAPATH,'diff_'+'real_'+TARGET_MODALITY+
-                         '-'+'synth_'+TARGET_MODALITY,DATASET,'')
-    DIFF_NII=os.path.join(NIIPATH,'diff_'+'real_'+TARGET_MODALITY+
-                         '-'+'synth_'+TARGET_MODALITY,DATASET,'')
-else:
-    DIFF_OUTPATH=os.path.join(DATAPATH,'diff_'+'synth_'+TARGET_MODALITY+
-                         '-'+'real_'+TARGET_MODALITY,DATASET,'')
-    DIFF_NII=os.path.join(NIIPATH,'diff_'+'synth_'+TARGET_MODALITY+
-                         '-'+'real_'+TARGET_MODALITY,DATASET,'')
-OUTPATH=os.path.join(DATAPATH,'synth_'+TARGET_MODALITY,DATASET,'')
-
-TARGET_NII = os.path.join(NIIPATH,TARGET_MODALITY,DATASET,'')
-INPUT_NII = os.path.join(NIIPATH,INPUT_MODALITY,DATASET,'')
-SYNTH_NII = os.path.join(NIIPATH,'synth_'+TARGET_MODALITY,DATASET,'')
-GAN_TARGET_NII = os.path.join(NIIPATH, 'gan_target_'+TARGET_MODALITY,DATASET,'')
-GAN_INPUT_NII = os.path.join(NIIPATH,'gan_input_'+INPUT_MODALITY,DATASET,'')
-
 BUFFER_SIZE = 400
 BATCH_SIZE = 1
 IMG_WIDTH = 256
 IMG_HEIGHT = 256
 INPUT_CHANNELS = 7
-if INPUT_CHANNELS % 2 == 0:
-    print('Even no. of slices not supported, setting INPUT_CHANNELS to ',INPUT_CHANNELS+1)
-    INPUT_CHANNELS += 1
-    
-def file_exists(image_file,slicenum,slice_of_interest):
-    return tf.io.gfile.exists(tf.strings.regex_replace(image_file,slicenum,str(slice_of_interest.numpy()).zfill(3)+'.').numpy())
-
-def load_padding(padding_path,subjid,first):
-    if first:
-        return tf.io.read_file(padding_path+subjid+'_first_mean_padding.png')
-    else:
-        return tf.io.read_file(padding_path+subjid+'_last_mean_padding.png')
-    
-def load_curr_slice(image_file,slicenum,curr_slice):
-    return tf.io.read_file(tf.strings.regex_replace(image_file,slicenum,str(curr_slice.numpy()).zfill(3)+'.'))
 
-def load(image_file):
+INTRA_THREADS = 0 # tensorflow intra-op threads, 0 for tensorflow's default
+INTER_THREADS = 0 # tensorflow inter-op threads, 0 for tensorflow's default
+SHARD = '0/1' # i/n: process the i-th of n subject shards (0-based)
+OUT_FORMAT = 'nii' # NIfTI outputs, 'nii' or 'nii.gz'
 
-  real_image_file=tf.strings.regex_replace(image_file,INPUTPATH,TARGETPATH)
-  #create 3D image stack for multi-channel input with mean padding
-  #input_imagelist,real_imagelist = tf.zeros((IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS), tf.float32), tf.zeros((IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS), tf.float32)    
-  input_imagelist = tf.zeros((IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS), tf.float32)
-  slicenum="([0-9]{3})\."
-  subjid=tf.strings.split(tf.strings.split(image_file,sep='/')[-1],sep='_')[0]
-  mid_slice=int(tf.strings.substr(image_file, -7, 3))
-  halfstack = lo_idx = hi_idx = INPUT_CHANNELS//2
-  min_slice=mid_slice-lo_idx
-  max_slice=mid_slice+hi_idx
-  num_curr_slice=0
+#-------------------------------
 
 
-  while not tf.py_function(file_exists,[image_file, slicenum, min_slice],Tout=tf.bool):
-    lo_idx -= 1
-    min_slice +=1
+def parse_shard(value):
+    """'i/n' -> (i, n)"""
+    try:
+        index, count = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("'{}' is not a shard i/n, e.g. 0/4".format(value))
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard '{}' needs 0 <= i < n".format(value))
+    return index, count
+
+
+def common_options():
+    common = argparse.ArgumentParser(add_help=False)
+
+    common.add_argument("--model", dest="MODEL", default=MODEL, type=str,
+                        help="Generator model (default: {})".format(MODEL))
+    common.add_argument("--dir", dest="DIRECTION", default=DIRECTION, type=str,
+                        choices=["real-fake", "fake-real"],
+                        help="Mapping direction of the difference image (default: real-fake)")
+    common.add_argument("--im", dest="INPUT_MODALITY", default=INPUT_MODALITY, type=str,
+                        choices=["T1", "FLAIR"], help="Modality of input image")
+    common.add_argument("--om", dest="TARGET_MODALITY", default=TARGET_MODALITY, type=str,
+                        choices=["T1", "FLAIR"], help="Modality of synthetic image")
+    common.add_argument("--png_p", dest="DATAPATH", default=DATAPATH, type=str,
+                        help="PNG data directory (default: {})".format(DATAPATH))
+    common.add_argument("--nii_p", dest="NIIPATH", default=NIIPATH, type=str,
+                        help="NIfTI data directory (default: {})".format(NIIPATH))
+    common.add_argument("--input", dest="INPUT", default=None, type=str,
+                        help="PNG directory of the real input and target slices, their NIfTIs are "
+                             "read from the sibling nii directory, as with --input of the OLD_SKIMAGE "
+                             "script (default: --png_p and --nii_p)")
+    common.add_argument("--sid", dest="SUBJID", default=SUBJID, type=str,
+                        help="Subject name. If none is given, all files will be processed (default)")
+    common.add_argument("--ds", dest="DATASET", default=DATASET, type=str,
+                        help="Directory prefix (test, train, none (=default))")
+    common.add_argument("--batch_size", dest="BATCH_SIZE", default=BATCH_SIZE, type=int,
+                        help="Batch size for model inference (default={})".format(BATCH_SIZE))
+    common.add_argument("--img_w", dest="IMG_WIDTH", default=IMG_WIDTH, type=int,
+                        help="Width of image (default={})".format(IMG_WIDTH))
+    common.add_argument("--img_h", dest="IMG_HEIGHT", default=IMG_HEIGHT, type=int,
+                        help="Height of image (default={})".format(IMG_HEIGHT))
+    common.add_argument("--num_c", dest="INPUT_CHANNELS", default=INPUT_CHANNELS, type=int,
+                        help="Number of input channels. Only odd no. of slices is supported "
+                             "(default={})".format(INPUT_CHANNELS))
+    common.add_argument("--overwrite", dest="OVERWRITE", action="store_true", default=False,
+                        help="Rerun stages even if their outputs already exist")
+    common.add_argument("--metrics_log", dest="METRICS_LOG", default=None, type=str,
+                        help="JSON lines log for stage timing and resources "
+                             "(default: ${})".format(instrumentation.ENV_LOG))
+    common.add_argument("--intra_threads", dest="INTRA_THREADS", default=INTRA_THREADS, type=int,
+                        help="Threads of tensorflow's intra-op pool (default: {}, tensorflow's choice)".format(
+                            INTRA_THREADS))
+    common.add_argument("--inter_threads", dest="INTER_THREADS", default=INTER_THREADS, type=int,
+                        help="Threads of tensorflow's inter-op pool (default: {}, tensorflow's choice)".format(
+                            INTER_THREADS))
+    common.add_argument("--shard", dest="SHARD", default=SHARD, type=parse_shard,
+                        help="Only process subject shard i of n, 0 <= i < n (default: {})".format(SHARD))
+    common.add_argument("--format", dest="OUT_FORMAT", default=OUT_FORMAT, type=str, choices=["nii", "nii.gz"],
+                        help="Format of the NIfTI outputs (default: {})".format(OUT_FORMAT))
+    common.add_argument("--config", dest="CONFIG", default=None, type=str,
+                        help="JSON file with option defaults by USER INPUT or option name, "
+                             "e.g. {\"BATCH_SIZE\": 8, \"shard\": \"0/4\"}")
+    return common
+
+
+def apply_config(argv, parsers):
+    """Sets the defaults of parsers from the --config JSON file in argv (if any)"""
+    pre = argparse.ArgumentParser(add_help=False)
+    pre.add_argument("--config", dest="CONFIG", default=None)
+    config_file = pre.parse_known_args(argv)[0].CONFIG
+    if config_file is None:
+        return
+    # keys are USER INPUT names (BATCH_SIZE) or option names (batch_size, num_c)
+    names = {}
+    for action in (action for parser in parsers for action in parser._actions):
+        names[action.dest.upper()] = action.dest
+        for option in action.option_strings:
+            names[option.lstrip('-').upper()] = action.dest
+    with open(config_file) as f:
+        config = json.load(f)
+    unknown = sorted(key for key in config if key.upper() not in names)
+    if unknown:
+        parsers[0].error('unknown options in {}: {}'.format(config_file, ', '.join(unknown)))
+    for parser in parsers:
+        parser.set_defaults(**{names[key.upper()]: value for key, value in config.items()})
+
+
+def configure_threads(args):
+    """Tensorflow thread pools, before tensorflow runs its first operation"""
+    if args.INTRA_THREADS:
+        tf.config.threading.set_intra_op_parallelism_threads(args.INTRA_THREADS)
+    if args.INTER_THREADS:
+        tf.config.threading.set_inter_op_parallelism_threads(args.INTER_THREADS)
+
+
+def shard_subjects(subjids, shard):
+    """Subjects of shard (i, n): every n-th of the sorted subjects, starting with the i-th"""
+    index, count = shard
+    return sorted(subjids)[index::count]
+
+
+def shard_files(files, shard):
+    """Files (<sbj>_*) of the subjects in shard, in the given order"""
+    subjects = set(shard_subjects(set(subject_of(f) for f in files), shard))
+    return [f for f in files if subject_of(f) in subjects]
+
+
+def check_channels(args):
+    if args.INPUT_CHANNELS % 2 == 0:
+        print('Even no. of slices not supported, setting INPUT_CHANNELS to ', args.INPUT_CHANNELS + 1)
+        args.INPUT_CHANNELS += 1
+    return args
+
+
+def setup_options(argv=None):
+    common = common_options()
+    parser = argparse.ArgumentParser(description='Synthetic Image Generation with GAN')
+    subparsers = parser.add_subparsers(dest="STAGE", metavar="STAGE")
+    subparsers.required = True
+    stages = [subparsers.add_parser("synth", parents=[common],
+                                    help="run the generator and save raw synthetic PNGs"),
+              subparsers.add_parser("postproc", parents=[common],
+                                    help="histogram matching of synthetic PNGs and difference images"),
+              subparsers.add_parser("nifti", parents=[common],
+                                    help="create niftis for input, target, synthetic and diff images"),
+              subparsers.add_parser("all", parents=[common],
+                                    help="run synth, postproc and nifti stages")]
+    both = subparsers.add_parser("both", parents=[common],
+                                 help="synthesize both directions in one pass, straight to NIfTI")
+    both.add_argument("--model_rev", dest="MODEL_REV", default=MODEL_REV, type=str,
+                      help="Generator of the reverse direction, target -> input modality "
+                           "(default: {})".format(MODEL_REV))
+    stages.append(both)
+
+    apply_config(argv, stages)
+    return check_channels(parser.parse_args(argv))
+
+
+def setup_dirs(args):
+    dir_dict = {}
+    dir_dict["INFILES"] = args.SUBJID + '*.png'
+    # real slices and volumes, separate from the outputs if --input is given
+    inpath = args.INPUT or args.DATAPATH
+    in_niipath = os.path.join(os.path.dirname(os.path.normpath(args.INPUT)), 'nii') if args.INPUT else args.NIIPATH
+    dir_dict["TARGETPATH"] = os.path.join(inpath, args.TARGET_MODALITY, args.DATASET, '')
+    dir_dict["INPUTPATH"] = os.path.join(inpath, args.INPUT_MODALITY, args.DATASET, '')
+    dir_dict["TARGET_PADDING_PATH"] = os.path.join(args.DATAPATH, args.TARGET_MODALITY + '_paddings', args.DATASET, '')
+    dir_dict["INPUT_PADDING_PATH"] = os.path.join(args.DATAPATH, args.INPUT_MODALITY + '_paddings', args.DATASET, '')
+
+    dir_dict["RAW_OUTPATH"] = os.path.join(args.DATAPATH, 'raw_synth_' + args.TARGET_MODALITY, args.DATASET, '')
+    if args.DIRECTION == 'real-fake':
+        diff_name = 'diff_' + 'real_' + args.TARGET_MODALITY + '-' + 'synth_' + args.TARGET_MODALITY
+    else:
+        diff_name = 'diff_' + 'synth_' + args.TARGET_MODALITY + '-' + 'real_' + args.TARGET_MODALITY
+    dir_dict["DIFF_OUTPATH"] = os.path.join(args.DATAPATH, diff_name, args.DATASET, '')
+    dir_dict["DIFF_NII"] = os.path.join(args.NIIPATH, diff_name, args.DATASET, '')
+    dir_dict["OUTPATH"] = os.path.join(args.DATAPATH, 'synth_' + args.TARGET_MODALITY, args.DATASET, '')
 
-  while not tf.py_function(file_exists,[image_file, slicenum, max_slice],Tout=tf.bool):
-    hi_idx -=1
-    max_slice -=1
+    dir_dict["TARGET_NII"] = os.path.join(in_niipath, args.TARGET_MODALITY, args.DATASET, '')
+    dir_dict["INPUT_NII"] = os.path.join(in_niipath, args.INPUT_MODALITY, args.DATASET, '')
+    dir_dict["SYNTH_NII"] = os.path.join(args.NIIPATH, 'synth_' + args.TARGET_MODALITY, args.DATASET, '')
+    dir_dict["GAN_TARGET_NII"] = os.path.join(args.NIIPATH, 'gan_target_' + args.TARGET_MODALITY, args.DATASET, '')
+    dir_dict["GAN_INPUT_NII"] = os.path.join(args.NIIPATH, 'gan_input_' + args.INPUT_MODALITY, args.DATASET, '')
+    return dir_dict
 
-  if halfstack-lo_idx != 0:
-    
-    #input_image = tf.io.read_file(INPUT_PADDING_PATH+subjid+'_first_mean_padding.png')
-    input_image = tf.py_function(load_padding, [INPUT_PADDING_PATH,subjid,True],Tout=tf.string)
-    input_image = tf.image.decode_png(input_image,channels=1)
-    input_image = tf.image.convert_image_dtype(input_image, tf.float32) 
-    
-#     real_image = tf.py_function(load_padding, [TARGET_PADDING_PATH,subjid,True],Tout=tf.string)
-#     real_image = tf.image.decode_png(real_image,channels=1)
-#     real_image = tf.image.convert_image_dtype(real_image, tf.float32) 
-    
-    for i in range(halfstack-lo_idx): 
-      input_imagelist=tf.concat([input_imagelist[...,:num_curr_slice], 
-                                 input_image, tf.zeros((IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS-num_curr_slice-1), 
-                                                       tf.float32)], axis=2)
-#       real_imagelist=tf.concat([real_imagelist[...,:num_curr_slice], 
-#                                 real_image, tf.zeros((IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS-num_curr_slice-1), 
-#                                                      tf.float32)], axis=2)
-      num_curr_slice += 1
-    
-      input_imagelist.set_shape([IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS])
-#       real_imagelist.set_shape([IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS])
-    
-  for curr_slice in range(min_slice, max_slice+1):
-    
-    #input_image = tf.io.read_file(tf.strings.regex_replace(image_file,slicenum,str(curr_slice).zfill(3)+'.'))
-    input_image = tf.py_function(load_curr_slice, 
-                                 [image_file,slicenum,curr_slice], 
-                                 Tout=tf.string)
-    input_image = tf.image.decode_png(input_image,channels=1)
-    input_image = tf.image.convert_image_dtype(input_image, tf.float32) 
-    
-    #real_image = tf.io.read_file(tf.strings.regex_replace(real_image_file,slicenum,str(curr_slice).zfill(3)+'.'))
-#     real_image = tf.py_function(load_curr_slice, 
-#                                 [real_image_file,slicenum,curr_slice], 
-#                                 Tout=tf.string)
-#     real_image = tf.image.decode_png(real_image,channels=1)
-#     real_image = tf.image.convert_image_dtype(real_image, tf.float32) 
-    
-    
-    input_imagelist=tf.concat([input_imagelist[...,:num_curr_slice], 
-                               input_image, tf.zeros((IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS-num_curr_slice-1), 
-                                                     tf.float32)], axis=2)
-#     real_imagelist=tf.concat([real_imagelist[...,:num_curr_slice], 
-#                               real_image, tf.zeros((IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS-num_curr_slice-1), 
-#                                                    tf.float32)], axis=2)
-    num_curr_slice += 1
-    
-    input_imagelist.set_shape([IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS])
-#     real_imagelist.set_shape([IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS])    
-                                      
-  if halfstack-hi_idx != 0:
-    
-    input_image = tf.py_function(load_padding, [INPUT_PADDING_PATH,subjid,False],Tout=tf.string)
-    input_image = tf.image.decode_png(input_image,channels=1)
-    input_image = tf.image.convert_image_dtype(input_image, tf.float32) 
 
-    
-#     real_image = tf.py_function(load_padding, [TARGET_PADDING_PATH,subjid,False],Tout=tf.string)
-#     real_image = tf.image.decode_png(real_image,channels=1)
-#     real_image = tf.image.convert_image_dtype(real_image, tf.float32) 
-    
-    for i in range(halfstack-hi_idx): 
-      input_imagelist=tf.concat([input_imagelist[...,:num_curr_slice], 
-                                 input_image, tf.zeros((IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS-num_curr_slice-1), 
-                                                       tf.float32)], axis=2)
-#       real_imagelist=tf.concat([real_imagelist[...,:num_curr_slice], 
-#                                 real_image, tf.zeros((IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS-num_curr_slice-1), 
-#                                                      tf.float32)], axis=2)
-      num_curr_slice += 1
-      input_imagelist.set_shape([IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS])
-#       real_imagelist.set_shape([IMG_WIDTH, IMG_HEIGHT, INPUT_CHANNELS])
-      
-  real_image = tf.io.read_file(real_image_file)
-  real_image = tf.image.decode_png(real_image, channels=1)
-  real_image = tf.image.convert_image_dtype(real_image, tf.float32)
-  
-#   return input_imagelist, real_imagelist
-  return input_imagelist, real_image
-
-def resize(input_image, real_image, height, width):
-  input_image = tf.image.resize(input_image, [height, width],
-                                method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
-  real_image = tf.image.resize(real_image, [height, width],
-                               method=tf.image.ResizeMethod.NEAREST_NEIGHBOR)
-
-  return input_image, real_image
-
-# normalizing the images to [-1, 1]
-
-def normalize(input_image, real_image):
-  input_image = (input_image / 127.5) - 1
-  real_image = (real_image / 127.5) - 1
-
-  return input_image, real_image
-
-def load_image_test(image_file):
-  input_image, real_image = load(image_file)
-  input_image, real_image = resize(input_image, real_image,
-                                   IMG_HEIGHT, IMG_WIDTH)
-  input_image, real_image = normalize(input_image, real_image)
-
-  return input_image, real_image
+def outputs_exist(outfiles):
+    return len(outfiles) > 0 and all(os.path.exists(f) for f in outfiles)
 
 def intensity_rescale(synth_img, real_img):
     
@@ -235,11 +287,11 @@ def histo_matching(synth_img, real_img):
     real_img=np.array(Image.open(real_img))
     synth_img=np.array(Image.open(synth_img))
     
-    synth_img_scaled=match_histograms(synth_img,real_img)
+    synth_img_scaled=exposure.match_histograms(synth_img,real_img)
     
     return Image.fromarray(np.uint8(synth_img_scaled))
 
-def subtract_images(synth_img, real_img, direction=DIRECTION):
+def subtract_images(synth_img, real_img, direction):
     
  
 #    synth_img=Image.open(synth_img)
@@ -252,6 +304,37 @@ def subtract_images(synth_img, real_img, direction=DIRECTION):
         
     return out_img
 
+def slices_to_nifti(slices, real_nifti, outname):
+    final_nifti=nib.Nifti1Image(volume_ops.slices_to_volume(slices), real_nifti.affine, header=real_nifti.header)
+    final_nifti.to_filename(outname)
+
+def read_slice(png):
+    return np.array(Image.open(png).convert('L'))
+
+def read_slices(files):
+    return np.stack([read_slice(png) for png in files])
+
+def read_paddings(padding_path, subjid, slices=None, channels=INPUT_CHANNELS):
+    """Mean paddings of create_mean_padding.py, computed from the slices (if given) if they were not created"""
+    first, last = stack_loader.padding_files(padding_path, subjid)
+    if os.path.exists(first) and os.path.exists(last):
+        return read_slice(first), read_slice(last)
+    if slices is None:
+        raise IOError('No mean paddings for subject {} in {}'.format(subjid, padding_path))
+    return volume_ops.mean_paddings(slices, channels)
+
+def subject_of(png):
+    return os.path.basename(png).split('_')[0]
+
+def generate(generator, stacks, batch_size):
+    """uint8 synthetic slices of uint8 stacks (N, H, W, C), scaled like the raw PNGs of the synth stage"""
+    synth = np.empty(stacks.shape[:3], dtype=np.uint8)
+    for start in range(0, len(stacks), batch_size):
+        inp = volume_ops.to_generator_input(stacks[start:start + batch_size])
+        prediction = generator(inp, training=True).numpy()
+        synth[start:start + batch_size] = volume_ops.scale_to_uint8(prediction[..., 0])
+    return synth
+
 def to_nifti(subjid, realnii, inputdir, outname):
     
     real_nifti=nib.load(realnii)
@@ -272,68 +355,186 @@ def to_nifti(subjid, realnii, inputdir, outname):
     final_nifti.to_filename(outname)
 
 
-test_dataset = tf.data.Dataset.list_files(INPUTPATH+INFILES, shuffle=False)
-test_dataset = test_dataset.map(load_image_test)
-test_dataset = test_dataset.batch(BATCH_SIZE)
-
-generator = tf.keras.models.load_model(MODEL)
-
-os.makedirs(os.path.join(RAW_OUTPATH), exist_ok=True)
-
-# Run the trained model on a few examples from the test dataset
-print()
-for (inp, tar), path, i in zip(test_dataset,
-                            tf.data.Dataset.list_files(INPUTPATH+INFILES,shuffle=False),
-                            tqdm(range(len(glob.glob(os.path.join(TARGETPATH,INFILES)))),
-                                 desc='Creating raw synthetic images')):
-    
-  prediction = generator(inp, training=True)
-
-  outfile = tf.strings.regex_replace(path,INPUTPATH,RAW_OUTPATH)
-  #print('\rwriting '+outfile.numpy().decode("utf-8").split('/')[-1], end='')
-  tf.keras.preprocessing.image.save_img(outfile.numpy(), prediction[0], file_format='png')
-
-  
-raw_synth_list=sorted(glob.glob(os.path.join(RAW_OUTPATH,INFILES)))
-real_list=sorted(glob.glob(os.path.join(TARGETPATH,INFILES)))
-
-os.makedirs(os.path.join(OUTPATH), exist_ok=True)
-os.makedirs(os.path.join(DIFF_OUTPATH), exist_ok=True)
 
-print()
-for synth_img, real_img, i in zip(raw_synth_list, real_list, tqdm(range(len(raw_synth_list)),
-                                 desc='Creating final synthetic and diff images')):
-    
-    # MinMax Intensity scaling (not recommended):
-    # synth_img_minmax_scaled= intensity_rescale(synth_img, real_img)
-    # synth_img_minmax_scaled.save(os.path.join(OUTPATH,'test','minmax',synth_img.split('/')[-1]))
-    
-    #print('\rwriting '+synth_img.split('/')[-1], end='')
-    synth_img_histo_scaled = histo_matching(synth_img, real_img)
-    diff_img = subtract_images(synth_img_histo_scaled, real_img)
-    synth_img_histo_scaled.save(os.path.join(OUTPATH,synth_img.split('/')[-1]))
-    diff_img.save(os.path.join(DIFF_OUTPATH,synth_img.split('/')[-1]))
-    
-if CREATE_NIFTI:
-    
-    os.makedirs(os.path.join(SYNTH_NII), exist_ok=True)
-    os.makedirs(os.path.join(DIFF_NII), exist_ok=True)
-    os.makedirs(os.path.join(GAN_INPUT_NII), exist_ok=True)
-    os.makedirs(os.path.join(GAN_TARGET_NII), exist_ok=True)
-    
-    subjids=set([os.path.basename(img).split('/')[-1].split('_')[0]
-                 for img in glob.glob(os.path.join(INPUTPATH,INFILES))])
-    
-    for sbj in tqdm(subjids):
-        
-        to_nifti(sbj, TARGET_NII+sbj+'_'+TARGET_MODALITY+'.nii.gz',
-                 OUTPATH, SYNTH_NII+sbj+'_synth_'+TARGET_MODALITY)
-        
-        to_nifti(sbj, TARGET_NII+sbj+'_'+TARGET_MODALITY+'.nii.gz',
-                 DIFF_OUTPATH, DIFF_NII+sbj+'_diff')
-        
-        to_nifti(sbj, INPUT_NII+sbj+'_'+INPUT_MODALITY+'.nii.gz',
-                 INPUTPATH, GAN_INPUT_NII+sbj+'_gan-input_'+INPUT_MODALITY)
-        
-        to_nifti(sbj, TARGET_NII+sbj+'_'+TARGET_MODALITY+'.nii.gz',
-                 TARGETPATH, GAN_TARGET_NII+sbj+'_gan-target_'+TARGET_MODALITY)
\ No newline at end of file
+def run_synth(args, dir_dict, generator=None):
+    input_files = shard_files(sorted(glob.glob(dir_dict["INPUTPATH"] + dir_dict["INFILES"])), args.SHARD)
+    raw_files = [os.path.join(dir_dict["RAW_OUTPATH"], os.path.basename(f)) for f in input_files]
+    if not args.OVERWRITE and outputs_exist(raw_files):
+        print('Raw synthetic images already exist in {}, skipping synth stage'.format(dir_dict["RAW_OUTPATH"]))
+        return
+
+    # a generator passed in is already loaded with its threads configured (synth_replicas.py)
+    if generator is None:
+        configure_threads(args)
+        with instrumentation.stage('load_generator', subject=args.SUBJID or None, log=args.METRICS_LOG):
+            generator = tf.keras.models.load_model(args.MODEL)
+
+    os.makedirs(os.path.join(dir_dict["RAW_OUTPATH"]), exist_ok=True)
+
+    # every input PNG is decoded once into the subject's slab ring (slab_inference.py), batches of
+    # consecutive stacks are views of it; the batches are in the order of input_files, i.e. of raw_files
+    raw_iter = iter(raw_files)
+    sections = instrumentation.Sections(subject=args.SUBJID or None, log=args.METRICS_LOG)
+    progress = tqdm(total=len(raw_files), desc='Creating raw synthetic images')
+    for sbj, files in groupby(input_files, key=subject_of):
+        first_pad, last_pad = read_paddings(dir_dict["INPUT_PADDING_PATH"], sbj)
+        batches = slab_inference.slab_batches((read_slice(png) for png in files), first_pad, last_pad,
+                                              args.INPUT_CHANNELS, args.BATCH_SIZE)
+        while True:
+            with sections('load_stacks'):
+                stacks = next(batches, None)
+            if stacks is None:
+                break
+            with sections('generator'):
+                prediction = generator(volume_ops.to_generator_input(stacks), training=True).numpy()
+            with sections('save_png'):
+                for pred in prediction:
+                    tf.keras.preprocessing.image.save_img(next(raw_iter), pred, file_format='png')
+            progress.update(len(prediction))
+    progress.close()
+    sections.flush()
+
+
+def run_postproc(args, dir_dict):
+    raw_synth_list = shard_files(sorted(glob.glob(os.path.join(dir_dict["RAW_OUTPATH"], dir_dict["INFILES"]))),
+                                 args.SHARD)
+    real_list = shard_files(sorted(glob.glob(os.path.join(dir_dict["TARGETPATH"], dir_dict["INFILES"]))), args.SHARD)
+
+    out_files = [os.path.join(d, os.path.basename(f)) for f in raw_synth_list
+                 for d in (dir_dict["OUTPATH"], dir_dict["DIFF_OUTPATH"])]
+    if not args.OVERWRITE and outputs_exist(out_files):
+        print('Synthetic and diff images already exist, skipping postproc stage')
+        return
+
+    os.makedirs(os.path.join(dir_dict["OUTPATH"]), exist_ok=True)
+    os.makedirs(os.path.join(dir_dict["DIFF_OUTPATH"]), exist_ok=True)
+
+    sections = instrumentation.Sections(subject=args.SUBJID or None, log=args.METRICS_LOG)
+    for synth_img, real_img in tqdm(list(zip(raw_synth_list, real_list)),
+                                    desc='Creating final synthetic and diff images'):
+
+        # MinMax Intensity scaling (not recommended):
+        # synth_img_minmax_scaled= intensity_rescale(synth_img, real_img)
+        # synth_img_minmax_scaled.save(os.path.join(OUTPATH,'test','minmax',synth_img.split('/')[-1]))
+
+        with sections('histo_matching'):
+            synth_img_histo_scaled = histo_matching(synth_img, real_img)
+        with sections('subtract'):
+            diff_img = subtract_images(synth_img_histo_scaled, real_img, args.DIRECTION)
+        with sections('save_png'):
+            synth_img_histo_scaled.save(os.path.join(dir_dict["OUTPATH"], synth_img.split('/')[-1]))
+            diff_img.save(os.path.join(dir_dict["DIFF_OUTPATH"], synth_img.split('/')[-1]))
+    sections.flush()
+
+
+def run_nifti(args, dir_dict):
+    os.makedirs(os.path.join(dir_dict["SYNTH_NII"]), exist_ok=True)
+    os.makedirs(os.path.join(dir_dict["DIFF_NII"]), exist_ok=True)
+    os.makedirs(os.path.join(dir_dict["GAN_INPUT_NII"]), exist_ok=True)
+    os.makedirs(os.path.join(dir_dict["GAN_TARGET_NII"]), exist_ok=True)
+
+    subjids = shard_subjects(set([os.path.basename(img).split('_')[0]
+                                  for img in glob.glob(os.path.join(dir_dict["INPUTPATH"], dir_dict["INFILES"]))]),
+                             args.SHARD)
+
+    target_mod, input_mod = args.TARGET_MODALITY, args.INPUT_MODALITY
+    for sbj in tqdm(subjids, desc='Creating niftis'):
+        target_nii = dir_dict["TARGET_NII"] + sbj + '_' + target_mod + '.nii.gz'
+        input_nii = dir_dict["INPUT_NII"] + sbj + '_' + input_mod + '.nii.gz'
+        jobs = [(target_nii, dir_dict["OUTPATH"], dir_dict["SYNTH_NII"] + sbj + '_synth_' + target_mod),
+                (target_nii, dir_dict["DIFF_OUTPATH"], dir_dict["DIFF_NII"] + sbj + '_diff'),
+                (input_nii, dir_dict["INPUTPATH"], dir_dict["GAN_INPUT_NII"] + sbj + '_gan-input_' + input_mod),
+                (target_nii, dir_dict["TARGETPATH"], dir_dict["GAN_TARGET_NII"] + sbj + '_gan-target_' + target_mod)]
+
+        with instrumentation.stage('to_nifti', subject=sbj, log=args.METRICS_LOG):
+            for realnii, inputdir, outname in jobs:
+                if not args.OVERWRITE and glob.glob(outname + '*'):
+                    continue
+                to_nifti(sbj, realnii, inputdir, outname + '.' + args.OUT_FORMAT)
+
+
+def reverse_options(args):
+    """Options of the reverse direction (target -> input modality, MODEL_REV)"""
+    rev_args = argparse.Namespace(**vars(args))
+    rev_args.INPUT_MODALITY, rev_args.TARGET_MODALITY = args.TARGET_MODALITY, args.INPUT_MODALITY
+    rev_args.MODEL = args.MODEL_REV
+    return rev_args
+
+
+def run_both(args, dir_dict):
+    directions = [(args, dir_dict)]
+    rev_args = reverse_options(args)
+    directions.append((rev_args, setup_dirs(rev_args)))
+
+    def outnames(a, dd, sbj):
+        return [dd["SYNTH_NII"] + sbj + '_synth_' + a.TARGET_MODALITY, dd["DIFF_NII"] + sbj + '_diff',
+                dd["GAN_INPUT_NII"] + sbj + '_gan-input_' + a.INPUT_MODALITY,
+                dd["GAN_TARGET_NII"] + sbj + '_gan-target_' + a.TARGET_MODALITY]
+
+    subjids = shard_subjects(set([os.path.basename(img).split('_')[0]
+                                  for img in glob.glob(os.path.join(dir_dict["INPUTPATH"], dir_dict["INFILES"]))]),
+                             args.SHARD)
+    if not args.OVERWRITE:
+        subjids = [sbj for sbj in subjids
+                   if not all(glob.glob(o + '*') for a, dd in directions for o in outnames(a, dd, sbj))]
+    if not subjids:
+        print('Synthetic volumes of both directions already exist, skipping both stage')
+        return
+
+    for a, dd in directions:
+        for key in ("SYNTH_NII", "DIFF_NII", "GAN_INPUT_NII", "GAN_TARGET_NII"):
+            os.makedirs(dd[key], exist_ok=True)
+    configure_threads(args)
+    with instrumentation.stage('load_generator', subject=args.SUBJID or None, log=args.METRICS_LOG):
+        generators = [tf.keras.models.load_model(a.MODEL) for a, dd in directions]
+
+    sections = instrumentation.Sections(subject=args.SUBJID or None, log=args.METRICS_LOG)
+    for sbj in tqdm(subjids, desc='Synthesizing both directions'):
+        # real slices and reference niftis of the input (0) and target (1) modality, shared by both directions
+        with sections('load_slices'):
+            slices = [read_slices(sorted(glob.glob(dd["INPUTPATH"] + sbj + '_*.png'))) for a, dd in directions]
+            niftis = [nib.load(dd["INPUT_NII"] + sbj + '_' + a.INPUT_MODALITY + '.nii.gz') for a, dd in directions]
+        if slices[0].shape != slices[1].shape:
+            raise ValueError('Subject {}: {} and {} slices differ in shape ({} vs {})'.format(
+                sbj, args.INPUT_MODALITY, args.TARGET_MODALITY, slices[0].shape, slices[1].shape))
+
+        for d, ((a, dd), generator) in enumerate(zip(directions, generators)):
+            real_input, real_target = slices[d], slices[1 - d]
+            input_nifti, target_nifti = niftis[d], niftis[1 - d]
+            with sections('stacks'):
+                first_pad, last_pad = read_paddings(dd["INPUT_PADDING_PATH"], sbj, real_input, args.INPUT_CHANNELS)
+                stacks = volume_ops.slice_stacks(real_input, first_pad, last_pad, args.INPUT_CHANNELS)
+            with sections('generator'):
+                synth = generate(generator, stacks, args.BATCH_SIZE)
+            with sections('histo_matching'):
+                synth = volume_ops.histo_matching(synth, real_target)
+            with sections('subtract'):
+                diff = volume_ops.subtract_slices(synth, real_target, args.DIRECTION)
+            with sections('save_nifti'):
+                jobs = zip((synth, diff, real_input, real_target),
+                           (target_nifti, target_nifti, input_nifti, target_nifti), outnames(a, dd, sbj))
+                for vol_slices, real_nifti, outname in jobs:
+                    if not args.OVERWRITE and glob.glob(outname + '*'):
+                        continue
+                    slices_to_nifti(vol_slices, real_nifti, outname + '.' + args.OUT_FORMAT)
+    sections.flush()
+
+
+STAGES = {"synth": [run_synth],
+          "postproc": [run_postproc],
+          "nifti": [run_nifti],
+          "all": [run_synth, run_postproc, run_nifti],
+          "both": [run_both]}
+
+
+def main(argv=None):
+    args = setup_options(argv)
+    dir_dict = setup_dirs(args)
+    for stage in STAGES[args.STAGE]:
+        with instrumentation.stage(stage.__name__[len('run_'):], subject=args.SUBJID or None,
+                                   log=args.METRICS_LOG):
+            stage(args, dir_dict)
+
+
+if __name__ == "__main__":
+    main()
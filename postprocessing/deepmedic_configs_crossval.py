@@ -4,105 +4,138 @@
 Created on Wed Jul 15 15:57:22 2020
 
 Script to create specific cross-validation configurations for DeepMedic.
-Needs to be refactored to be more dynamic. At the moment only implemented
-for 7-channel input.
+The channels are the 7 channels of the original script (7ch, default) or a
+custom list of channels, which has to match the channels of the DeepMedic
+model config (numberOfInputChannels and the channel lists of the generic
+train/test configs). All file lists of a split are built in memory and written once.
+Before anything is written, every referenced input NIfTI is checked against a
+single listing of the input directory, so missing files are reported up front.
+
+Expects the generic trainConfig.cfg / testConfig.cfg ('session_name' is replaced)
+in <outpath>/train and <outpath>/test.
 
 @author: bdavid
 """
 
+import os
+import sys
+import argparse
+
 import pandas as pd
-import numpy as np
 from sklearn.model_selection import RepeatedKFold
-import os
 
-lesions = pd.read_csv('/home/bdavid/Deep_Learning/data/bonn/administration/lists/lesion_volumes.txt',
-                      delim_whitespace=True)
-
-session='7ch_FCD_crossval'
-random_state=42
-n_splits=5
-n_repeats=3
-outpath=os.path.join('/home/bdavid/Deep_Learning/deepmedic/examples/configFiles/',session)
-inpath='/home/bdavid/Deep_Learning/data/bonn/FCD/iso_FLAIR/nii/deepmedic_input'
-
-rkf = RepeatedKFold(n_splits=n_splits, n_repeats=n_repeats, random_state=random_state)
-
-repeat=1
-idx=1
-split = 1
-for train, test in rkf.split(lesions['ID']): 
-    
-    curr_path=str(repeat)+'_'+str(split)
-    filename_train='train_'+str(repeat)+'_'+str(split)+'.txt'
-    filename_test='test_'+str(repeat)+'_'+str(split)+'.txt'
-    
-    curr_train=lesions['ID'].iloc[train].values
-    curr_test=lesions['ID'].iloc[test].values
-    
-    os.makedirs(os.path.join(outpath,'train',curr_path), exist_ok=True)
-    os.makedirs(os.path.join(outpath,'test',curr_path), exist_ok=True)
-    np.savetxt(os.path.join(outpath,'train',curr_path,filename_train),curr_train,delimiter='\n',fmt='%d')
-    np.savetxt(os.path.join(outpath,'test',curr_path,filename_test),curr_test,delimiter='\n',fmt='%d')
-    
-    for sbj in curr_train:
-        
-        with open(os.path.join(outpath,'train',curr_path,'T1.txt'),"a") as T1:
-            print(os.path.join(inpath,str(sbj)+'_T1.nii.gz'), file=T1)
-        with open(os.path.join(outpath,'train',curr_path,'FLAIR.txt'),"a") as FLAIR:
-            print(os.path.join(inpath,str(sbj)+'_FLAIR.nii.gz'), file=FLAIR)
-        with open(os.path.join(outpath,'train',curr_path,'diff.txt'),"a") as diff:
-            print(os.path.join(inpath,str(sbj)+'_diff.nii.gz'), file=diff)
-        with open(os.path.join(outpath,'train',curr_path,'weights.txt'),"a") as weights:
-            print(os.path.join(inpath,str(sbj)+'_weights.nii.gz'), file=weights)
-        with open(os.path.join(outpath,'train',curr_path,'extension.txt'),"a") as extension:
-            print(os.path.join(inpath,str(sbj)+'_extension.nii.gz'), file=extension)
-        with open(os.path.join(outpath,'train',curr_path,'junction.txt'),"a") as junction:
-            print(os.path.join(inpath,str(sbj)+'_junction.nii.gz'), file=junction)
-        with open(os.path.join(outpath,'train',curr_path,'thickness.txt'),"a") as thickness:
-            print(os.path.join(inpath,str(sbj)+'_thickness.nii.gz'), file=thickness)
-        with open(os.path.join(outpath,'train',curr_path,'roi.txt'),"a") as roi:
-            print(os.path.join(inpath,str(sbj)+'_roi.nii.gz'), file=roi)
-        with open(os.path.join(outpath,'train',curr_path,'mask.txt'),"a") as mask:
-            print(os.path.join(inpath,str(sbj)+'_mask.nii.gz'), file=mask)
-            
-    for sbj in curr_test:
-        
-        with open(os.path.join(outpath,'test',curr_path,'T1.txt'),"a") as T1:
-            print(os.path.join(inpath,str(sbj)+'_T1.nii.gz'), file=T1)
-        with open(os.path.join(outpath,'test',curr_path,'FLAIR.txt'),"a") as FLAIR:
-            print(os.path.join(inpath,str(sbj)+'_FLAIR.nii.gz'), file=FLAIR)
-        with open(os.path.join(outpath,'test',curr_path,'diff.txt'),"a") as diff:
-            print(os.path.join(inpath,str(sbj)+'_diff.nii.gz'), file=diff)
-        with open(os.path.join(outpath,'test',curr_path,'weights.txt'),"a") as weights:
-            print(os.path.join(inpath,str(sbj)+'_weights.nii.gz'), file=weights)
-        with open(os.path.join(outpath,'test',curr_path,'extension.txt'),"a") as extension:
-            print(os.path.join(inpath,str(sbj)+'_extension.nii.gz'), file=extension)
-        with open(os.path.join(outpath,'test',curr_path,'junction.txt'),"a") as junction:
-            print(os.path.join(inpath,str(sbj)+'_junction.nii.gz'), file=junction)
-        with open(os.path.join(outpath,'test',curr_path,'thickness.txt'),"a") as thickness:
-            print(os.path.join(inpath,str(sbj)+'_thickness.nii.gz'), file=thickness)
-        with open(os.path.join(outpath,'test',curr_path,'roi.txt'),"a") as roi:
-            print(os.path.join(inpath,str(sbj)+'_roi.nii.gz'), file=roi)
-        with open(os.path.join(outpath,'test',curr_path,'mask.txt'),"a") as mask:
-            print(os.path.join(inpath,str(sbj)+'_mask.nii.gz'), file=mask)
-        with open(os.path.join(outpath,'test',curr_path,'prediction_names.txt'),"a") as pred:
-            print(os.path.join(inpath,str(sbj)+'_prediction.nii.gz'), file=pred)
-            
-    with open(os.path.join(outpath,'train','trainConfig.cfg'), 'r') as generic_train:
-        filedata = generic_train.read()
-    filedata = filedata.replace('session_name',session+'_'+str(repeat)+'_'+str(split))
-    with open(os.path.join(outpath,'train',curr_path,'train_'+str(repeat)+'_'+str(split)+'.cfg'), 'w') as curr_config:
-        curr_config.write(filedata)
-        
-    with open(os.path.join(outpath,'test','testConfig.cfg'), 'r') as generic_test:
-        filedata = generic_test.read()
-    filedata = filedata.replace('session_name',session+'_'+str(repeat)+'_'+str(split))
-    with open(os.path.join(outpath,'test',curr_path,'test_'+str(repeat)+'_'+str(split)+'.cfg'), 'w') as curr_config:
-        curr_config.write(filedata)
-            
-        
-    split += 1
-    if idx%n_splits == 0: 
-        repeat += 1
-        split = 1
-    idx += 1
\ No newline at end of file
+# -------- USER INPUT (defaults) ----------
+
+LESIONS = '/home/bdavid/Deep_Learning/data/bonn/administration/lists/lesion_volumes.txt'
+CONFIGPATH = '/home/bdavid/Deep_Learning/deepmedic/examples/configFiles/'
+INPATH = '/home/bdavid/Deep_Learning/data/bonn/FCD/iso_FLAIR/nii/deepmedic_input'
+RANDOM_STATE = 42
+N_SPLITS = 5
+N_REPEATS = 3
+
+#-------------------------------
+
+CHANNEL_SETS = {'7ch': ['T1', 'FLAIR', 'diff', 'weights', 'extension', 'junction', 'thickness']}
+
+# lists written for every split in addition to the channels
+LABEL_LISTS = ['roi', 'mask']
+
+
+def setup_options():
+    parser = argparse.ArgumentParser(description='Cross-validation configurations for DeepMedic')
+    parser.add_argument("--channels", default='7ch',
+                        help="channel set ({}) or comma separated list of channels, e.g. T1,FLAIR,disc "
+                             "(default: 7ch)".format(', '.join(CHANNEL_SETS)))
+    parser.add_argument("--session", default=None,
+                        help="session name (default: <channels>_FCD_crossval)")
+    parser.add_argument("--lesions", default=LESIONS, help="table with subject 'ID' column")
+    parser.add_argument("--config_path", default=CONFIGPATH,
+                        help="DeepMedic configFiles directory, output goes to <config_path>/<session>")
+    parser.add_argument("--inpath", default=INPATH, help="directory of the DeepMedic input niftis")
+    parser.add_argument("--n_splits", type=int, default=N_SPLITS)
+    parser.add_argument("--n_repeats", type=int, default=N_REPEATS)
+    parser.add_argument("--random_state", type=int, default=RANDOM_STATE)
+    parser.add_argument("--allow_missing", action="store_true",
+                        help="write the configurations even if input files are missing")
+    return parser.parse_args()
+
+
+def channel_list(channels):
+    if channels in CHANNEL_SETS:
+        return CHANNEL_SETS[channels]
+    return [ch.strip() for ch in channels.split(',') if ch.strip()]
+
+
+def split_lists(subjects, channels, inpath, test=False):
+    """File lists of one split as {list name: [lines]}"""
+    names = channels + LABEL_LISTS
+    lists = {name: [os.path.join(inpath, str(sbj) + '_' + name + '.nii.gz') for sbj in subjects]
+             for name in names}
+    if test:
+        lists['prediction_names'] = [os.path.join(inpath, str(sbj) + '_prediction.nii.gz') for sbj in subjects]
+    return lists
+
+
+def missing_inputs(splits, inpath, channels):
+    """Checks all referenced channel/label files against one listing of inpath"""
+    index = set(os.listdir(inpath)) if os.path.isdir(inpath) else set()
+    missing = set()
+    for phase, curr_path, subjects, lists in splits:
+        for name in channels + LABEL_LISTS:
+            missing.update(f for f in lists[name] if os.path.basename(f) not in index)
+    return sorted(missing)
+
+
+def write_lines(filename, lines):
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def main():
+    args = setup_options()
+    channels = channel_list(args.channels)
+    session = args.session or args.channels.replace(',', '-') + '_FCD_crossval'
+    outpath = os.path.join(args.config_path, session)
+
+    lesions = pd.read_csv(args.lesions, sep=r'\s+')
+    rkf = RepeatedKFold(n_splits=args.n_splits, n_repeats=args.n_repeats, random_state=args.random_state)
+
+    # build all splits in memory first
+    splits = []
+    for idx, (train, test) in enumerate(rkf.split(lesions['ID'])):
+        repeat, split = idx // args.n_splits + 1, idx % args.n_splits + 1
+        curr_path = str(repeat) + '_' + str(split)
+        for phase, rows in (('train', train), ('test', test)):
+            subjects = lesions['ID'].iloc[rows].values
+            splits.append((phase, curr_path, subjects,
+                           split_lists(subjects, channels, args.inpath, test=phase == 'test')))
+
+    missing = missing_inputs(splits, args.inpath, channels)
+    if missing:
+        print('{} referenced input files are missing in {}:'.format(len(missing), args.inpath))
+        print('\n'.join('  ' + os.path.basename(f) for f in missing))
+        if not args.allow_missing:
+            sys.exit(1)
+
+    templates = {}
+    for phase, generic in (('train', 'trainConfig.cfg'), ('test', 'testConfig.cfg')):
+        with open(os.path.join(outpath, phase, generic), 'r') as generic_cfg:
+            templates[phase] = generic_cfg.read()
+
+    for phase, curr_path, subjects, lists in splits:
+        split_dir = os.path.join(outpath, phase, curr_path)
+        os.makedirs(split_dir, exist_ok=True)
+
+        write_lines(os.path.join(split_dir, phase + '_' + curr_path + '.txt'), ['%d' % sbj for sbj in subjects])
+        for name, lines in lists.items():
+            write_lines(os.path.join(split_dir, name + '.txt'), lines)
+
+        filedata = templates[phase].replace('session_name', session + '_' + curr_path)
+        with open(os.path.join(split_dir, phase + '_' + curr_path + '.cfg'), 'w') as curr_config:
+            curr_config.write(filedata)
+
+    print('Wrote {} splits with channels {} to {}'.format(len(splits) // 2, ', '.join(channels), outpath))
+
+
+if __name__ == "__main__":
+    main()
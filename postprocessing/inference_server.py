@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent local inference server for synthetic image generation.
+
+Keeps the generator (and optionally the discriminator) loaded, so that subjects
+arriving from the scanner do not pay for the tensorflow import and model loading.
+Slices of concurrent requests are collected into micro-batches: a batch is run as
+soon as it is full or the oldest queued slice waited --max_wait ms.
+
+Input volumes are expected in the GAN slice layout (e.g. gan_input_T1 niftis
+written by create_synthetic_images.py), see volume_ops.py.
+
+API (HTTP, default 127.0.0.1:8765):
+    GET  /health       model and queue information
+    POST /synthesize   JSON {"input": nii, "target": nii (optional), "out_dir": dir,
+                             "subject": id (optional), "direction": "real-fake"}
+                       -> writes <subject>_synth_<mod>.nii.gz (and _diff, _disc)
+                          and returns the written paths as JSON
+    POST /synthesize   application/octet-stream, npz with arrays 'input' and
+                       optionally 'target' and 'direction' (0-d string array)
+                       -> npz with 'synth', 'diff', 'disc'
+    Invalid requests (e.g. slices not matching the generator input) get a 400,
+    failures while processing a valid one a 500 reply, both with JSON {"error": ...}.
+
+Example:
+    python3 inference_server.py serve --model ../models/T1_2_FLAIR_cor/generator
+    python3 inference_server.py submit --input 101_gan-input_T1.nii.gz \
+            --target 101_gan-target_FLAIR.nii.gz --out_dir /output/synth
+
+@author: bdavid
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.request import Request, urlopen
+
+import numpy as np
+
+from lazy_import import lazy_import
+import volume_ops
+
+tf = lazy_import('tensorflow')
+nib = lazy_import('nibabel')
+
+# -------- USER INPUT (defaults) ----------
+
+MODEL = '../models/T1_2_FLAIR_cor/generator'
+HOST = '127.0.0.1'
+PORT = 8765
+MAX_BATCH = 16
+MAX_WAIT_MS = 5.0
+INPUT_CHANNELS = 7
+TARGET_MODALITY = 'FLAIR'
+
+#-------------------------------
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """http.server.ThreadingHTTPServer, which is only available from Python 3.7 on"""
+    daemon_threads = True
+
+
+class _Request(object):
+    """Slices of one volume waiting for the model"""
+
+    def __init__(self, stacks):
+        self.stacks = stacks
+        self.outputs = [None] * len(stacks)
+        self.pending = len(stacks)
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """Collects single slices of concurrent requests into batches for one model call
+
+    predict_fn gets the stacks of a batch as one array (B, H, W, C) and returns
+    a tuple of arrays with the batch dimension first.
+    """
+
+    def __init__(self, predict_fn, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+        self.predict_fn = predict_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.slices = 0
+        self._thread = threading.Thread(target=self._run, name='micro-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def predict(self, stacks):
+        """Blocks until all stacks (N, H, W, C) are processed, returns the stacked outputs"""
+        request = _Request(stacks)
+        if request.pending == 0:
+            raise ValueError('No slices to process')
+        for i in range(len(stacks)):
+            self._queue.put((request, i))
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return tuple(np.stack(out) for out in zip(*request.outputs))
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _call(self, items):
+        """Model outputs per (request, slice) item, raises if the batch fails"""
+        outputs = self.predict_fn(np.stack([req.stacks[i] for req, i in items]))
+        return [tuple(np.asarray(out[b]) for out in outputs) for b in range(len(items))]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = [(item, out, None) for item, out in zip(batch, self._call(batch))]
+            except Exception:
+                # run the requests of the batch separately, so that only the offending one fails
+                results = []
+                for req in set(req for req, _ in batch):
+                    items = [(r, i) for r, i in batch if r is req]
+                    try:
+                        results += [(item, out, None) for item, out in zip(items, self._call(items))]
+                    except Exception as e:  # handed on to the waiting request
+                        results += [(item, None, e) for item in items]
+
+            self.batches += 1
+            self.slices += len(batch)
+            for (req, i), out, error in results:
+                with self._lock:
+                    if error is not None:
+                        req.error = error
+                    else:
+                        req.outputs[i] = out
+                    req.pending -= 1
+                    finished = req.pending == 0
+                if finished or error is not None:
+                    req.done.set()
+
+
+class SynthesisService(object):
+    """Generator (+ optional discriminator) kept in memory"""
+
+    def __init__(self, model, discriminator=None, channels=INPUT_CHANNELS, max_batch=MAX_BATCH,
+                 max_wait_ms=MAX_WAIT_MS, target_modality=TARGET_MODALITY):
+        self.channels = channels
+        self.target_modality = target_modality
+        self.model_path = model
+        self.generator = tf.keras.models.load_model(model)
+        self.discriminator = tf.keras.models.load_model(discriminator) if discriminator else None
+
+        signature = [tf.TensorSpec([None, None, None, channels], tf.float32)]
+        self._predict = tf.function(self._forward, input_signature=signature)
+        self.batcher = MicroBatcher(self._predict_numpy, max_batch, max_wait_ms)
+
+    def _forward(self, inp):
+        prediction = self.generator(inp, training=True)
+        if self.discriminator is None:
+            return (prediction,)
+        disc = self.discriminator([inp[..., self.channels // 2, tf.newaxis], prediction], training=True)
+        # PatchGAN logits upsampled to slice resolution, as in discriminator_output_test.py
+        return prediction, tf.image.resize(disc, tf.shape(inp)[1:3], method=tf.image.ResizeMethod.BILINEAR)
+
+    def _predict_numpy(self, batch):
+        inp = volume_ops.to_generator_input(batch)
+        return tuple(out.numpy() for out in self._predict(tf.constant(inp)))
+
+    def synthesize(self, input_volume, target_volume=None, direction='real-fake'):
+        """Returns dict with synthetic volume, diff volume (if target given) and discriminator map volume"""
+        if direction not in ('real-fake', 'fake-real'):
+            raise ValueError("Unknown direction '{}'".format(direction))
+        slices = volume_ops.volume_to_slices(input_volume)
+        # rejected before queueing, a mismatching volume would fail the whole micro-batch
+        height, width, channels = self.generator.input_shape[1:]
+        if (height, width) != (None, None) and slices.shape[1:] != (height, width):
+            raise ValueError('Slices of {} x {} expected by the generator, got {} x {}'.format(
+                height, width, *slices.shape[1:]))
+        if channels is not None and channels != self.channels:
+            raise ValueError('Generator expects {} input channels, server runs with {}'.format(channels,
+                                                                                             self.channels))
+        if target_volume is not None and np.shape(target_volume) != np.shape(input_volume):
+            raise ValueError('Target volume does not match the input volume')
+        first_pad, last_pad = volume_ops.mean_paddings(slices, self.channels)
+        # uint8 view of the padded slices, converted to generator input per micro-batch
+        stacks = volume_ops.slice_stacks(slices, first_pad, last_pad, self.channels)
+
+        outputs = self.batcher.predict(stacks)
+        synth = volume_ops.scale_to_uint8(outputs[0][..., 0])
+
+        result = {}
+        if target_volume is not None:
+            real = volume_ops.volume_to_slices(target_volume)
+            synth = volume_ops.histo_matching(synth, real)
+            result['diff'] = volume_ops.slices_to_volume(volume_ops.subtract_slices(synth, real, direction))
+        result['synth'] = volume_ops.slices_to_volume(synth)
+        if len(outputs) > 1:
+            result['disc'] = volume_ops.slices_to_volume(outputs[1][..., 0])
+        return result
+
+    def synthesize_files(self, input_nii, out_dir, target_nii=None, subject=None, direction='real-fake'):
+        input_img = nib.load(input_nii)
+        target_img = nib.load(target_nii) if target_nii else None
+        if subject is None:
+            subject = os.path.basename(input_nii).split('_')[0]
+
+        result = self.synthesize(np.asanyarray(input_img.dataobj),
+                                 np.asanyarray(target_img.dataobj) if target_img is not None else None,
+                                 direction)
+
+        # header and affine of the target, as in create_synthetic_images.py
+        ref = target_img if target_img is not None else input_img
+        os.makedirs(out_dir, exist_ok=True)
+        written = {}
+        for key, name in (('synth', subject + '_synth_' + self.target_modality), ('diff', subject + '_diff'),
+                          ('disc', subject + '_disc_' + self.target_modality)):
+            if key in result:
+                header = ref.header.copy()
+                header.set_data_dtype(result[key].dtype)
+                written[key] = os.path.join(out_dir, name + '.nii.gz')
+                nib.Nifti1Image(result[key], ref.affine, header=header).to_filename(written[key])
+        return written
+
+
+class SynthesisHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def _send(self, code, body, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/health':
+            return self._send(404, {'error': 'unknown path ' + self.path})
+        batcher = self.service.batcher
+        self._send(200, {'model': self.service.model_path,
+                         'discriminator': self.service.discriminator is not None,
+                         'queued_slices': batcher.qsize(),
+                         'batches': batcher.batches,
+                         'slices': batcher.slices})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/synthesize':
+            return self._send(404, {'error': 'unknown path ' + self.path})
+        start = time.time()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                req = json.loads(body.decode('utf-8'))
+                written = self.service.synthesize_files(req['input'], req['out_dir'], req.get('target'),
+                                                        req.get('subject'), req.get('direction', 'real-fake'))
+                written['seconds'] = time.time() - start
+                return self._send(200, written)
+
+            arrays = np.load(io.BytesIO(body))
+            direction = str(arrays['direction']) if 'direction' in arrays else 'real-fake'
+            result = self.service.synthesize(arrays['input'], arrays['target'] if 'target' in arrays else None,
+                                             direction)
+            out = io.BytesIO()
+            np.savez(out, **result)
+            self._send(200, out.getvalue(), 'application/octet-stream')
+        except (KeyError, ValueError, IOError) as e:
+            self._send(400, {'error': repr(e)})
+        except Exception as e:  # e.g. a failing model call, the client still gets a reply
+            self._send(500, {'error': repr(e)})
+
+    def log_message(self, fmt, *args):
+        print('[{}] {}'.format(time.strftime('%H:%M:%S'), fmt % args))
+
+
+def submit(url, input_nii, out_dir, target_nii=None, subject=None, direction='real-fake'):
+    """Client side of /synthesize for nifti paths, returns the server's JSON reply"""
+    payload = {'input': os.path.abspath(input_nii), 'out_dir': os.path.abspath(out_dir),
+               'direction': direction}
+    if target_nii:
+        payload['target'] = os.path.abspath(target_nii)
+    if subject:
+        payload['subject'] = subject
+    req = Request(url.rstrip('/') + '/synthesize', data=json.dumps(payload).encode('utf-8'),
+                  headers={'Content-Type': 'application/json'})
+    with urlopen(req) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def setup_options():
+    parser = argparse.ArgumentParser(description='Persistent inference server for synthetic images')
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    subparsers.required = True
+
+    serve = subparsers.add_parser("serve", help="load the models and serve requests")
+    serve.add_argument("--model", default=MODEL, help="Generator model (default: {})".format(MODEL))
+    serve.add_argument("--disc", default=None, help="Discriminator model (optional)")
+    serve.add_argument("--om", dest="target_modality", default=TARGET_MODALITY, choices=["T1", "FLAIR"],
+                       help="Modality of synthetic image, used for output names")
+    serve.add_argument("--num_c", dest="channels", type=int, default=INPUT_CHANNELS,
+                       help="Number of input channels (default={})".format(INPUT_CHANNELS))
+    serve.add_argument("--host", default=HOST)
+    serve.add_argument("--port", type=int, default=PORT)
+    serve.add_argument("--max_batch", type=int, default=MAX_BATCH,
+                       help="Maximum no. of slices per model call (default={})".format(MAX_BATCH))
+    serve.add_argument("--max_wait", type=float, default=MAX_WAIT_MS,
+                       help="Maximum wait in ms for filling a batch (default={})".format(MAX_WAIT_MS))
+
+    sub = subparsers.add_parser("submit", help="send a subject to a running server")
+    sub.add_argument("--url", default='http://{}:{}'.format(HOST, PORT))
+    sub.add_argument("--input", required=True, help="Input nifti (GAN slice layout)")
+    sub.add_argument("--target", default=None, help="Real target nifti for histogram matching and diff")
+    sub.add_argument("--out_dir", required=True)
+    sub.add_argument("--sid", dest="subject", default=None, help="Subject ID (default: input file prefix)")
+    sub.add_argument("--dir", dest="direction", default='real-fake', choices=['real-fake', 'fake-real'])
+    return parser.parse_args()
+
+
+def main():
+    args = setup_options()
+    if args.command == 'submit':
+        print(json.dumps(submit(args.url, args.input, args.out_dir, args.target, args.subject, args.direction),
+                         indent=2))
+        return
+
+    SynthesisHandler.service = SynthesisService(args.model, args.disc, args.channels, args.max_batch,
+                                                args.max_wait, args.target_modality)
+    server = ThreadingHTTPServer((args.host, args.port), SynthesisHandler)
+    print('Serving {} on http://{}:{}'.format(args.model, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Deferred imports for the postprocessing scripts.
+
+TensorFlow, skimage and nibabel take several seconds to import. The scripts
+bind these names through lazy_import() at module level, so the actual import
+only happens once a stage touches the module (e.g. not for --help or when all
+outputs of a stage already exist).
+"""
+
+import importlib
+
+
+class LazyModule(object):
+    """Module proxy, imports the wrapped module on first attribute access"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return "<lazy module '{}' ({})>".format(self._name, state)
+
+
+def lazy_import(name):
+    return LazyModule(name)
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stage graph version of preprocessing_for_deepmedic.sh.
+
+Every processing step of a subject is declared as a stage with its input and
+output images. The stages of all subjects form one dependency graph, which is
+run by a scheduler that starts every stage whose inputs are available, as long
+as the CPU budget (--cores) is not exceeded. Thereby independent branches
+(bet/fast, samseg, the MAP normalizations, ...) of one subject and the stages of
+different subjects run concurrently.
+
+A stage is skipped if all of its outputs exist and are newer than its inputs,
+i.e. an interrupted or extended run only recomputes what is missing or outdated.
+In contrast to the shell script, no image is modified in place (e.g. the eroded
+mask or the registered diff image get their own intermediate files), otherwise
+the modification times could not tell whether a stage is up to date.
+
+Intermediates in <output_dir>/tmp are written uncompressed (FSLOUTPUTTYPE=NIFTI),
+which saves the gzip CPU time of every write/read and lets Python stages memory map
+them (nib.load(..., mmap='r')); only stages writing DeepMedic inputs compress.
+
+Commands and their output are written per stage to <log_dir>/<sbj>/fcd_gan.log,
+followed by the wall time of every stage and a per subject summary. Wall/CPU
+time, peak RSS and I/O of every command go to <log_dir>/metrics.jsonl (see
+util/instrumentation.py, which also aggregates them over the cohort).
+
+Example:
+    python3 preprocessing_for_deepmedic.py --cores 16 3022 3023
+
+@author: bdavid
+"""
+
+import os
+import sys
+import glob
+import time
+import shlex
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# -------- USER INPUT (defaults) ----------
+
+INPUT_DIR = '/input/data/berlin/analyses/FCD/nii'
+OUTPUT_DIR = '/output/data/berlin/analyses/FCD/nii'
+SCRIPT_DIR = '/output'
+# morphometric_maps (also change order Sid_T1)
+MAP_SUBDIR = 'berlin_morphometric_maps/FCD'
+FS_LICENSE = '/output/postprocessing/.license'
+CORES = os.cpu_count() or 1
+SAMSEG_THREADS = 4
+
+#-------------------------------
+
+# ROIs not being purged (filtering out mostly subcortical structures)
+ROIS = [3, 2, 24, 41, 42, 77, 78, 79, 80, 81, 82, 100, 109]
+MAPS = ['junction', 'extension', 'thickness']
+IMAGE_EXT = ('.nii.gz', '.nii')
+# FSLOUTPUTTYPE of intermediates and of the DeepMedic inputs, and their file extensions
+TMP_TYPE, FINAL_TYPE = 'NIFTI', 'NIFTI_GZ'
+TYPE_EXT = {'NIFTI': '.nii', 'NIFTI_GZ': '.nii.gz'}
+INSTRUMENTATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'util', 'instrumentation.py')
+
+FLIRT_APPLY = '-nosearch -noresampblur -cost normmi -interp spline'
+
+
+def setup_options(argv=None):
+    parser = argparse.ArgumentParser(description='Pre-DeepMedic processing as a parallel stage graph')
+    parser.add_argument("subjects", nargs='+', help="subject IDs")
+    parser.add_argument("--input_dir", default=INPUT_DIR, help="input nii directory (default: {})".format(INPUT_DIR))
+    parser.add_argument("--output_dir", default=OUTPUT_DIR,
+                        help="output nii directory (default: {})".format(OUTPUT_DIR))
+    parser.add_argument("--script_dir", default=SCRIPT_DIR, help="DeepFCD directory (default: {})".format(SCRIPT_DIR))
+    parser.add_argument("--map_dir", default=None,
+                        help="morphometric maps (default: <input_dir>/{})".format(MAP_SUBDIR))
+    parser.add_argument("--no_map", dest="map", action="store_false", default=True,
+                        help="do not process the morphometric maps")
+    parser.add_argument("--disc", action="store_true", default=False,
+                        help="process the discriminator maps (discriminator_output_test.py) as additional channel")
+    parser.add_argument("--cores", type=int, default=CORES,
+                        help="CPU budget shared by all running stages (default={})".format(CORES))
+    parser.add_argument("--samseg_threads", type=int, default=SAMSEG_THREADS,
+                        help="threads per samseg run (default={})".format(SAMSEG_THREADS))
+    parser.add_argument("--force", action="store_true", default=False,
+                        help="run all stages, even if their outputs are up to date")
+    parser.add_argument("--metrics_log", default=None,
+                        help="JSON lines resource log (default: <output_dir>/log/metrics.jsonl)")
+    parser.add_argument("--dry_run", action="store_true", default=False,
+                        help="only print the stages and whether they would run")
+    return parser.parse_args(argv)
+
+
+def setup_dirs(args):
+    dir_dict = dict()
+    dir_dict["REAL_T1"] = os.path.join(args.input_dir, 'T1')
+    dir_dict["REAL_FLAIR"] = os.path.join(args.input_dir, 'FLAIR')
+    dir_dict["MAP"] = args.map_dir or os.path.join(args.input_dir, MAP_SUBDIR)
+    dir_dict["ROI"] = os.path.join(args.input_dir, 'ROI')
+    dir_dict["GAN_INPUT_T1"] = os.path.join(args.output_dir, 'gan_input_T1')
+    dir_dict["GAN_TARGET_FLAIR"] = os.path.join(args.output_dir, 'gan_target_FLAIR')
+    dir_dict["SYNTH_FLAIR"] = os.path.join(args.output_dir, 'synth_FLAIR')
+    dir_dict["DIFF"] = os.path.join(args.output_dir, 'diff_real_FLAIR-synth_FLAIR')
+    dir_dict["DISC"] = os.path.join(args.output_dir, 'disc_map_FLAIR')
+    dir_dict["MATRICES"] = os.path.join(args.output_dir, 'matrices')
+    dir_dict["DEEPMEDIC_INPUT"] = os.path.join(args.output_dir, 'deepmedic_input')
+    dir_dict["TMP"] = os.path.join(args.output_dir, 'tmp')
+    dir_dict["LOG"] = os.path.join(args.output_dir, 'log')
+    return dir_dict
+
+
+def image_file(path):
+    """Existing file of an FSL image name (with or without extension), None if missing"""
+    if os.path.isfile(path):
+        return path
+    for ext in IMAGE_EXT:
+        if os.path.isfile(path + ext):
+            return path + ext
+    return None
+
+
+def image_key(path):
+    for ext in IMAGE_EXT:
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+def remove_stale(path, output_type):
+    """Removes images of an output name with an extension other than output_type's (FSL refuses ambiguous names)"""
+    if path.endswith(IMAGE_EXT):
+        return
+    for ext in IMAGE_EXT:
+        if ext != TYPE_EXT[output_type] and os.path.isfile(path + ext):
+            os.remove(path + ext)
+
+
+def first_match(pattern):
+    """Like the shell's '${DIR}/${sbj}_*' as flirt argument, keeps the pattern if nothing matches"""
+    files = sorted(glob.glob(pattern))
+    return files[0] if files else pattern
+
+
+def normalize(src, mask, dst, apply_mask=True, env=None, timer=()):
+    """Zero mean unit variance within mask (fslstats + fslmaths), returns the commands and their output"""
+    stats = ['fslstats', src, '-k', mask, '-m', '-s']
+    result = subprocess.run(stats, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError('{} failed:\n{}'.format(' '.join(stats), result.stdout))
+    mean, std = result.stdout.split()[:2]
+    cmd = ['fslmaths', src, '-sub', mean, '-div', std]
+    if apply_mask:
+        cmd += ['-mul', mask]
+    return [' '.join(stats), result.stdout] + run_cmd(cmd + [dst], env, timer)
+
+
+def run_cmd(cmd, env=None, timer=()):
+    """Runs a command, prefixed by the instrumentation wrapper 'timer' if given"""
+    if isinstance(cmd, str):
+        cmd = shlex.split(cmd)
+    result = subprocess.run(list(timer) + cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True, env=env)
+    log = [' '.join(shlex.quote(c) for c in cmd), result.stdout]
+    if result.returncode != 0:
+        raise RuntimeError('\n'.join(log + ['exit code {}'.format(result.returncode)]))
+    return log
+
+
+class Stage:
+    """One processing step of a subject
+
+    :param str sbj: subject ID
+    :param str name: stage name (unique per subject)
+    :param list inputs: images/files read by the stage
+    :param list outputs: images/files written by the stage (FSL image names without extension are fine)
+    :param list cmds: commands run in order, str or callable(env, timer) returning log lines
+    :param int threads: CPUs used by the stage
+    :param str output_type: FSLOUTPUTTYPE of the written images
+    """
+
+    def __init__(self, sbj, name, inputs, outputs, cmds, threads=1, output_type=TMP_TYPE):
+        self.sbj = sbj
+        self.name = name
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.cmds = cmds if isinstance(cmds, list) else [cmds]
+        self.threads = threads
+        self.output_type = output_type
+        self.deps = set()
+
+    @property
+    def label(self):
+        return '{}:{}'.format(self.sbj, self.name)
+
+    def up_to_date(self):
+        """All outputs exist and the oldest output is newer than the newest input"""
+        outputs = [image_file(f) for f in self.outputs]
+        if not outputs or None in outputs:
+            return False
+        inputs = [image_file(f) for f in self.inputs]
+        if None in inputs:
+            return False
+        newest_input = max(os.path.getmtime(f) for f in inputs) if inputs else 0
+        return min(os.path.getmtime(f) for f in outputs) >= newest_input
+
+    def run(self, metrics_log=None):
+        env = dict(os.environ, OMP_NUM_THREADS=str(self.threads), FSLOUTPUTTYPE=self.output_type)
+        for out in self.outputs:
+            remove_stale(out, self.output_type)
+        timer = []
+        if metrics_log:
+            timer = [sys.executable, INSTRUMENTATION, 'run', '--stage', self.name, '--subject', self.sbj,
+                     '--log', metrics_log, '--']
+        log = []
+        for cmd in self.cmds:
+            log += cmd(env, timer) if callable(cmd) else run_cmd(cmd, env, timer)
+        return log
+
+
+def subject_stages(sbj, dir_dict, args):
+    """Stage graph of preprocessing_for_deepmedic.sh for one subject"""
+    d = dir_dict
+    tmp = os.path.join(d["TMP"], sbj)
+    dm = os.path.join(d["DEEPMEDIC_INPUT"], sbj)
+    mat = os.path.join(d["MATRICES"], sbj)
+    t1, flair, mask = tmp + '_T1', tmp + '_FLAIR', dm + '_mask'
+    gan_mat = mat + '_gan_input_T1_2_T1.mat'
+    stages = []
+
+    def add(name, inputs, outputs, cmds, threads=1):
+        final = any(os.path.dirname(out) == d["DEEPMEDIC_INPUT"] for out in outputs)
+        stages.append(Stage(sbj, name, inputs, outputs, cmds, threads, FINAL_TYPE if final else TMP_TYPE))
+
+    def register_gan(name, src, out):
+        add(name, [src, t1, gan_mat], [out],
+            "flirt -in {} -ref {} -applyxfm -init {} {} -out {}".format(src, t1, gan_mat, FLIRT_APPLY, out))
+
+    def add_normalize(name, src, dst, apply_mask=True):
+        add(name, [src, mask], [dst], lambda env, timer: normalize(src, mask, dst, apply_mask, env, timer))
+
+    real_t1 = os.path.join(d["REAL_T1"], sbj + '_T1.nii.gz')
+    add('resample_T1', [real_t1], [t1],
+        "flirt -in {0} -ref {0} -applyisoxfm 0.8 {1} -out {2}".format(real_t1, FLIRT_APPLY, t1))
+
+    real_flair = os.path.join(d["REAL_FLAIR"], sbj + '_FLAIR.nii.gz')
+    flair_mat = mat + '_FLAIR_2_T1.mat'
+    add('register_FLAIR', [real_flair, t1], [flair_mat, flair],
+        "flirt -in {} -ref {} -omat {} -out {} -noresampblur -interp spline".format(real_flair, t1, flair_mat, flair))
+
+    roi = os.path.join(d["ROI"], sbj + '_roi')
+    add('register_roi', [roi, t1, flair_mat], [dm + '_roi'],
+        "flirt -in {} -ref {} -applyxfm -init {} -out {} -interp nearestneighbour".format(roi, t1, flair_mat,
+                                                                                          dm + '_roi'))
+
+    gan_input = first_match(os.path.join(d["GAN_INPUT_T1"], sbj + '_*'))
+    add('register_gan_input', [gan_input, t1], [gan_mat],
+        "flirt -in {} -ref {} -omat {} {}".format(gan_input, t1, gan_mat, FLIRT_APPLY))
+    register_gan('register_diff', first_match(os.path.join(d["DIFF"], sbj + '_*')), tmp + '_diff_reg')
+
+    # brain mask: bet/fast and samseg branch
+    add('bet', [t1], [tmp + '_bet_T1'], "bet {} {} -R".format(t1, tmp + '_bet_T1'))
+    add('fast', [tmp + '_bet_T1'], [tmp + '_seg_1', tmp + '_seg_2'],
+        "fast -g -o {} {}".format(tmp, tmp + '_bet_T1'))
+    add('gmwm', [tmp + '_seg_1', tmp + '_seg_2'], [tmp + '_gmwm_eroded'],
+        ["fslmaths {0}_seg_1 -add {0}_seg_2 {0}_gmwm".format(tmp),
+         "fslmaths {0}_gmwm -fillh {0}_gmwm_filled".format(tmp),
+         "fslmaths {0}_gmwm_filled -kernel sphere 1 -ero {0}_gmwm_eroded".format(tmp)])
+
+    seg = os.path.join(tmp, 'seg.mgz')
+    seg_reg = os.path.join(tmp, 'seg_reg.nii')
+    add('samseg', [t1, flair], [seg],
+        "samseg --t1w {0}{3} --flair {1}{3} --refmode t1w --o {2} --no-save-warp --threads {4} "
+        "--pallidum-separate".format(t1, flair, tmp, TYPE_EXT[TMP_TYPE], args.samseg_threads),
+        threads=args.samseg_threads)
+    add('label2vol', [seg, t1], [seg_reg],
+        "mri_label2vol --seg {} --temp {}{} --o {} --regheader {}".format(seg, t1, TYPE_EXT[TMP_TYPE], seg_reg, seg))
+    cortical = tmp + '_only_cortical_structures'
+    roi_cmds = ["fslmaths {} -mul 0 {}".format(seg_reg, cortical)]
+    for roi_label in ROIS:
+        roi_cmds += ["fslmaths {0} -thr {1} -uthr {1} -bin {2}_roi_tmp".format(seg_reg, roi_label, tmp),
+                     "fslmaths {0} -add {1}_roi_tmp {0}".format(cortical, tmp)]
+    add('cortical_structures', [seg_reg], [cortical], roi_cmds)
+
+    add('mask', [tmp + '_gmwm_eroded', cortical], [mask],
+        ["fslmaths {0}_gmwm_eroded -mul {1} {0}_gmwm_cortical".format(tmp, cortical),
+         "fslmaths {0}_gmwm_cortical -kernel sphere 1 -ero {0}_gmwm_cortical_ero".format(tmp),
+         "fslmaths {}_gmwm_cortical_ero -kernel sphere 1 -dilF {}".format(tmp, mask)])
+
+    # normalized DeepMedic channels
+    add_normalize('normalize_diff', tmp + '_diff_reg', dm + '_diff')
+    add_normalize('normalize_T1', t1, dm + '_T1', apply_mask=False)
+    add_normalize('normalize_FLAIR', flair, dm + '_FLAIR', apply_mask=False)
+
+    if args.disc:
+        register_gan('register_disc', first_match(os.path.join(d["DISC"], sbj + '_*')), tmp + '_disc')
+        add_normalize('normalize_disc', tmp + '_disc', dm + '_disc')
+
+    if args.map:
+        for name in MAPS:
+            src = os.path.join(d["MAP"], 'T1_{}_{}_z_score'.format(sbj, name))
+            geom = os.path.join(d["TMP"], 'T1_{}_{}_z_score'.format(sbj, name))
+            iso = geom + '_iso'
+            add('copy_' + name, [src, real_t1], [geom],
+                ["fslchfiletype {} {} {}".format(TMP_TYPE, src, geom), "fslcpgeom {} {}".format(real_t1, geom)])
+            add('resample_' + name, [geom], [iso],
+                "flirt -in {0} -ref {0} -applyisoxfm 0.8 {1} -out {2}".format(geom, FLIRT_APPLY, iso))
+            add_normalize('normalize_' + name, iso, dm + '_' + name)
+
+    # outlier weight map (Tukey biweight, see robust_weights.py)
+    weights = tmp + '_weights.nii'
+    real = first_match(os.path.join(d["GAN_TARGET_FLAIR"], sbj + '_*'))
+    synth = first_match(os.path.join(d["SYNTH_FLAIR"], sbj + '_*'))
+    add('weights', [real, synth], [weights],
+        "python3 {} --real_dir {} --synth_dir {} --out_dir {} {}".format(
+            os.path.join(args.script_dir, 'postprocessing', 'robust_weights.py'), d["GAN_TARGET_FLAIR"],
+            d["SYNTH_FLAIR"], d["TMP"], sbj))
+    register_gan('register_weights', weights, tmp + '_weights_reg')
+    add_normalize('normalize_weights', tmp + '_weights_reg', dm + '_weights')
+
+    # dependencies from matching inputs and outputs
+    producers = {image_key(out): stage for stage in stages for out in stage.outputs}
+    for stage in stages:
+        stage.deps = {producers[image_key(f)] for f in stage.inputs if image_key(f) in producers}
+    return stages
+
+
+class SubjectLog:
+    """Log file of one subject, blocks of concurrently running stages are written as a whole"""
+
+    def __init__(self, log_dir, sbj):
+        os.makedirs(os.path.join(log_dir, sbj), exist_ok=True)
+        self.filename = os.path.join(log_dir, sbj, 'fcd_gan.log')
+        self.lock = threading.Lock()
+        self.timings = []
+        with open(self.filename, 'w') as f:
+            f.write('Log file for FCD GAN Processing\n{}\nProcessing {}\n\n'.format(time.ctime(), sbj))
+
+    def write(self, lines):
+        with self.lock, open(self.filename, 'a') as f:
+            f.write('\n'.join(line.rstrip('\n') for line in lines if line) + '\n')
+
+    def stage(self, stage, status, seconds=0.0, lines=()):
+        self.timings.append((stage.name, status, seconds))
+        self.write(list(lines) + ['[stage] {}: {} ({:.1f} s)'.format(stage.name, status, seconds)])
+
+    def summary(self):
+        lines = ['', 'Stage timing:']
+        lines += ['  {:<24s} {:>8s} {:>9.1f} s'.format(name, status, seconds) for name, status, seconds in self.timings]
+        lines.append('  {:<24s} {:>8s} {:>9.1f} s'.format('total', '', sum(t[2] for t in self.timings)))
+        self.write(lines)
+
+
+def run_graph(stages, cores, logs, force=False, metrics_log=None):
+    """Runs the stages in dependency order, with at most 'cores' CPUs in use
+
+    Stages of a subject whose predecessor failed are not run. Returns the failed stages.
+    """
+    pending = list(stages)
+    done, failed, running = set(), set(), {}
+    used = 0
+
+    def execute(stage):
+        start = time.time()
+        return stage.run(metrics_log), time.time() - start
+
+    with ThreadPoolExecutor(max_workers=max(cores, 1)) as pool:
+        while pending or running:
+            blocked = [s for s in pending if s.deps & failed]
+            for stage in blocked:
+                pending.remove(stage)
+                failed.add(stage)
+                logs[stage.sbj].stage(stage, 'blocked')
+
+            ready = [s for s in pending if s.deps <= done]
+            # larger stages first, so they are not starved by a stream of small ones
+            for stage in sorted(ready, key=lambda s: -s.threads):
+                if not force and stage.up_to_date():
+                    pending.remove(stage)
+                    done.add(stage)
+                    logs[stage.sbj].stage(stage, 'skipped')
+                    continue
+                threads = min(stage.threads, cores)
+                if running and used + threads > cores:
+                    continue
+                pending.remove(stage)
+                running[pool.submit(execute, stage)] = stage
+                used += threads
+
+            if not running:
+                if pending and not ready:
+                    raise RuntimeError('Cyclic stage dependencies: ' + ', '.join(s.label for s in pending))
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                used -= min(stage.threads, cores)
+                try:
+                    lines, seconds = future.result()
+                except Exception as e:
+                    failed.add(stage)
+                    logs[stage.sbj].stage(stage, 'failed', lines=[str(e)])
+                    print('{} failed, see {}'.format(stage.label, logs[stage.sbj].filename))
+                else:
+                    done.add(stage)
+                    logs[stage.sbj].stage(stage, 'done', seconds, lines)
+    return failed
+
+
+def run(args):
+    """Runs the stage graph of args.subjects, returns the failed stages"""
+    dir_dict = setup_dirs(args)
+    os.environ.setdefault('FS_LICENSE', FS_LICENSE)
+    os.environ['FSLOUTPUTTYPE'] = TMP_TYPE
+    args.samseg_threads = max(1, min(args.samseg_threads, args.cores))
+
+    stages = []
+    for sbj in args.subjects:
+        stages += subject_stages(sbj, dir_dict, args)
+
+    if args.dry_run:
+        for stage in stages:
+            status = 'run' if args.force or not stage.up_to_date() else 'skip'
+            deps = ', '.join(sorted(dep.name for dep in stage.deps))
+            print('{:<6s} {:<36s} <- {}'.format(status, stage.label, deps))
+        return set()
+
+    for key in ("MATRICES", "TMP", "DEEPMEDIC_INPUT", "LOG"):
+        os.makedirs(dir_dict[key], exist_ok=True)
+    logs = {sbj: SubjectLog(dir_dict["LOG"], sbj) for sbj in args.subjects}
+    for sbj in args.subjects:
+        os.makedirs(os.path.join(dir_dict["TMP"], sbj), exist_ok=True)
+        print('Processing {}'.format(sbj))
+
+    metrics_log = args.metrics_log or os.path.join(dir_dict["LOG"], 'metrics.jsonl')
+    failed = run_graph(stages, args.cores, logs, args.force, metrics_log)
+    for log in logs.values():
+        log.summary()
+    return failed
+
+
+def main(argv=None):
+    args = setup_options(argv)
+    failed = run(args)
+    if failed:
+        print('{} of {} subjects failed'.format(len({s.sbj for s in failed}), len(args.subjects)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
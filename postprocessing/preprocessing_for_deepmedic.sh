@@ -1,21 +1,28 @@
 #!/bin/bash
 
-# Simple script for translating the input and output of the generator network to the native t1-space, intensity transformation (zero mean unit variance) and mask generation. Additionally to the difference image, we produce a outlier weight image using mri_robust_register (see ) Also registering MAP morphometric maps, if specified.
+# Simple script for translating the input and output of the generator network to the native t1-space, intensity transformation (zero mean unit variance) and mask generation. Additionally to the difference image, we produce a outlier weight image (Tukey biweight, as mri_robust_register --satit, see robust_weights.py) Also registering MAP morphometric maps, if specified.
+# See preprocessing_for_deepmedic.py for the same steps as a parallel stage graph, which skips up-to-date outputs.
 # WIP: Should be redone in nipype at some point. Also registration ultimately not necessary if generator trained in native space.
 # space in the first place.
 # Written by: Bastian David, M.Sc.
 
 # Do you want to use morphometric maps?
 MAP=true
+# Do you want to use the discriminator maps (discriminator_output_test.py) as additional channel?
+DISC=false
 
-# export FREESURFER License and FSLOUTPUTTYPE (set to nii.gz)
+# export FREESURFER License and FSLOUTPUTTYPE (uncompressed nii for the intermediates in tmp_dir, only the
+# DeepMedic inputs are compressed via $gz; the *.nii.gz of a subject left in tmp_dir by older runs are removed
+# before its first stage, FSL refuses ambiguous names)
 export FS_LICENSE=/output/postprocessing/.license
 export OMP_NUM_THREADS=1
-export FSLOUTPUTTYPE=NIFTI_GZ
+export FSLOUTPUTTYPE=NIFTI
+gz="env FSLOUTPUTTYPE=NIFTI_GZ"
 
 # base directories
 INPUT_DIR=/input/data/berlin/analyses/FCD/nii
 OUTPUT_DIR=/output/data/berlin/analyses/FCD/nii
+SCRIPT_DIR=/output
 
 # original input directories
 REAL_T1_DIR=${INPUT_DIR}/T1
@@ -28,6 +35,7 @@ GAN_INPUT_T1_DIR=${OUTPUT_DIR}/gan_input_T1
 GAN_TARGET_FLAIR_DIR=${OUTPUT_DIR}/gan_target_FLAIR
 SYNTH_FLAIR_DIR=${OUTPUT_DIR}/synth_FLAIR
 DIFF_DIR=${OUTPUT_DIR}/diff_real_FLAIR-synth_FLAIR
+DISC_DIR=${OUTPUT_DIR}/disc_map_FLAIR
 
 # post-processing of GAN results and MAP --> created in here
 MATRICES_DIR=${OUTPUT_DIR}/matrices
@@ -38,6 +46,11 @@ log_dir=${OUTPUT_DIR}/log
 # make directories
 mkdir -p $MATRICES_DIR $tmp_dir $DEEPMEDIC_INPUT $log_dir
 
+# record wall/CPU time, peak RSS and I/O of every command (see util/instrumentation.py), cohort report:
+# python3 ${SCRIPT_DIR}/util/instrumentation.py report ${log_dir}/metrics.jsonl
+export FCD_METRICS_LOG=${log_dir}/metrics.jsonl
+timecmd="python3 ${SCRIPT_DIR}/util/instrumentation.py run --"
+
 # define subjects (not necessary if using parallelized wrapper script)
 #SUBJECTS=$(ls ${T1_DIR}| cut -d'_' -f1)
 SUBJECTS=$1
@@ -72,6 +85,7 @@ for sbj in $SUBJECTS
 do
   # Set up log file
   LF=$log_dir/$sbj/fcd_gan.log
+  export FCD_SUBJECT=$sbj
   mkdir $log_dir/$sbj
   if [ $LF != /dev/null ] ; then  rm -f $LF ; fi
   echo "Log file for FCD GAN Processing" >> $LF
@@ -79,18 +93,21 @@ do
   echo "Processing $sbj" |& tee -a $LF
   echo "" |& tee -a $LF
 
+  # intermediates of older (NIFTI_GZ) runs, ${sbj}_T1.nii and ${sbj}_T1.nii.gz would be ambiguous for FSL
+  rm -f ${tmp_dir}/${sbj}_*.nii.gz ${tmp_dir}/T1_${sbj}_*.nii.gz
+
   cmd="flirt -in ${REAL_T1_DIR}/${sbj}_T1.nii.gz -ref ${REAL_T1_DIR}/${sbj}_T1.nii.gz -applyisoxfm 0.8 -nosearch -noresampblur -cost normmi -interp spline -out ${tmp_dir}/${sbj}_T1"
   RunIt "$cmd" $LF
 
   cmd="flirt -in ${REAL_FLAIR_DIR}/${sbj}_FLAIR.nii.gz -ref ${tmp_dir}/${sbj}_T1 -omat ${MATRICES_DIR}/${sbj}_FLAIR_2_T1.mat -out ${tmp_dir}/${sbj}_FLAIR -noresampblur -interp spline"
   RunIt "$cmd" $LF
-  cmd="flirt -in ${ROI_DIR}/${sbj}_roi -ref ${tmp_dir}/${sbj}_T1 -applyxfm -init ${MATRICES_DIR}/${sbj}_FLAIR_2_T1.mat -out ${DEEPMEDIC_INPUT}/${sbj}_roi -interp nearestneighbour"
+  cmd="$gz flirt -in ${ROI_DIR}/${sbj}_roi -ref ${tmp_dir}/${sbj}_T1 -applyxfm -init ${MATRICES_DIR}/${sbj}_FLAIR_2_T1.mat -out ${DEEPMEDIC_INPUT}/${sbj}_roi -interp nearestneighbour"
   RunIt "$cmd" $LF
 
   cmd="flirt -in ${GAN_INPUT_T1_DIR}/${sbj}_* -ref ${tmp_dir}/${sbj}_T1 -omat ${MATRICES_DIR}/${sbj}_gan_input_T1_2_T1.mat -nosearch -noresampblur -cost normmi -interp spline"
   RunIt "$cmd" $LF
 
-  cmd="flirt -in ${DIFF_DIR}/${sbj}_* -ref ${tmp_dir}/${sbj}_T1 -applyxfm -init ${MATRICES_DIR}/${sbj}_gan_input_T1_2_T1.mat -nosearch -noresampblur -cost normmi -interp spline -out ${DEEPMEDIC_INPUT}/${sbj}_diff"
+  cmd="$gz flirt -in ${DIFF_DIR}/${sbj}_* -ref ${tmp_dir}/${sbj}_T1 -applyxfm -init ${MATRICES_DIR}/${sbj}_gan_input_T1_2_T1.mat -nosearch -noresampblur -cost normmi -interp spline -out ${DEEPMEDIC_INPUT}/${sbj}_diff"
   RunIt "$cmd" $LF
 
   cmd="bet ${tmp_dir}/${sbj}_T1 ${tmp_dir}/${sbj}_bet_T1 -R"
@@ -107,9 +124,9 @@ do
   cmd="fslmaths ${tmp_dir}/${sbj}_gmwm -kernel sphere 1 -ero ${tmp_dir}/${sbj}_gmwm_eroded"
   RunIt "$cmd" $LF
 
-  cmd="samseg --t1w ${tmp_dir}/${sbj}_T1.nii.gz --flair ${tmp_dir}/${sbj}_FLAIR.nii.gz --refmode t1w --o ${tmp_dir}/${sbj} --no-save-warp --threads 1 --pallidum-separate"
+  cmd="samseg --t1w ${tmp_dir}/${sbj}_T1.nii --flair ${tmp_dir}/${sbj}_FLAIR.nii --refmode t1w --o ${tmp_dir}/${sbj} --no-save-warp --threads 1 --pallidum-separate"
   RunIt "$cmd" $LF
-  cmd="mri_label2vol --seg ${tmp_dir}/${sbj}/seg.mgz --temp ${tmp_dir}/${sbj}_T1.nii.gz --o ${tmp_dir}/${sbj}/seg_reg.nii --regheader ${tmp_dir}/${sbj}/seg.mgz"
+  cmd="mri_label2vol --seg ${tmp_dir}/${sbj}/seg.mgz --temp ${tmp_dir}/${sbj}_T1.nii --o ${tmp_dir}/${sbj}/seg_reg.nii --regheader ${tmp_dir}/${sbj}/seg.mgz"
   RunIt "$cmd" $LF
 
   cmd="fslmaths ${tmp_dir}/${sbj}/seg_reg.nii -mul 0 ${tmp_dir}/${sbj}_only_cortical_structures"
@@ -131,31 +148,44 @@ do
   cmd="fslmaths ${tmp_dir}/${sbj}_gmwm_eroded -kernel sphere 1 -ero ${tmp_dir}/${sbj}_gmwm_eroded_ero"
   RunIt "$cmd" $LF
 
-  cmd="fslmaths ${tmp_dir}/${sbj}_gmwm_eroded_ero -kernel sphere 1 -dilF ${DEEPMEDIC_INPUT}/${sbj}_mask"
+  cmd="$gz fslmaths ${tmp_dir}/${sbj}_gmwm_eroded_ero -kernel sphere 1 -dilF ${DEEPMEDIC_INPUT}/${sbj}_mask"
   RunIt "$cmd" $LF
   # intermediate cleaning
   #rm -rf ${tmp_dir}/${sbj}
 
   # normalizing difference
   read -r mean std <<< $(fslstats ${DEEPMEDIC_INPUT}/${sbj}_diff -k ${DEEPMEDIC_INPUT}/${sbj}_mask -m -s)
-  cmd="fslmaths ${DEEPMEDIC_INPUT}/${sbj}_diff -sub $mean -div $std -mul ${DEEPMEDIC_INPUT}/${sbj}_mask ${DEEPMEDIC_INPUT}/${sbj}_diff"
+  cmd="$gz fslmaths ${DEEPMEDIC_INPUT}/${sbj}_diff -sub $mean -div $std -mul ${DEEPMEDIC_INPUT}/${sbj}_mask ${DEEPMEDIC_INPUT}/${sbj}_diff"
   RunIt "$cmd" $LF
 
+  if $DISC
+  then
+
+    # registering and normalizing discriminator map (same transform as the diff image)
+    cmd="flirt -in ${DISC_DIR}/${sbj}_* -ref ${tmp_dir}/${sbj}_T1 -applyxfm -init ${MATRICES_DIR}/${sbj}_gan_input_T1_2_T1.mat -nosearch -noresampblur -cost normmi -interp spline -out ${tmp_dir}/${sbj}_disc"
+    RunIt "$cmd" $LF
+
+    read -r mean std <<< $(fslstats ${tmp_dir}/${sbj}_disc -k ${DEEPMEDIC_INPUT}/${sbj}_mask -m -s)
+    cmd="$gz fslmaths ${tmp_dir}/${sbj}_disc -sub $mean -div $std -mul ${DEEPMEDIC_INPUT}/${sbj}_mask ${DEEPMEDIC_INPUT}/${sbj}_disc"
+    RunIt "$cmd" $LF
+
+  fi
+
   # normalizing T1
   read -r mean std <<< $(fslstats ${tmp_dir}/${sbj}_T1 -k ${DEEPMEDIC_INPUT}/${sbj}_mask -m -s)
-  cmd="fslmaths ${tmp_dir}/${sbj}_T1 -sub $mean -div $std ${DEEPMEDIC_INPUT}/${sbj}_T1"
+  cmd="$gz fslmaths ${tmp_dir}/${sbj}_T1 -sub $mean -div $std ${DEEPMEDIC_INPUT}/${sbj}_T1"
   RunIt "$cmd" $LF
 
   # normalizing FLAIR
   read -r mean std <<< $(fslstats ${tmp_dir}/${sbj}_FLAIR -k ${DEEPMEDIC_INPUT}/${sbj}_mask -m -s)
-  cmd="fslmaths ${tmp_dir}/${sbj}_FLAIR -sub $mean -div $std ${DEEPMEDIC_INPUT}/${sbj}_FLAIR"
+  cmd="$gz fslmaths ${tmp_dir}/${sbj}_FLAIR -sub $mean -div $std ${DEEPMEDIC_INPUT}/${sbj}_FLAIR"
   RunIt "$cmd" $LF
   
   if $MAP
   then
 
     # normalizing junction map
-    cmd="imcp ${MAP_DIR}/T1_${sbj}_junction_z_score ${tmp_dir}/T1_${sbj}_junction_z_score"
+    cmd="fslchfiletype NIFTI ${MAP_DIR}/T1_${sbj}_junction_z_score ${tmp_dir}/T1_${sbj}_junction_z_score"
     RunIt "$cmd" $LF
 
     cmd="fslcpgeom ${REAL_T1_DIR}/${sbj}_T1 ${tmp_dir}/T1_${sbj}_junction_z_score"
@@ -165,11 +195,11 @@ do
     RunIt "$cmd" $LF
 
     read -r mean std <<< $(fslstats ${tmp_dir}/T1_${sbj}_junction_z_score -k ${DEEPMEDIC_INPUT}/${sbj}_mask -m -s)
-    cmd="fslmaths ${tmp_dir}/T1_${sbj}_junction_z_score -sub $mean -div $std -mul ${DEEPMEDIC_INPUT}/${sbj}_mask ${DEEPMEDIC_INPUT}/${sbj}_junction"
+    cmd="$gz fslmaths ${tmp_dir}/T1_${sbj}_junction_z_score -sub $mean -div $std -mul ${DEEPMEDIC_INPUT}/${sbj}_mask ${DEEPMEDIC_INPUT}/${sbj}_junction"
     RunIt "$cmd" $LF
 
     # normalizing extension map
-    cmd="imcp ${MAP_DIR}/T1_${sbj}_extension_z_score ${tmp_dir}/T1_${sbj}_extension_z_score"
+    cmd="fslchfiletype NIFTI ${MAP_DIR}/T1_${sbj}_extension_z_score ${tmp_dir}/T1_${sbj}_extension_z_score"
     RunIt "$cmd" $LF
     cmd="fslcpgeom ${REAL_T1_DIR}/${sbj}_T1 ${tmp_dir}/T1_${sbj}_extension_z_score"
     RunIt "$cmd" $LF
@@ -178,11 +208,11 @@ do
     RunIt "$cmd" $LF
 
     read -r mean std <<< $(fslstats ${tmp_dir}/T1_${sbj}_extension_z_score -k ${DEEPMEDIC_INPUT}/${sbj}_mask -m -s)
-    cmd="fslmaths ${tmp_dir}/T1_${sbj}_extension_z_score -sub $mean -div $std -mul ${DEEPMEDIC_INPUT}/${sbj}_mask ${DEEPMEDIC_INPUT}/${sbj}_extension"
+    cmd="$gz fslmaths ${tmp_dir}/T1_${sbj}_extension_z_score -sub $mean -div $std -mul ${DEEPMEDIC_INPUT}/${sbj}_mask ${DEEPMEDIC_INPUT}/${sbj}_extension"
     RunIt "$cmd" $LF
 
     # normalzing thickness map
-    cmd="imcp ${MAP_DIR}/T1_${sbj}_thickness_z_score ${tmp_dir}/T1_${sbj}_thickness_z_score"
+    cmd="fslchfiletype NIFTI ${MAP_DIR}/T1_${sbj}_thickness_z_score ${tmp_dir}/T1_${sbj}_thickness_z_score"
     RunIt "$cmd" $LF
     cmd="fslcpgeom ${REAL_T1_DIR}/${sbj}_T1 ${tmp_dir}/T1_${sbj}_thickness_z_score"
     RunIt "$cmd" $LF
@@ -191,18 +221,22 @@ do
     RunIt "$cmd" $LF
 
     read -r mean std <<< $(fslstats ${tmp_dir}/T1_${sbj}_thickness_z_score -k ${DEEPMEDIC_INPUT}/${sbj}_mask -m -s)
-    cmd="fslmaths ${tmp_dir}/T1_${sbj}_thickness_z_score -sub $mean -div $std -mul ${DEEPMEDIC_INPUT}/${sbj}_mask ${DEEPMEDIC_INPUT}/${sbj}_thickness"
+    cmd="$gz fslmaths ${tmp_dir}/T1_${sbj}_thickness_z_score -sub $mean -div $std -mul ${DEEPMEDIC_INPUT}/${sbj}_mask ${DEEPMEDIC_INPUT}/${sbj}_thickness"
     RunIt "$cmd" $LF
     
   fi
 
-  # creating weight map using mri_robust_register
-  cmd="mri_robust_register --mov ${GAN_TARGET_FLAIR_DIR}/${sbj}_* --dst ${SYNTH_FLAIR_DIR}/${sbj}_* --lta ${tmp_dir}/${sbj}.lta --weights ${tmp_dir}/${sbj}_weights.nii --satit"
-  RunIt "$cmd" $LF
+  # creating outlier weight map (replaces mri_robust_register --satit, images are in the same space)
+  # skipped if already computed for a batch of subjects by wrapper_preproc_deepmedic.sh
+  if [ ! -f ${tmp_dir}/${sbj}_weights.nii ]
+  then
+    cmd="python3 ${SCRIPT_DIR}/postprocessing/robust_weights.py --real_dir ${GAN_TARGET_FLAIR_DIR} --synth_dir ${SYNTH_FLAIR_DIR} --out_dir ${tmp_dir} ${sbj}"
+    RunIt "$cmd" $LF
+  fi
   cmd="flirt -in ${tmp_dir}/${sbj}_weights.nii -ref ${tmp_dir}/${sbj}_T1 -applyxfm -init ${MATRICES_DIR}/${sbj}_gan_input_T1_2_T1.mat -nosearch -noresampblur -cost normmi -interp spline -out ${tmp_dir}/${sbj}_weights_reg"
   RunIt "$cmd" $LF
   read -r mean std <<< $(fslstats ${tmp_dir}/${sbj}_weights_reg -k ${DEEPMEDIC_INPUT}/${sbj}_mask -m -s)
-  cmd="fslmaths ${tmp_dir}/${sbj}_weights_reg -sub $mean -div $std -mul ${DEEPMEDIC_INPUT}/${sbj}_mask ${DEEPMEDIC_INPUT}/${sbj}_weights"
+  cmd="$gz fslmaths ${tmp_dir}/${sbj}_weights_reg -sub $mean -div $std -mul ${DEEPMEDIC_INPUT}/${sbj}_mask ${DEEPMEDIC_INPUT}/${sbj}_weights"
   RunIt "$cmd" $LF
 
   # cleaning up temporary directory
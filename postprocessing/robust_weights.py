@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Outlier weight maps between real and synthetic images (Tukey biweight).
+
+Replaces 'mri_robust_register --satit --weights' in preprocessing_for_deepmedic.sh.
+GAN target and synthetic image are already in the same space, so no registration
+is estimated, only the robust weights of the residuals:
+
+    r = real - synth,  u = (r - median(r)) / (1.4826 * MAD(r))
+    w = (1 - (u/c)^2)^2 for |u| < c, else 0      (1 = inlier, 0 = outlier)
+
+Median and MAD are taken over the foreground (voxels nonzero in either image).
+As with --satit, the saturation c is chosen per subject so that a fraction of
+--wlimit foreground voxels gets a weight below 0.5 (closed form, since w < 0.5
+exactly where |u| > c * sqrt(1 - 1/sqrt(2))). Use --sat for a fixed saturation.
+
+All subjects of a call are processed one after another by the same process
+(wrapper_preproc_deepmedic.sh passes the whole cohort). The residuals are only
+computed for the foreground voxels, as one float32 array which is turned into
+the weights in place. The memory footprint is therefore bounded by one subject:
+the two input volumes and the float32 weight volume, plus about 8 bytes per
+foreground voxel (the array and the copy taken by the median/quantile).
+
+Example:
+    python3 robust_weights.py --real_dir nii/gan_target_FLAIR --synth_dir nii/synth_FLAIR \
+            --out_dir nii/tmp 101 102 103
+
+@author: bdavid
+"""
+
+import os
+import glob
+import argparse
+
+import numpy as np
+import nibabel as nib
+
+# -------- USER INPUT (defaults) ----------
+
+WLIMIT = 0.16
+
+#-------------------------------
+
+# |u|/c above which the Tukey weight drops below 0.5
+HALF_WEIGHT = np.sqrt(1 - 1 / np.sqrt(2))
+MAD_TO_SIGMA = 1.4826
+
+
+def robust_weights(real, synth, sat=None, wlimit=WLIMIT):
+    """Weight map of one subject's real and synthetic image
+
+    Only the foreground voxels are processed, in one float32 array that is transformed in
+    place (residual -> |u| -> (u/c)^2 -> weight), the background gets weight 0.
+
+    :param np.array real: real image
+    :param np.array synth: synthetic image, same shape as real
+    :param float sat: fixed saturation, if None it is estimated (satit)
+    :param float wlimit: fraction of foreground voxels with weight < 0.5 for satit
+    :return: weights (float32, shape of real) and saturation
+    """
+    foreground = real != 0
+    foreground |= synth != 0
+    w = real[foreground].astype(np.float32)
+    w -= synth[foreground]
+    if not w.size:
+        return np.zeros(real.shape, dtype=np.float32), sat or 1
+
+    w -= np.median(w)
+    np.abs(w, out=w)
+    sigma = MAD_TO_SIGMA * np.median(w)
+    w /= sigma if sigma > 0 else 1
+
+    if sat is None:
+        sat = np.quantile(w, 1 - wlimit) / HALF_WEIGHT
+        sat = sat if sat > 0 else 1
+
+    # Tukey biweight (1 - (u/c)^2)^2 for |u| < c, else 0
+    w /= sat
+    np.square(w, out=w)
+    outlier = w >= 1
+    np.subtract(1, w, out=w)
+    np.square(w, out=w)
+    w[outlier] = 0
+
+    weights = np.zeros(real.shape, dtype=np.float32)
+    weights[foreground] = w
+    return weights, sat
+
+
+def find_image(directory, sbj):
+    files = sorted(glob.glob(os.path.join(directory, sbj + '_*')))
+    if not files:
+        raise IOError('No image for subject {} in {}'.format(sbj, directory))
+    return files[0]
+
+
+def process_subject(sbj, real_dir, synth_dir, out_dir, sat=None, wlimit=WLIMIT):
+    synth_img = nib.load(find_image(synth_dir, sbj))
+    real = np.asanyarray(nib.load(find_image(real_dir, sbj)).dataobj)
+    weights, sat = robust_weights(real, np.asanyarray(synth_img.dataobj), sat, wlimit)
+
+    # weights are saved in the space of the synthetic image, like mri_robust_register's dst
+    header = synth_img.header.copy()
+    header.set_data_dtype(np.float32)
+    nib.Nifti1Image(weights, synth_img.affine, header=header).to_filename(os.path.join(out_dir, sbj + '_weights.nii'))
+    print('{}: saturation {:.3f}'.format(sbj, sat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tukey biweight outlier maps of real vs. synthetic images')
+    parser.add_argument("subjects", nargs='+', help="subject IDs")
+    parser.add_argument("--real_dir", required=True, help="directory of the real (GAN target) niftis")
+    parser.add_argument("--synth_dir", required=True, help="directory of the synthetic niftis")
+    parser.add_argument("--out_dir", required=True, help="output directory for <sbj>_weights.nii")
+    parser.add_argument("--sat", type=float, default=None,
+                        help="fixed saturation, e.g. 4.685 (default: estimated per subject as with --satit)")
+    parser.add_argument("--wlimit", type=float, default=WLIMIT,
+                        help="outlier fraction for the saturation estimate (default={})".format(WLIMIT))
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    for sbj in args.subjects:
+        process_subject(sbj, args.real_dir, args.synth_dir, args.out_dir, args.sat, args.wlimit)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,15 +20,19 @@ DIFF_DIR=${OUTPUT_DIR}/diff_real_FLAIR-synth_FLAIR
 # make directories
 mkdir -p $GAN_INPUT_T1_DIR $GAN_TARGET_FLAIR_DIR $SYNTH_FLAIR_DIR $DIFF_DIR
 
+# record wall/CPU time, peak RSS and I/O per step and subject (see util/instrumentation.py)
+export FCD_METRICS_LOG=${OUTPUT_DIR}/log/metrics.jsonl
+timecmd="python3 ${SCRIPT_DIR}/util/instrumentation.py run"
+
 # Run commands
 for sbj in $SUBJECTS; do
     echo "Processing $sbj"
     # 1. Padding
-    python3 $SCRIPT_DIR/preprocessing/create_mean_padding.py ${OUTPUT_DIR:0:-4}/png ${INPUT_DIR:0:-4}/png ${sbj}
+    $timecmd --stage padding --subject $sbj -- python3 $SCRIPT_DIR/preprocessing/create_mean_padding.py ${OUTPUT_DIR:0:-4}/png ${INPUT_DIR:0:-4}/png ${sbj}
     # 2. Create fake flairs (on GPU)
-    python3 $SCRIPT_DIR/postprocessing/create_synthetic_images-OLD_SKIMAGE.py --sid $sbj --nii --nii_p $OUTPUT_DIR \
+    $timecmd --stage gan --subject $sbj -- python3 $SCRIPT_DIR/postprocessing/create_synthetic_images-OLD_SKIMAGE.py all --sid $sbj --nii --nii_p $OUTPUT_DIR \
             --png_p ${OUTPUT_DIR:0:-4}/png --input ${INPUT_DIR:0:-4}/png
     # 3. Generate Difference image
-    python3 $SCRIPT_DIR/postprocessing/subtract_GAN_images.py -rd ${GAN_INPUT_T1_DIR} -fd ${SYNTH_FLAIR_DIR} -s $sbj -od ${DIFF_DIR}
+    $timecmd --stage subtract --subject $sbj -- python3 $SCRIPT_DIR/postprocessing/subtract_GAN_images.py -rd ${GAN_INPUT_T1_DIR} -fd ${SYNTH_FLAIR_DIR} -s $sbj -od ${DIFF_DIR}
 done
 
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script to export generator and discriminator as one fused SavedModel.
+
+The exported module has a single tf.function 'serve' with a fixed signature
+(input stack (B, H, W, C), real target (B, H, W, 1), both normalized to [-1, 1]),
+which returns synthetic image, raw difference image, PatchGAN logits and the
+logits upsampled to slice resolution from one graph execution. The middle input
+slice for the discriminator is selected inside the graph, so there is no extra
+eager call or Python-side slicing per batch.
+
+Usage:
+    python3 save_fused_model.py --gen ../models/T1_2_FLAIR_cor/generator \
+            --disc ../models/T1_2_FLAIR_cor/discriminator --out ../models/T1_2_FLAIR_cor/fused
+
+    fused = tf.saved_model.load('../models/T1_2_FLAIR_cor/fused')
+    out = fused.serve(inp, tar)  # dict with 'synth', 'diff', 'disc', 'disc_map'
+
+@author: bdavid
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+
+import tensorflow as tf
+
+# -------- USER INPUT (defaults) ----------
+
+GENERATOR = '../models/T1_2_FLAIR_cor/generator'
+DISCRIMINATOR = '../models/T1_2_FLAIR_cor/discriminator'
+OUTPATH = '../models/T1_2_FLAIR_cor/fused'
+IMG_WIDTH = 256
+IMG_HEIGHT = 256
+INPUT_CHANNELS = 7
+
+#-------------------------------
+
+
+class FusedGAN(tf.Module):
+    """Generator and discriminator behind one fixed-signature tf.function"""
+
+    def __init__(self, generator, discriminator, channels=INPUT_CHANNELS, height=IMG_HEIGHT,
+                 width=IMG_WIDTH, direction='real-fake'):
+        super(FusedGAN, self).__init__()
+        if direction not in ('real-fake', 'fake-real'):
+            raise ValueError("Unknown direction '{}'".format(direction))
+        self.generator = generator
+        self.discriminator = discriminator
+        self.channels = channels
+        self.height = height
+        self.width = width
+        self.direction = direction
+        self.serve = tf.function(self._serve, input_signature=[
+            tf.TensorSpec([None, height, width, channels], tf.float32, name='input_image'),
+            tf.TensorSpec([None, height, width, 1], tf.float32, name='target_image')])
+
+    def _serve(self, input_image, target_image):
+        mid = self.channels // 2
+        synth = self.generator(input_image, training=True)
+        disc = self.discriminator([input_image[..., mid:mid + 1], synth], training=True)
+        # clipped at zero like ImageChops.subtract, but before histogram matching
+        if self.direction == 'real-fake':
+            diff = tf.nn.relu(target_image - synth)
+        else:
+            diff = tf.nn.relu(synth - target_image)
+        disc_map = tf.image.resize(disc, [self.height, self.width], method=tf.image.ResizeMethod.BILINEAR)
+        return {'synth': synth, 'diff': diff, 'disc': disc, 'disc_map': disc_map}
+
+
+def export_fused(generator, discriminator, outpath, channels=INPUT_CHANNELS, height=IMG_HEIGHT,
+                 width=IMG_WIDTH, direction='real-fake'):
+    fused = FusedGAN(generator, discriminator, channels, height, width, direction)
+    tf.saved_model.save(fused, outpath, signatures={'serving_default': fused.serve})
+    return fused
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export generator + discriminator as one fused SavedModel')
+    parser.add_argument("--gen", default=GENERATOR, help="Generator model (default: {})".format(GENERATOR))
+    parser.add_argument("--disc", default=DISCRIMINATOR,
+                        help="Discriminator model (default: {})".format(DISCRIMINATOR))
+    parser.add_argument("--out", default=OUTPATH, help="Output directory (default: {})".format(OUTPATH))
+    parser.add_argument("--dir", dest="direction", default='real-fake', choices=['real-fake', 'fake-real'],
+                        help="Direction of the difference image (default: real-fake)")
+    parser.add_argument("--num_c", dest="channels", default=INPUT_CHANNELS, type=int,
+                        help="Number of input channels (default={})".format(INPUT_CHANNELS))
+    parser.add_argument("--img_w", dest="width", default=IMG_WIDTH, type=int)
+    parser.add_argument("--img_h", dest="height", default=IMG_HEIGHT, type=int)
+    args = parser.parse_args()
+
+    generator = tf.keras.models.load_model(args.gen)
+    discriminator = tf.keras.models.load_model(args.disc)
+    export_fused(generator, discriminator, args.out, args.channels, args.height, args.width, args.direction)
+    print('Saved fused model to {}'.format(args.out))
+
+
+if __name__ == "__main__":
+    main()
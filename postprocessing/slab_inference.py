@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Slab-wise inference for the multi-channel ("3d_multichannel") generators.
+
+The generators get INPUT_CHANNELS neighbouring slices as channels and predict
+the middle slice, i.e. every slice is part of INPUT_CHANNELS input stacks. The
+tf.data pipeline (stack_loader.py) reads and decodes each slice once per
+stack. Here the slices of a subject are decoded one at a time, in slice order,
+into a SliceRing, a ring buffer of uint8 slices which advances by one slice per
+push. A batch of stacks centered on consecutive slices is a single strided view
+of the ring (volume_ops.stack_view()), no stack is copied before the float
+conversion of the generator input.
+
+Each slice is written to the ring twice (at k and k + capacity), so that every
+run of up to capacity consecutive slices is contiguous and a view never has to
+wrap around. Neighbours outside of the volume are the mean paddings, as in
+volume_ops.slice_stacks() and stack_loader.stack_windows(). Every slice is the
+middle slice of exactly one stack, so the outputs of consecutive batches do not
+overlap and need no blending.
+
+Example:
+    for stacks in slab_batches((read_png(f) for f in files), first_pad, last_pad, 7, batch_size):
+        prediction = generator(volume_ops.to_generator_input(stacks), training=True)
+
+@author: bdavid
+"""
+
+import numpy as np
+
+from volume_ops import stack_view
+
+INPUT_CHANNELS = 7
+BATCH_SIZE = 1
+
+
+class SliceRing(object):
+    """Ring buffer of the last batch_size + channels - 1 slices of shape (H, W)"""
+
+    def __init__(self, shape, channels=INPUT_CHANNELS, batch_size=BATCH_SIZE, dtype=np.uint8):
+        self.channels = channels
+        self.capacity = batch_size + channels - 1
+        self.buffer = np.empty((2 * self.capacity,) + tuple(shape), dtype=dtype)
+        self.count = 0
+
+    def push(self, image):
+        pos = self.count % self.capacity
+        self.buffer[pos] = image
+        self.buffer[pos + self.capacity] = image
+        self.count += 1
+
+    def stacks(self, n):
+        """View (n, H, W, channels) of the n stacks ending with the last pushed slice"""
+        size = n + self.channels - 1
+        if n < 1 or size > min(self.count, self.capacity):
+            raise ValueError('{} stacks are not available in the ring'.format(n))
+        start = (self.count - size) % self.capacity
+        return stack_view(self.buffer[start:start + size], n, self.channels)
+
+
+def slab_batches(slices, first_pad, last_pad, channels=INPUT_CHANNELS, batch_size=BATCH_SIZE):
+    """uint8 input stacks (B, H, W, channels) centered on consecutive slices, in slice order
+
+    :param slices: iterable of uint8 slices (H, W) of one subject, e.g. lazily decoded PNGs, read once
+    :param first_pad: mean padding below the first slice
+    :param last_pad: mean padding above the last slice
+    The batches are views of the ring buffer, they are only valid until the next batch is requested.
+    """
+    half = channels // 2
+    ring = SliceRing(np.shape(first_pad), channels, batch_size, np.asarray(first_pad).dtype)
+    for _ in range(half):
+        ring.push(first_pad)
+
+    def tail():
+        for _ in range(half):
+            yield last_pad
+
+    pending = 0
+    for source in (slices, tail()):
+        for image in source:
+            ring.push(image)
+            if ring.count >= channels:
+                pending += 1
+                if pending == batch_size:
+                    yield ring.stacks(pending)
+                    pending = 0
+    if pending:
+        yield ring.stacks(pending)
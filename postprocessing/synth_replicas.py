@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Generator replicas for the CPU inference of create_synthetic_images.py.
+
+Instead of one process with tensorflow's default thread pools (or one thread,
+as OMP_NUM_THREADS=1 in the shell pipelines), several generator replicas run in
+parallel. Every replica is a process pinned to its own core set
+(os.sched_setaffinity), with as many intra-op threads as cores and one inter-op
+thread. The replicas take subjects from a shared queue until it is empty, i.e.
+a slow subject does not hold back a whole static shard. Core sets are cut along
+the NUMA nodes (/sys/devices/system/node/node*/cpulist), so that a replica does
+not span nodes unless there are fewer replicas than nodes.
+
+calibrate runs the generator on random stacks with every replica/thread split
+of the cores (replicas 1, 2, 4, ... up to one per core), all replicas of a split
+at the same time, and writes the splits with their slices/s to a JSON file.
+run takes the fastest split from this file (--calibration), unless --replicas
+is given.
+
+Options of create_synthetic_images.py (paths, --batch_size, --shard, --format,
+--config, ...) apply to run and calibrate as well.
+
+Example:
+    python3 synth_replicas.py calibrate --model ../models/T1_2_FLAIR_cor/generator --calibration calib.json
+    python3 synth_replicas.py run --stage all --calibration calib.json --png_p /data/png --nii_p /data/nii
+
+@author: bdavid
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import glob
+import json
+import time
+import queue
+import argparse
+import multiprocessing
+from tqdm import tqdm
+
+import create_synthetic_images as csi
+
+# -------- USER INPUT (defaults) ----------
+
+CALIBRATION = 'replica_calibration.json'
+STAGE = 'all'
+CALIBRATION_SLICES = 64 # slices per replica and split
+POLL = 5 # s between checks whether the replicas are still alive
+
+#-------------------------------
+
+NODE_DIR = '/sys/devices/system/node'
+
+
+def parse_cpulist(text):
+    """'0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]"""
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def numa_nodes(cpus):
+    """Available cpus grouped by NUMA node, one group if the topology is unknown"""
+    nodes = []
+    for cpulist in sorted(glob.glob(os.path.join(NODE_DIR, 'node[0-9]*', 'cpulist')),
+                          key=lambda f: int(os.path.basename(os.path.dirname(f))[4:])):
+        with open(cpulist) as f:
+            node = [cpu for cpu in parse_cpulist(f.read()) if cpu in cpus]
+        if node:
+            nodes.append(node)
+    covered = set(cpu for node in nodes for cpu in node)
+    rest = sorted(set(cpus) - covered)
+    if rest:
+        nodes.append(rest)
+    return nodes
+
+
+def split(items, n):
+    """n contiguous, nearly equal parts of items"""
+    size, extra = divmod(len(items), n)
+    parts, start = [], 0
+    for i in range(n):
+        end = start + size + (i < extra)
+        parts.append(items[start:end])
+        start = end
+    return parts
+
+
+def core_sets(replicas, cpus=None):
+    """Core sets of the replicas, cut along the NUMA nodes
+
+    With at least as many replicas as nodes, every node gets replicas in proportion to its
+    cores and every replica stays on one node; with fewer, neighbouring nodes are merged.
+    """
+    cpus = sorted(os.sched_getaffinity(0) if cpus is None else cpus)
+    if not 1 <= replicas <= len(cpus):
+        raise ValueError('{} replicas for {} cpus'.format(replicas, len(cpus)))
+    nodes = numa_nodes(cpus)
+    if replicas < len(nodes):
+        return [[cpu for node in group for cpu in node] for group in split(nodes, replicas)]
+    # one replica per node, every further one to the node with the most cores per replica
+    counts = [1] * len(nodes)
+    for _ in range(replicas - len(nodes)):
+        i = max((i for i in range(len(nodes)) if counts[i] < len(nodes[i])),
+                key=lambda i: len(nodes[i]) / float(counts[i]))
+        counts[i] += 1
+    return [part for node, count in zip(nodes, counts) for part in split(node, count)]
+
+
+def candidate_splits(n_cpus):
+    """(replicas, threads) with replicas 1, 2, 4, ... and one replica per core"""
+    replicas, splits = 1, []
+    while replicas < n_cpus:
+        splits.append((replicas, n_cpus // replicas))
+        replicas *= 2
+    splits.append((n_cpus, 1))
+    return splits
+
+
+def pin(cpus, threads):
+    """Pins the calling process and sets the thread pools, before tensorflow runs anything"""
+    os.sched_setaffinity(0, cpus)
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    csi.tf.config.threading.set_intra_op_parallelism_threads(threads)
+    csi.tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def process_subject(args, sbj, generator):
+    sub_args = argparse.Namespace(**vars(args))
+    sub_args.SUBJID, sub_args.SHARD = sbj, (0, 1)
+    dir_dict = csi.setup_dirs(sub_args)
+    # exactly this subject, SUBJID alone is a file name prefix
+    dir_dict["INFILES"] = sbj + '_*.png'
+    csi.run_synth(sub_args, dir_dict, generator)
+    if args.STAGE == 'all':
+        csi.run_postproc(sub_args, dir_dict)
+        csi.run_nifti(sub_args, dir_dict)
+    return len(glob.glob(dir_dict["INPUTPATH"] + dir_dict["INFILES"]))
+
+
+def _replica(index, cpus, args, tasks, results):
+    """Messages: ('start', index, sbj), ('done', index, sbj, slices, seconds, error), ('failed', index, error)"""
+    os.environ['TQDM_DISABLE'] = '1'
+    try:
+        pin(cpus, len(cpus))
+        generator = csi.tf.keras.models.load_model(args.MODEL)
+    except Exception as e:  # e.g. a bad --model, no subjects are taken
+        results.put(('failed', index, repr(e)))
+        return
+    while True:
+        sbj = tasks.get()
+        if sbj is None:
+            break
+        results.put(('start', index, sbj))
+        start = time.time()
+        try:
+            results.put(('done', index, sbj, process_subject(args, sbj, generator), time.time() - start, None))
+        except Exception as e:  # reported by the driver, the replica goes on with the next subject
+            results.put(('done', index, sbj, 0, time.time() - start, repr(e)))
+
+
+def _calibration_replica(cpus, args, n_slices, barrier, results):
+    try:
+        pin(cpus, len(cpus))
+        np, tf = csi.np, csi.tf
+        generator = tf.keras.models.load_model(args.MODEL)
+        stacks = np.random.RandomState(0).uniform(-1, 1, (args.BATCH_SIZE, args.IMG_HEIGHT, args.IMG_WIDTH,
+                                                          args.INPUT_CHANNELS)).astype(np.float32)
+        generator(stacks, training=True)  # tracing and allocation, not timed
+        barrier.wait()
+        start = time.time()
+        for _ in range(-(-n_slices // args.BATCH_SIZE)):
+            generator(stacks, training=True).numpy()
+        results.put((start, time.time(), -(-n_slices // args.BATCH_SIZE) * args.BATCH_SIZE, None))
+    except Exception as e:
+        # the other replicas of the split must not wait for this one at the barrier
+        barrier.abort()
+        results.put((None, None, 0, repr(e)))
+
+
+def dead_replicas(procs, known=()):
+    """Indices of replicas that exited, besides the known ones"""
+    return [i for i, proc in enumerate(procs) if proc.exitcode is not None and i not in known]
+
+
+def stop(procs):
+    for proc in procs:
+        proc.join(POLL)
+        if proc.is_alive():
+            proc.terminate()
+            proc.join()
+
+
+def collect_timings(procs, results):
+    """Timings of all calibration replicas, RuntimeError if one failed or died"""
+    timings = []
+    while len(timings) < len(procs):
+        try:
+            start, end, n_slices, error = results.get(timeout=POLL)
+        except queue.Empty:
+            # a replica might have been killed (e.g. OOM) before reporting
+            dead = [i for i in dead_replicas(procs) if procs[i].exitcode != 0]
+            if dead:
+                raise RuntimeError('replica {} died (exit code {})'.format(dead[0], procs[dead[0]].exitcode))
+            continue
+        if error:
+            raise RuntimeError(error)
+        timings.append((start, end, n_slices))
+    return timings
+
+
+def calibrate(args, cpus):
+    ctx = multiprocessing.get_context('spawn')
+    splits = []
+    for replicas, threads in candidate_splits(len(cpus)):
+        sets = [cores[:threads] for cores in core_sets(replicas, cpus)]
+        barrier, results = ctx.Barrier(replicas), ctx.Queue()
+        procs = [ctx.Process(target=_calibration_replica, args=(cores, args, args.SLICES, barrier, results))
+                 for cores in sets]
+        for proc in procs:
+            proc.start()
+        try:
+            timings = collect_timings(procs, results)
+        except RuntimeError as e:
+            barrier.abort()
+            stop(procs)
+            raise SystemExit('Calibration of {} replicas x {} threads failed: {}'.format(replicas, threads, e))
+        stop(procs)
+        seconds = max(end for _, end, _ in timings) - min(start for start, _, _ in timings)
+        slices = sum(n for _, _, n in timings)
+        splits.append({'replicas': replicas, 'threads': threads, 'slices_per_s': slices / seconds})
+        print('{:3d} replicas x {:3d} threads: {:8.1f} slices/s'.format(replicas, threads, slices / seconds))
+    best = max(splits, key=lambda s: s['slices_per_s'])
+    calibration = {'cpus': cpus, 'batch_size': args.BATCH_SIZE, 'model': args.MODEL,
+                   'best': best, 'splits': splits}
+    with open(args.CALIBRATION, 'w') as f:
+        json.dump(calibration, f, indent=2)
+    print('Best: {replicas} replicas x {threads} threads, written to {0}'.format(args.CALIBRATION, **best))
+
+
+def choose_split(args, cpus):
+    if args.REPLICAS:
+        return args.REPLICAS, args.THREADS or len(cpus) // args.REPLICAS
+    if os.path.exists(args.CALIBRATION):
+        with open(args.CALIBRATION) as f:
+            best = json.load(f)['best']
+        if best['replicas'] * best['threads'] <= len(cpus):
+            return best['replicas'], best['threads']
+        print('Calibration in {} is for more cpus, not used'.format(args.CALIBRATION))
+    # one replica per NUMA node
+    replicas = len(numa_nodes(cpus))
+    return replicas, len(cpus) // replicas
+
+
+def run(args, cpus):
+    dir_dict = csi.setup_dirs(args)
+    subjids = csi.shard_subjects(set(csi.subject_of(f) for f in glob.glob(dir_dict["INPUTPATH"] + dir_dict["INFILES"])),
+                                 args.SHARD)
+    if args.SUBJECTS:
+        subjids = [sbj for sbj in subjids if sbj in set(args.SUBJECTS)]
+    if not subjids:
+        print('No subjects in {}'.format(dir_dict["INPUTPATH"]))
+        return []
+    replicas, threads = choose_split(args, cpus)
+    replicas = min(replicas, len(subjids))
+    sets = [cores[:threads] for cores in core_sets(replicas, cpus)]
+    print('{} subjects on {} replicas: {}'.format(len(subjids), replicas,
+                                                 ', '.join('cpus ' + ','.join(map(str, c)) for c in sets)))
+
+    ctx = multiprocessing.get_context('spawn')
+    tasks, results = ctx.Queue(), ctx.Queue()
+    for sbj in subjids:
+        tasks.put(sbj)
+    for _ in sets:
+        tasks.put(None)
+    procs = [ctx.Process(target=_replica, args=(i, cores, args, tasks, results)) for i, cores in enumerate(sets)]
+    for proc in procs:
+        proc.start()
+
+    # subjects are failed if their replica reports an error or dies while processing them (e.g. OOM kill);
+    # if no replica is left, the subjects still queued are failed as well
+    start, n_slices = time.time(), 0
+    errors, current, dead = {}, {}, set()
+    progress = tqdm(total=len(subjids), desc='Subjects')
+    while len(errors) < len(subjids) and len(dead) < len(procs):
+        try:
+            message = results.get(timeout=POLL)
+        except queue.Empty:
+            for i in dead_replicas(procs, dead):
+                dead.add(i)
+                if i in current:
+                    sbj = current.pop(i)
+                    errors[sbj] = 'replica died (exit code {})'.format(procs[i].exitcode)
+                    print('Replica {}: subject {} failed: {}'.format(i, sbj, errors[sbj]))
+                    progress.update()
+            continue
+        kind, index = message[:2]
+        if kind == 'failed':
+            dead.add(index)
+            print('Replica {} failed: {}'.format(index, message[2]))
+        elif kind == 'start':
+            current[index] = message[2]
+        else:
+            sbj, slices, _, error = message[2:]
+            current.pop(index, None)
+            errors[sbj] = error
+            n_slices += slices
+            if error:
+                print('Replica {}: subject {} failed: {}'.format(index, sbj, error))
+            progress.update()
+    progress.close()
+    for sbj in subjids:
+        if sbj not in errors:
+            errors[sbj] = 'no replica left'
+            print('Subject {} failed: no replica left'.format(sbj))
+    stop(procs)
+    failed = [sbj for sbj in subjids if errors[sbj]]
+    seconds = time.time() - start
+    print('{} slices in {:.1f} s ({:.1f} slices/s), {} failed'.format(n_slices, seconds,
+                                                                       n_slices / max(seconds, 1e-9), len(failed)))
+    return failed
+
+
+def setup_options(argv=None):
+    common = csi.common_options()
+    common.add_argument("--cpus", dest="CPUS", default=None, type=str,
+                        help="cpu list to use, e.g. 0-31 (default: affinity of this process)")
+    common.add_argument("--calibration", dest="CALIBRATION", default=CALIBRATION, type=str,
+                        help="calibration file (default: {})".format(CALIBRATION))
+    parser = argparse.ArgumentParser(description='Generator replicas pinned to core sets')
+    subparsers = parser.add_subparsers(dest="COMMAND", metavar="COMMAND")
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser("run", parents=[common], help="process the subjects with generator replicas")
+    run_parser.add_argument("--stage", dest="STAGE", default=STAGE, choices=["synth", "all"],
+                            help="stages run per subject (default: {})".format(STAGE))
+    run_parser.add_argument("--replicas", dest="REPLICAS", default=0, type=int,
+                            help="number of replicas (default: from the calibration file, else one per NUMA node)")
+    run_parser.add_argument("--threads", dest="THREADS", default=0, type=int,
+                            help="threads per replica (default: cpus / replicas)")
+    run_parser.add_argument("--subjects", dest="SUBJECTS", default=None, nargs='+',
+                            help="only these subjects (default: all subjects of the shard)")
+
+    cal_parser = subparsers.add_parser("calibrate", parents=[common],
+                                       help="slices/s of the replica/thread splits, the best one is used by run")
+    cal_parser.add_argument("--slices", dest="SLICES", default=CALIBRATION_SLICES, type=int,
+                            help="slices per replica and split (default: {})".format(CALIBRATION_SLICES))
+
+    csi.apply_config(argv, [run_parser, cal_parser])
+    return csi.check_channels(parser.parse_args(argv))
+
+
+def main(argv=None):
+    args = setup_options(argv)
+    cpus = sorted(parse_cpulist(args.CPUS) if args.CPUS else os.sched_getaffinity(0))
+    if args.COMMAND == 'calibrate':
+        calibrate(args, cpus)
+    elif run(args, cpus):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
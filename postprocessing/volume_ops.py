@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-memory counterparts of the PNG based processing steps of the GAN pipeline.
+
+Slices are handled as uint8 arrays of shape (N, H, W), stacks as (N, H, W, C).
+Volumes are in the layout written by to_nifti() in create_synthetic_images.py
+(e.g. the gan_input_T1 / gan_target_FLAIR niftis), so that
+slices_to_volume(volume_to_slices(vol)) reproduces vol.
+
+@author: bdavid
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from lazy_import import lazy_import
+
+exposure = lazy_import('skimage.exposure')
+
+
+def slices_to_volume(slices):
+    """Same orientation as to_nifti(): PNG slices (N, H, W) to volume (W, N, H)"""
+    vol_array = np.asarray(slices).transpose(1, 2, 0)
+    return np.rot90(np.rot90(vol_array), axes=(2, 1))
+
+
+def volume_to_slices(volume):
+    """Inverse of slices_to_volume(), returns uint8 slices (N, H, W)
+
+    Volumes which are not uint8 yet are scaled to 0-255 with the volume maximum,
+    like nii_2_png.py does.
+    """
+    volume = np.asanyarray(volume)
+    vol_array = np.rot90(np.rot90(volume, axes=(1, 2)), k=-1)
+    slices = vol_array.transpose(2, 0, 1)
+    if slices.dtype != np.uint8:
+        cmax = float(slices.max())
+        scale = 255.0 / cmax if cmax > 0 else 1.0
+        slices = (np.clip(slices * scale, 0, 255) + 0.5).astype(np.uint8)
+    return np.ascontiguousarray(slices)
+
+
+def mean_paddings(slices, channels=7):
+    """First and last mean padding slice, as create_mean_padding.py"""
+    first = np.average(slices[:channels], axis=0).astype(np.uint8)
+    last = np.average(slices[-channels:], axis=0).astype(np.uint8)
+    return first, last
+
+
+def stack_view(slices, count, channels=7):
+    """Read-only view (count, H, W, channels) of the stacks of consecutive slices (count + channels - 1, H, W)
+
+    Stack i starts at slice i and its channel axis steps through the slices, no data is copied.
+    """
+    s_slice, s_row, s_col = slices.strides
+    return as_strided(slices, shape=(count, slices.shape[1], slices.shape[2], channels),
+                      strides=(s_slice, s_row, s_col, s_slice), writeable=False)
+
+
+def slice_stacks(slices, first_pad, last_pad, channels=7):
+    """Multi-channel input stacks (N, H, W, C) centered on every slice
+
+    Neighbours outside of the volume are replaced by the mean paddings, like
+    load() in the dataset pipelines. The stacks are a read-only view of the
+    padded slices (see stack_view()).
+    """
+    half = channels // 2
+    padded = np.concatenate([np.repeat(first_pad[np.newaxis], half, axis=0), slices,
+                             np.repeat(last_pad[np.newaxis], half, axis=0)], axis=0)
+    return stack_view(padded, len(slices), channels)
+
+
+def to_generator_input(stacks):
+    """uint8 stacks to generator input, same scaling as stack_loader.test_dataset()"""
+    # multiplication by 1/255 as tf.image.convert_image_dtype, a division differs in the last bit
+    return (stacks.astype(np.float32) * np.float32(1 / 255.)) / 127.5 - 1
+
+
+def scale_to_uint8(images):
+    """Per image min-max scaling to 0-255, as keras' save_img() does for the raw outputs"""
+    images = np.array(images, dtype=np.float32)
+    flat = images.reshape(len(images), -1)
+    flat -= flat.min(axis=1, keepdims=True)
+    img_max = flat.max(axis=1, keepdims=True)
+    flat /= np.where(img_max != 0, img_max, 1)
+    flat *= 255
+    return flat.reshape(images.shape).astype(np.uint8)
+
+
+def histo_matching(synth_slices, real_slices):
+    """Slice-wise histogram matching of synthetic to real slices"""
+    matched = np.empty(np.shape(synth_slices), dtype=np.uint8)
+    for i, (synth, real) in enumerate(zip(synth_slices, real_slices)):
+        matched[i] = np.uint8(exposure.match_histograms(synth, real))
+    return matched
+
+
+def subtract_slices(synth_slices, real_slices, direction='real-fake'):
+    """Clipped difference images, as PIL.ImageChops.subtract"""
+    real = real_slices.astype(np.int16)
+    synth = synth_slices.astype(np.int16)
+    if direction == 'real-fake':
+        diff = real - synth
+    elif direction == 'fake-real':
+        diff = synth - real
+    else:
+        raise ValueError("Unknown direction '{}'".format(direction))
+    return np.clip(diff, 0, 255).astype(np.uint8)
@@ -21,10 +21,31 @@ MATRICES_DIR=${OUTPUT_DIR}/matrices
 tmp_dir=${OUTPUT_DIR}/tmp
 
 
+# run the stage graph (preprocessing_for_deepmedic.py) instead of one shell script per subject
+STAGE_GRAPH=true
+
 # define subjects here
 SUBJECTS=$(ls ${REAL_T1_DIR}| cut -d'_' -f1)
 #SUBJECTS=3022
 
+# distribute GAN and preprocessing over workers in shards (cohort_runner.py), e.g. "local:16 node2:32";
+# empty: everything on this machine as below
+COHORT_WORKERS=""
+
+if [ -n "$COHORT_WORKERS" ]
+then
+  echo ""
+  echo "STARTING SHARDED COHORT PROCESSING ON: $COHORT_WORKERS"
+  echo ""
+  python3 ${SCRIPT_DIR}/postprocessing/cohort_runner.py run $(printf -- '--worker %s ' $COHORT_WORKERS) \
+          --input_dir ${INPUT_DIR} --output_dir ${OUTPUT_DIR} --script_dir ${SCRIPT_DIR} $SUBJECTS
+  status=$?
+  echo ""
+  echo "All done (manifest: ${OUTPUT_DIR}/log/cohort_manifest.tsv). Cleaning directory."
+  rm -rf ${tmp_dir} ${MATRICES_DIR}
+  exit $status
+fi
+
 # Run GAN (sequential)
 echo ""
 echo "STARTING GAN SYNTHETIC T2 GENERATION"
@@ -54,6 +75,15 @@ else
 fi
 
 
+# Outlier weight maps of real vs. synthetic FLAIR for all subjects (one process, one subject at a time)
+echo ""
+echo "CREATING OUTLIER WEIGHT MAPS"
+echo ""
+
+mkdir -p ${tmp_dir}
+python3 ${SCRIPT_DIR}/postprocessing/robust_weights.py --real_dir ${OUTPUT_DIR}/gan_target_FLAIR \
+        --synth_dir ${OUTPUT_DIR}/synth_FLAIR --out_dir ${tmp_dir} $SUBJECTS
+
 echo ""
 echo "STARTING PARALLEL PROCESSING"
 echo ""
@@ -61,7 +91,14 @@ echo "Processing list:"
 echo ""
 
 
-echo $SUBJECTS | xargs -n 1 -P $cores ${SCRIPT_DIR}/postprocessing/preprocessing_for_deepmedic.sh | grep "Processing"
+if $STAGE_GRAPH
+then
+  # independent stages of all subjects share the CPU budget, up-to-date stages are skipped
+  python3 ${SCRIPT_DIR}/postprocessing/preprocessing_for_deepmedic.py --input_dir ${INPUT_DIR} \
+          --output_dir ${OUTPUT_DIR} --script_dir ${SCRIPT_DIR} --cores $cores $SUBJECTS
+else
+  echo $SUBJECTS | xargs -n 1 -P $cores ${SCRIPT_DIR}/postprocessing/preprocessing_for_deepmedic.sh | grep "Processing"
+fi
 
 echo ""
 echo "All done. Cleaning directory."
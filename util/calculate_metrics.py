@@ -3,9 +3,18 @@ import numpy as np
 import nibabel as nib
 import os
 import glob
+import hashlib
 from subprocess import Popen, PIPE
 import shlex
 
+import instrumentation
+import cohort_metrics
+
+CLUSTER_THRESH = 0.9
+METRIC_COLUMNS = ["TP", "FP", "TN", "FN", "Orig_TP", "Orig_FP", "Clust_FP", "SizePred", "SizeGT",
+                  "TPR", "TNR", "PPV", "NPV", "FPR", "FNR", "FDR", "ACC"]
+CACHE_COLUMNS = ["Subject", "Network", "Fold", "Params", "Pred_file", "Pred_stat", "Pred_hash",
+                 "GT_file", "GT_stat", "GT_hash"] + METRIC_COLUMNS
 
 
 def call(command, **kwargs):
@@ -47,7 +56,11 @@ def fsl_cluster(finput, findex, thresh=0.9, fosize=None, fothresh=None, **kwargs
 
 
 def read_image(img):
-    data = nib.load(img)
+    """
+    Header, affine and data of an image; uncompressed (.nii) images are memory mapped read-only,
+    i.e. the data is paged in as accessed instead of being decompressed/copied as a whole
+    """
+    data = nib.load(img, mmap='r')
     return data.header, data.affine, np.asanyarray(data.dataobj)
 
 
@@ -74,14 +87,41 @@ def perf_measures(TP, TN, FP, FN):
     return [TPR, TNR, PPV, NPV, FPR,  FNR, FDR,  ACC]
 
 
+def bounding_box(*volumes):
+    """
+    Smallest box containing all nonzero voxels of the given (equally shaped) volumes
+    :return tuple: slices of the box, None if all volumes are empty
+    """
+    mask = volumes[0] != 0
+    for vol in volumes[1:]:
+        mask |= vol != 0
+    box = []
+    for ax in range(mask.ndim):
+        nonzero = np.flatnonzero(np.any(mask, axis=tuple(a for a in range(mask.ndim) if a != ax)))
+        if nonzero.size == 0:
+            return None
+        box.append(slice(nonzero[0], nonzero[-1] + 1))
+    return tuple(box)
+
+
 def get_true_positives(gt, pred):
     """
     Function to calculate number of true positives as indicated by overlap of
     x voxels
+    All comparisons are done within the bounding box of the nonzero voxels of gt and pred,
+    the background outside of it only adds to the true negatives (counted from the volume size)
     :param np.array gt: input ground truth
     :param np.array pred: predicted values
     :return dict x: dictionary with performance measures
     """
+    n_voxels = np.int64(gt.size)
+    box = bounding_box(gt, pred)
+    if box is None:
+        gt, pred = np.zeros(1, dtype=gt.dtype), np.zeros(1, dtype=pred.dtype)
+    else:
+        gt, pred = np.asarray(gt[box]), np.asarray(pred[box])
+    n_background = n_voxels - gt.size
+
     # Correction for FP belonging to same cluster --> if one of the voxels in it is TP, all
     # of them are counted as TP
     tp_bool = np.logical_and(pred > 0, gt == 1)
@@ -90,8 +130,9 @@ def get_true_positives(gt, pred):
     extra = np.sum(fp_bool)
     true_clust = np.unique(pred[tp_bool])
 
-    fp_bool[np.isin(pred, true_clust)] = False
-    tp_bool[np.isin(pred, true_clust)] = True
+    in_true_clust = np.isin(pred, true_clust)
+    fp_bool[in_true_clust] = False
+    tp_bool[in_true_clust] = True
 
     # True Positive (TP): we predict a label of 1 (positive), and the true label is 1.
     TP = np.sum(tp_bool)
@@ -100,7 +141,7 @@ def get_true_positives(gt, pred):
     FP = np.sum(fp_bool)
 
     # True Negative (TN): we predict a label of 0 (negative), and the true label is 0.
-    TN = np.sum(np.logical_and(pred == 0, gt == 0))
+    TN = np.sum(np.logical_and(pred == 0, gt == 0)) + n_background
 
     # False Negative (FN): we predict a label of 0 (negative), but the true label is 1.
     FN = np.sum(np.logical_and(pred == 0, gt == 1))
@@ -114,25 +155,119 @@ def get_true_positives(gt, pred):
     return list_m
 
 
-def write_to_file(metrics, subject, netw, ofile):
+def write_to_file(metrics, subject, netw, ofile, fold=None):
+    """Appends a row to the per-subject table, with fold as last column if given"""
+    if fold is not None:
+        metrics = list(metrics) + [fold]
     s = "{}\t{}" + "\t{}" * len(metrics) +"\n"
     with open(ofile, "a") as f:
         f.write(s.format(subject, netw, *metrics))
 
 
-def instantiate_csv(ofile):
-    val_header = "Subject\tNetwork\tTP\tFP\tTN\tFN\tOrig_TP\tOrig_FP\tClust_FP\tSizePred\tSizeGT\tTPR\tTNR\tPPV\tNPV\tFPR\tFNR\tFDR\tACC\n"
+def instantiate_csv(ofile, fold_column=False):
+    val_header = "Subject\tNetwork\t" + "\t".join(METRIC_COLUMNS + (["Fold"] if fold_column else [])) + "\n"
     with open(ofile, "w") as f:
         f.write(val_header)
 
 
-def get_population_stats(basedir, basedir2, gtdir, out, networks, pattern="*_ProbMapClass1.nii.gz"):
+def file_stat(path):
+    stat = os.stat(path)
+    return "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+
+
+class EvaluationCache:
+    """
+    Metric rows of earlier runs by subject, network and fold, tab separated and append only
+    (the last row of a subject/network/fold counts). A row is reused as long as the content
+    hashes of prediction and ground truth and the clustering parameters are unchanged; files
+    with unchanged size and mtime are not hashed again.
+    :param str filename: cache file, created if missing
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.rows = {}
+        self.hashes = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                header = f.readline().rstrip("\n").split("\t")
+                for line in f:
+                    row = dict(zip(header, line.rstrip("\n").split("\t")))
+                    if len(row) != len(header):
+                        continue  # incomplete last row of an interrupted run
+                    self.rows[(row["Subject"], row["Network"], row["Fold"])] = row
+                    for name in ("Pred", "GT"):
+                        self.hashes[row[name + "_file"]] = (row[name + "_stat"], row[name + "_hash"])
+        if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+            with open(filename, "w") as f:
+                f.write("\t".join(CACHE_COLUMNS) + "\n")
+
+    def file_hash(self, path):
+        """sha1 of the file content, from the cache if size and mtime did not change"""
+        stat = file_stat(path)
+        if path in self.hashes and self.hashes[path][0] == stat:
+            return self.hashes[path][1]
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        self.hashes[path] = (stat, digest.hexdigest())
+        return self.hashes[path][1]
+
+    def lookup(self, subject, netw, fold, params, pred_file, gt_file):
+        """Cached metrics (as written to the table) or None if prediction, ground truth or params changed"""
+        row = self.rows.get((subject, netw, fold))
+        if (row is None or row["Params"] != params or not os.path.exists(pred_file)
+                or row["Pred_hash"] != self.file_hash(pred_file)
+                or row["GT_hash"] != self.file_hash(gt_file)):
+            return None
+        return [row[column] for column in METRIC_COLUMNS]
+
+    def put(self, subject, netw, fold, params, pred_file, gt_file, metrics):
+        row = {"Subject": subject, "Network": netw, "Fold": fold, "Params": params}
+        for name, path in (("Pred", pred_file), ("GT", gt_file)):
+            row[name + "_file"] = path
+            row[name + "_hash"] = self.file_hash(path)
+            row[name + "_stat"] = self.hashes[path][0]
+        row.update(zip(METRIC_COLUMNS, (str(m) for m in metrics)))
+        self.rows[(subject, netw, fold)] = row
+        with open(self.filename, "a") as f:
+            f.write("\t".join(row[column] for column in CACHE_COLUMNS) + "\n")
+
+    def compact(self):
+        """Rewrites the cache with the current row of every subject/network/fold only"""
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("\t".join(CACHE_COLUMNS) + "\n")
+            for row in self.rows.values():
+                f.write("\t".join(row[column] for column in CACHE_COLUMNS) + "\n")
+        os.replace(tmp, self.filename)
+
+
+def get_population_stats(basedir, basedir2, gtdir, out, networks, pattern="*_ProbMapClass1.nii.gz",
+                         n_boot=cohort_metrics.N_BOOT, thresh=CLUSTER_THRESH, cache=True, fold_column=False):
+    """
+    Writes the per-subject metrics to out and, after every fold, the cohort summary
+    (sensitivity, FP clusters per subject, Youden index with bootstrap CIs over the
+    folds processed so far) to <out>_summary.tsv
+    With cache, the metric rows are kept in <out>_cache.tsv and only subjects whose prediction
+    map, ground truth or clustering threshold changed are clustered and scored again; the
+    table and the summary are rebuilt from cached and new rows.
+    The table keeps its layout (Subject, Network, metrics), with fold_column the fold of every
+    row is appended as last column, e.g. for cohort_metrics.py --follow with per-fold results.
+    """
     split_l = len(basedir.split("2ch")[0])
     split_l2 = len(basedir2.split("2ch")[0])
-    instantiate_csv(out)
+    instantiate_csv(out, fold_column)
+    aggregator = cohort_metrics.CohortAggregator(n_boot=n_boot)
+    summary_file = os.path.splitext(out)[0] + "_summary.tsv"
+    evaluation_cache = EvaluationCache(os.path.splitext(out)[0] + "_cache.tsv") if cache else None
+    params = "thresh={}".format(thresh)
+    n_cached = n_scored = 0
 
     # get all subjects in base and instantiate csv-file
     for folds in ["-fold_0", "-fold_1", "-fold_2", "-fold_3"]:
+        fold = folds.lstrip("-")
         subjects = glob.glob(os.path.join(basedir + folds, "predictions", pattern))
         print(os.path.join(basedir + folds, "predictions", pattern))
 
@@ -140,24 +275,51 @@ def get_population_stats(basedir, basedir2, gtdir, out, networks, pattern="*_Pro
 
         for sbj in subjects:
             sid = sbj.split("/")[-1].split("_")[0]
-            # Load gt images
-            try:
-                gt_h, gt_a, gt_d = read_image(os.path.join(gtdir, sid + "_roi.nii.gz"))
-                print("Processing subject {}".format(sid))
-            except FileNotFoundError:
+            gt_file = os.path.join(gtdir, sid + "_roi.nii.gz")
+            if not os.path.exists(gt_file):
                 print("Missing ROI ground truth for Subject {}. Continue with rest".format(sid))
                 continue
+            gt_d = None
 
             for nets in networks:
-                # create fsl-cluster map:
-                clust = os.path.join(basedir2[:split_l2] + nets + basedir2[split_l2 + len(nets):], sid + "cluster.nii.gz")
                 inputf = os.path.join(basedir[:split_l] + nets + basedir[split_l + len(nets):] + folds, "predictions", sid + "_ProbMapClass1.nii.gz")
-                fsl_cluster(inputf, clust)
-                p_h, p_a, p_d = read_image(clust)
-
-                # Get metrics for subject and save to file
-                m_list = get_true_positives(gt_d, p_d)
-                write_to_file(m_list, sid, nets, out)
+                m_list = None
+                if evaluation_cache is not None:
+                    m_list = evaluation_cache.lookup(sid, nets, fold, params, inputf, gt_file)
+                if m_list is None:
+                    # Load gt image once per subject, only if a network has to be scored
+                    if gt_d is None:
+                        with instrumentation.stage('read_gt', subject=sid):
+                            gt_h, gt_a, gt_d = read_image(gt_file)
+                        print("Processing subject {}".format(sid))
+                    # create fsl-cluster map (intermediate, uncompressed to be memory mapped):
+                    clust = os.path.join(basedir2[:split_l2] + nets + basedir2[split_l2 + len(nets):], sid + "cluster.nii")
+                    with instrumentation.stage('fsl_cluster', subject=sid, network=nets):
+                        code = fsl_cluster(inputf, clust, thresh=thresh, env=dict(os.environ, FSLOUTPUTTYPE="NIFTI"))
+                    with instrumentation.stage('read_cluster', subject=sid, network=nets):
+                        p_h, p_a, p_d = read_image(clust)
+                    with instrumentation.stage('metrics', subject=sid, network=nets):
+                        m_list = get_true_positives(gt_d, p_d)
+                    # a failed cluster run might have left an old cluster map behind, not cached
+                    if evaluation_cache is not None and code == 0:
+                        evaluation_cache.put(sid, nets, fold, params, inputf, gt_file, m_list)
+                    n_scored += 1
+                else:
+                    n_cached += 1
+
+                # save to file
+                write_to_file(m_list, sid, nets, out, fold if fold_column else None)
+                # Orig_TP, Clust_FP, SizeGT
+                aggregator.add(sid, nets, fold, m_list[4], m_list[6], m_list[8])
+
+        # interim cohort results, available before the remaining folds are processed
+        summary = aggregator.summary()
+        cohort_metrics.print_summary(summary, aggregator.ci)
+        cohort_metrics.write_summary(summary, summary_file)
+
+    if evaluation_cache is not None:
+        evaluation_cache.compact()
+    print("{} subject rows scored, {} taken from the cache".format(n_scored, n_cached))
 
 
 if __name__ == "__main__":
@@ -196,7 +358,7 @@ if __name__ == "__main__":
 
 # 1. List of "found" clusters (1 voxel overlap)
 # 2. List of "other" clusters (False Positives)
-# 3. Calculate Sensitivity and Specificity (a. over all subjects, b. per subject)
+# 3. Calculate Sensitivity and Specificity (a. over all subjects, b. per subject) --> cohort_metrics.py
 # 4. NEW: Calculate area overlap between a. found cluster and FCD, b. other cluster and FCD
-# 5. NEW: Youden Index (balance between Sensitivity and Specificity)
+# 5. NEW: Youden Index (balance between Sensitivity and Specificity) --> cohort_metrics.py
 # 6. Plotting functions
\ No newline at end of file
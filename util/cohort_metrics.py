@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cohort level detection metrics with bootstrap confidence intervals.
+
+Consumes the per-subject rows of calculate_metrics.py (one row per subject,
+network and fold) as they are written and keeps running totals per network and
+fold (tables read from file have a Fold column only if calculate_metrics.py
+wrote them with fold_column, otherwise their rows count as one fold). At any time, summary() gives for every network (pooled over all folds,
+Fold 'all') and every single fold:
+
+    Sensitivity     lesional subjects with >= 1 voxel overlap of a predicted cluster
+    FP_per_subject  false positive clusters per subject
+    Specificity     subjects without false positive clusters (healthy controls
+                    only, i.e. SizeGT == 0, if there are any in the table)
+    Youden          Sensitivity + Specificity - 1
+
+with percentile bootstrap confidence intervals. The resampling is vectorized:
+all bootstrap samples of a group are drawn as one (n_boot, n_subjects) index
+matrix and evaluated with array reductions (in chunks of bounded memory).
+
+Usage:
+    # summary of a finished or still growing table
+    python3 cohort_metrics.py /output/.../metric/bonn_FCD_crossVal_test.csv --n_boot 10000
+
+    # follow the table while calculate_metrics.py is running, print on every update
+    python3 cohort_metrics.py /output/.../metric/bonn_FCD_crossVal_test.csv --follow --out summary.tsv
+
+@author: bdavid
+"""
+
+import os
+import sys
+import time
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+# -------- USER INPUT (defaults) ----------
+
+N_BOOT = 10000
+CI = 95
+SEED = 42
+INTERVAL = 30  # s between polls with --follow
+
+#-------------------------------
+
+ALL_FOLDS = 'all'
+# max. no. of index entries per bootstrap chunk (int64, i.e. 8 bytes each)
+CHUNK_ENTRIES = 2 ** 24
+
+SUMMARY_COLUMNS = ['Network', 'Fold', 'N', 'Lesional', 'Controls', 'Detected',
+                   'Sensitivity', 'Sensitivity_lo', 'Sensitivity_hi',
+                   'FP_per_subject', 'FP_per_subject_lo', 'FP_per_subject_hi',
+                   'Specificity', 'Specificity_lo', 'Specificity_hi',
+                   'Youden', 'Youden_lo', 'Youden_hi']
+
+
+class Group:
+    """Running totals and per-subject values of one network/fold"""
+
+    def __init__(self):
+        self.subjects = []
+        self.lesional = []
+        self.detected = []
+        self.fp_clusters = []
+
+    def add(self, subject, lesional, detected, fp_clusters):
+        self.subjects.append(subject)
+        self.lesional.append(lesional)
+        self.detected.append(detected)
+        self.fp_clusters.append(fp_clusters)
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def arrays(self):
+        return (np.array(self.lesional, dtype=bool), np.array(self.detected, dtype=bool),
+                np.array(self.fp_clusters, dtype=np.float64))
+
+
+def cohort_stats(lesional, detected, fp_clusters):
+    """Cohort metrics of one or many (bootstrap) samples, arrays of shape (..., n_subjects)
+
+    :return: sensitivity, FP clusters per subject, specificity, Youden index (shape (...))
+    """
+    controls = ~lesional
+    n_lesional = lesional.sum(axis=-1)
+    n_controls = controls.sum(axis=-1)
+    no_fp = fp_clusters == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sensitivity = (detected & lesional).sum(axis=-1) / n_lesional
+        fp_per_subject = fp_clusters.mean(axis=-1)
+        specificity = np.where(n_controls > 0, (no_fp & controls).sum(axis=-1) / n_controls, no_fp.mean(axis=-1))
+    return sensitivity, fp_per_subject, specificity, sensitivity + specificity - 1
+
+
+def bootstrap(lesional, detected, fp_clusters, n_boot=N_BOOT, ci=CI, seed=SEED, use_controls=None):
+    """Percentile bootstrap CIs of cohort_stats(), resampling subjects with replacement
+
+    If the full sample contains controls, specificity is always computed on the
+    controls within each resample (NaN if a resample contains none), i.e. the
+    definition does not switch between resamples.
+    """
+    n = len(lesional)
+    rng = np.random.RandomState(seed)
+    if use_controls is None:
+        use_controls = bool((~lesional).any())
+    chunk = max(1, CHUNK_ENTRIES // max(n, 1))
+    stats = []
+    for start in range(0, n_boot, chunk):
+        idx = rng.randint(0, n, size=(min(chunk, n_boot - start), n))
+        sens, fp, spec, youden = cohort_stats(lesional[idx], detected[idx], fp_clusters[idx])
+        if use_controls:
+            controls = (~lesional[idx]).sum(axis=-1)
+            spec = np.where(controls > 0, spec, np.nan)
+            youden = sens + spec - 1
+        stats.append(np.stack([sens, fp, spec, youden]))
+    stats = np.concatenate(stats, axis=1)
+    alpha = (100 - ci) / 2.
+    with np.errstate(invalid='ignore'):
+        return np.nanpercentile(stats, [alpha, 100 - alpha], axis=1).T
+
+
+class CohortAggregator:
+    """Per-subject rows in, running cohort metrics per network and fold out"""
+
+    def __init__(self, n_boot=N_BOOT, ci=CI, seed=SEED):
+        self.n_boot = n_boot
+        self.ci = ci
+        self.seed = seed
+        self.groups = OrderedDict()
+
+    def add(self, subject, network, fold, orig_tp, clust_fp, size_gt):
+        """Adds one subject result (columns Orig_TP, Clust_FP, SizeGT of calculate_metrics.py)"""
+        lesional = float(size_gt) > 0
+        detected = float(orig_tp) > 0
+        for key in ((network, str(fold)), (network, ALL_FOLDS)):
+            self.groups.setdefault(key, Group()).add(subject, lesional, detected, float(clust_fp))
+
+    def add_row(self, row):
+        """Adds a row (dict) of the per-subject table, tables without Fold column count as one fold"""
+        self.add(row['Subject'], row['Network'], row.get('Fold', ALL_FOLDS), row['Orig_TP'], row['Clust_FP'],
+                 row['SizeGT'])
+
+    def summary(self, bootstrap_ci=True):
+        rows = []
+        for (network, fold), group in self.groups.items():
+            lesional, detected, fp_clusters = group.arrays()
+            point = cohort_stats(lesional, detected, fp_clusters)
+            if bootstrap_ci and len(group) > 1:
+                ci = bootstrap(lesional, detected, fp_clusters, self.n_boot, self.ci, self.seed)
+            else:
+                ci = np.full((4, 2), np.nan)
+            row = OrderedDict([('Network', network), ('Fold', fold), ('N', len(group)),
+                               ('Lesional', int(lesional.sum())), ('Controls', int((~lesional).sum())),
+                               ('Detected', int((detected & lesional).sum()))])
+            for name, value, (lo, hi) in zip(['Sensitivity', 'FP_per_subject', 'Specificity', 'Youden'], point, ci):
+                row[name], row[name + '_lo'], row[name + '_hi'] = float(value), float(lo), float(hi)
+            rows.append(row)
+        # pooled result first, then the single folds
+        return sorted(rows, key=lambda r: (r['Network'], r['Fold'] != ALL_FOLDS, r['Fold']))
+
+
+class TableReader:
+    """Reads the rows appended to a tab separated table since the last call"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self.header = None
+        self.pending = ''
+
+    def read_new(self):
+        if not os.path.exists(self.filename):
+            return []
+        if os.path.getsize(self.filename) < self.offset:
+            # table was re-instantiated
+            self.offset, self.header, self.pending = 0, None, ''
+        with open(self.filename) as f:
+            f.seek(self.offset)
+            data = self.pending + f.read()
+            self.offset = f.tell()
+        lines = data.split('\n')
+        # last line might still be written
+        self.pending = lines.pop()
+        rows = []
+        for line in lines:
+            if not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if self.header is None:
+                self.header = fields
+                continue
+            rows.append(dict(zip(self.header, fields)))
+        return rows
+
+
+def format_summary(rows):
+    lines = ['\t'.join(SUMMARY_COLUMNS)]
+    for row in rows:
+        lines.append('\t'.join('{:.4f}'.format(row[c]) if isinstance(row[c], float) else str(row[c])
+                               for c in SUMMARY_COLUMNS))
+    return '\n'.join(lines) + '\n'
+
+
+def print_summary(rows, ci=CI):
+    print('{:<8s}{:>6s}{:>5s}{:>5s}  {:<24s}{:<24s}{:<24s}{:<24s}'.format(
+        'Network', 'Fold', 'N', 'Les', 'Sensitivity', 'FP clusters/subject', 'Specificity', 'Youden'))
+    for row in rows:
+        cells = ['{:.3f} [{:.3f}, {:.3f}]'.format(row[n], row[n + '_lo'], row[n + '_hi'])
+                 for n in ('Sensitivity', 'FP_per_subject', 'Specificity', 'Youden')]
+        print('{:<8s}{:>6s}{:>5d}{:>5d}  {:<24s}{:<24s}{:<24s}{:<24s}'.format(
+            row['Network'], row['Fold'], row['N'], row['Lesional'], *cells))
+    print('({}% bootstrap confidence intervals)'.format(ci))
+
+
+def write_summary(rows, outfile):
+    tmp = outfile + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(format_summary(rows))
+    os.replace(tmp, outfile)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cohort detection metrics with bootstrap CIs')
+    parser.add_argument("table", help="per-subject table of calculate_metrics.py")
+    parser.add_argument("--n_boot", type=int, default=N_BOOT, help="bootstrap resamples (default={})".format(N_BOOT))
+    parser.add_argument("--ci", type=float, default=CI, help="confidence level in %% (default={})".format(CI))
+    parser.add_argument("--seed", type=int, default=SEED, help="bootstrap seed (default={})".format(SEED))
+    parser.add_argument("--out", default=None, help="write the summary table (tab separated) to this file")
+    parser.add_argument("--follow", action="store_true",
+                        help="keep reading rows appended to the table, update the summary on every change")
+    parser.add_argument("--interval", type=float, default=INTERVAL,
+                        help="seconds between polls with --follow (default={})".format(INTERVAL))
+    args = parser.parse_args()
+
+    aggregator = CohortAggregator(args.n_boot, args.ci, args.seed)
+    reader = TableReader(args.table)
+    try:
+        while True:
+            rows = reader.read_new()
+            for row in rows:
+                aggregator.add_row(row)
+            if rows or not args.follow:
+                summary = aggregator.summary()
+                print_summary(summary, args.ci)
+                if args.out:
+                    write_summary(summary, args.out)
+            if not args.follow:
+                break
+            sys.stdout.flush()
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
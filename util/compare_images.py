@@ -1,19 +1,19 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
 Created on Mon Dec 17 15:32:39 2018
 
+Compares a single pair of PNG slices, see evaluate_synthesis.py for whole volumes
+and test sets.
+
 @author: bdavid
 """
 
 import sys
 
-from scipy.misc import imread
-from numpy.linalg import norm
-from scipy import sum, average
 from PIL import Image
 import numpy as np
-from skimage.measure import compare_ssim as ssim
+from skimage.metrics import structural_similarity as ssim
 
 
 def main():
@@ -34,14 +34,14 @@ def compare_images(img1, img2):
     # normalize to compensate for exposure difference
     #img1 = normalize(img1)
     #img2 = normalize(img2)
-    # calculate the difference and its norms
-    diff = img1 - img2  # elementwise for scipy arrays
-    l1_norm = sum(abs(diff))  # Manhattan norm
-    l2_norm = sum(diff**2)/np.size(img1)
-    structural_sim = ssim(img1, img2)
+    # calculate the difference and its norms (signed, uint8 differences would wrap around)
+    diff = img1.astype(np.float64) - img2.astype(np.float64)
+    l1_norm = np.sum(np.abs(diff))  # Manhattan norm
+    l2_norm = np.sum(diff**2)/np.size(img1)
+    structural_sim = ssim(img1, img2, data_range=255)
     
     return (l1_norm, l2_norm, structural_sim)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
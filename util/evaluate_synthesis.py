@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Similarity of synthetic and real volumes for whole test sets (e.g. to pick a
+generator checkpoint).
+
+For every subject with a volume in --real_dir and --synth_dir (<sbj>_*.nii[.gz],
+e.g. gan_target_FLAIR and synth_FLAIR), L1, MSE, PSNR and SSIM are computed
+within the brain mask, per slice and per subject. Volumes are compared as the
+8 bit slices the GAN works on (volume_ops.volume_to_slices, data range 255).
+The mask is read from --mask_dir (<sbj>_*, same grid as the real volume) or, if
+not given, taken as the nonzero voxels of the real volume.
+
+All slices of a subject are evaluated at once: SSIM uses Gaussian weighted local
+statistics (sigma 1.5, 11x11 window, K1=0.01, K2=0.03, as tf.image.ssim and
+skimage's structural_similarity with gaussian_weights=True), computed by
+filtering the whole (N, H, W) stack, the other metrics are masked array
+reductions. Subjects are processed by a pool of workers.
+
+Subject values pool all mask voxels of the volume (PSNR from the pooled MSE).
+Output: <out>.tsv (per subject) and optionally <out>_slices.tsv (per slice).
+
+Example:
+    python3 evaluate_synthesis.py --real_dir nii/gan_target_FLAIR --synth_dir nii/synth_FLAIR \\
+            --out metric/synth_FLAIR_similarity --processes 8
+
+@author: bdavid
+"""
+
+import os
+import sys
+import glob
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'postprocessing'))
+from volume_ops import volume_to_slices
+
+# -------- USER INPUT (defaults) ----------
+
+PROCESSES = os.cpu_count() or 1
+SIGMA = 1.5
+DATA_RANGE = 255.0
+
+#-------------------------------
+
+K1, K2 = 0.01, 0.03
+# truncate the Gaussian at 3.5 sigma, i.e. an 11x11 window for sigma 1.5
+TRUNCATE = 3.5
+METRICS = ['L1', 'MSE', 'PSNR', 'SSIM']
+
+
+def find_image(directory, sbj):
+    files = sorted(glob.glob(os.path.join(directory, sbj + '_*')))
+    if not files:
+        raise IOError('No image for subject {} in {}'.format(sbj, directory))
+    return files[0]
+
+
+def ssim_maps(x, y, sigma=SIGMA, data_range=DATA_RANGE):
+    """SSIM maps of image stacks x, y (N, H, W), Gaussian weighted, filtered in-plane only"""
+    x = x.astype(np.float32)
+    y = y.astype(np.float32)
+    c1 = (K1 * data_range) ** 2
+    c2 = (K2 * data_range) ** 2
+    sigmas = (0, sigma, sigma)
+
+    def filt(img):
+        return ndimage.gaussian_filter(img, sigmas, mode='reflect', truncate=TRUNCATE)
+
+    mu_x, mu_y = filt(x), filt(y)
+    var_x = filt(x * x) - mu_x * mu_x
+    var_y = filt(y * y) - mu_y * mu_y
+    cov = filt(x * y) - mu_x * mu_y
+    return ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+
+
+def psnr(mse, data_range=DATA_RANGE):
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10(data_range ** 2 / mse)
+
+
+def compare_stacks(real, synth, mask, data_range=DATA_RANGE):
+    """Per slice and pooled metrics of slice stacks (N, H, W) within mask
+
+    :return: dict of per slice arrays (NaN for slices without mask voxels), dict of subject values
+    """
+    mask = mask.astype(bool)
+    diff = real.astype(np.float32) - synth.astype(np.float32)
+    ssim = ssim_maps(real, synth, data_range=data_range)
+    n_mask = mask.sum(axis=(1, 2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        per_slice = {'Voxels': n_mask,
+                     'L1': np.where(mask, np.abs(diff), 0).sum(axis=(1, 2)) / n_mask,
+                     'MSE': np.where(mask, diff * diff, 0).sum(axis=(1, 2)) / n_mask,
+                     'SSIM': np.where(mask, ssim, 0).sum(axis=(1, 2)) / n_mask}
+    per_slice['PSNR'] = psnr(per_slice['MSE'], data_range)
+    total = n_mask.sum()
+    subject = {'Voxels': int(total),
+               'L1': float(np.abs(diff[mask]).sum() / total) if total else np.nan,
+               'MSE': float((diff[mask] ** 2).sum() / total) if total else np.nan,
+               'SSIM': float(ssim[mask].sum() / total) if total else np.nan}
+    subject['PSNR'] = float(psnr(subject['MSE'], data_range))
+    return per_slice, subject
+
+
+def evaluate_subject(sbj, real_dir, synth_dir, mask_dir=None):
+    real_img = nib.load(find_image(real_dir, sbj))
+    synth_img = nib.load(find_image(synth_dir, sbj))
+    if real_img.shape != synth_img.shape:
+        raise ValueError('Shape mismatch for subject {}: {} vs {}'.format(sbj, real_img.shape, synth_img.shape))
+    real = volume_to_slices(real_img.dataobj)
+    synth = volume_to_slices(synth_img.dataobj)
+    if mask_dir:
+        mask_data = np.asanyarray(nib.load(find_image(mask_dir, sbj)).dataobj) > 0
+        mask = volume_to_slices(mask_data.astype(np.uint8)) > 0
+    else:
+        mask = real > 0
+    return compare_stacks(real, synth, mask)
+
+
+def _evaluate(job):
+    sbj = job[0]
+    try:
+        return sbj, evaluate_subject(*job), None
+    except (IOError, ValueError) as e:
+        return sbj, None, str(e)
+
+
+def list_subjects(directory):
+    files = glob.glob(os.path.join(directory, '*_*.nii*'))
+    return sorted({os.path.basename(f).split('_')[0] for f in files})
+
+
+def write_results(results, out, slices=False):
+    with open(out + '.tsv', 'w') as f:
+        f.write('Subject\tVoxels\t' + '\t'.join(METRICS) + '\n')
+        for sbj, (per_slice, subject) in results:
+            f.write('{}\t{}\t'.format(sbj, subject['Voxels']) +
+                    '\t'.join('{:.6f}'.format(subject[m]) for m in METRICS) + '\n')
+    if slices:
+        with open(out + '_slices.tsv', 'w') as f:
+            f.write('Subject\tSlice\tVoxels\t' + '\t'.join(METRICS) + '\n')
+            for sbj, (per_slice, subject) in results:
+                for i in np.flatnonzero(per_slice['Voxels']):
+                    f.write('{}\t{}\t{}\t'.format(sbj, i, per_slice['Voxels'][i]) +
+                            '\t'.join('{:.6f}'.format(per_slice[m][i]) for m in METRICS) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='L1, MSE, PSNR and SSIM of synthetic vs. real volumes')
+    parser.add_argument("--real_dir", required=True, help="real volumes (<sbj>_*.nii[.gz])")
+    parser.add_argument("--synth_dir", required=True, help="synthetic volumes (<sbj>_*.nii[.gz])")
+    parser.add_argument("--mask_dir", default=None, help="brain masks (default: nonzero voxels of the real volume)")
+    parser.add_argument("--out", required=True, help="output prefix, writes <out>.tsv")
+    parser.add_argument("--slices", action="store_true", default=False,
+                        help="also write the per slice metrics to <out>_slices.tsv")
+    parser.add_argument("--subjects", nargs='+', default=None,
+                        help="subject IDs (default: all subjects in synth_dir)")
+    parser.add_argument("--processes", type=int, default=PROCESSES,
+                        help="subjects evaluated in parallel (default={})".format(PROCESSES))
+    args = parser.parse_args()
+
+    subjects = args.subjects or list_subjects(args.synth_dir)
+    jobs = [(sbj, args.real_dir, args.synth_dir, args.mask_dir) for sbj in subjects]
+    if args.processes > 1 and len(jobs) > 1:
+        with Pool(min(args.processes, len(jobs))) as pool:
+            evaluated = pool.map(_evaluate, jobs)
+    else:
+        evaluated = [_evaluate(job) for job in jobs]
+
+    results = []
+    for sbj, result, error in evaluated:
+        if error:
+            print('Skipped {}: {}'.format(sbj, error))
+        else:
+            results.append((sbj, result))
+    if os.path.dirname(args.out):
+        os.makedirs(os.path.dirname(args.out), exist_ok=True)
+    write_results(results, args.out, args.slices)
+
+    values = np.array([[subject[m] for m in METRICS] for _, (_, subject) in results])
+    print('{} subjects'.format(len(results)))
+    if len(results):
+        for m, mean, std in zip(METRICS, np.nanmean(values, axis=0), np.nanstd(values, axis=0)):
+            print('{:<5s} {:10.4f} +- {:.4f}'.format(m, mean, std))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resource instrumentation for the FCD pipeline stages.
+
+Every recorded stage appends one JSON line to the metrics log with wall time,
+CPU time (user/sys, including child processes), peak RSS and the bytes read and
+written (from /proc/self/io, which also contains the I/O of finished child
+processes). Nothing is recorded unless a metrics log is given, either directly
+or via the environment variable FCD_METRICS_LOG, so the scripts run unchanged
+without it.
+
+Python scripts:
+    import instrumentation
+    with instrumentation.stage('histo_matching', subject='3022'):
+        ...
+
+    # many short calls of a stage (e.g. per slice), one record per flush
+    sections = instrumentation.Sections(subject='3022')
+    with sections('histo_matching'):
+        ...
+    sections.flush()
+
+Shell scripts (RunIt in preprocessing_for_deepmedic.sh):
+    export FCD_METRICS_LOG=/output/.../log/metrics.jsonl FCD_SUBJECT=3022
+    timecmd="python3 instrumentation.py run --"
+    $timecmd flirt -in ...          # stage name defaults to the command name (script name of
+                                    # python3 script.py, flirt for 'env VAR=value flirt ...')
+
+Cohort report:
+    python3 instrumentation.py report /output/.../log/metrics.jsonl --by stage
+
+@author: bdavid
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+import subprocess
+from contextlib import contextmanager
+from collections import OrderedDict
+
+ENV_LOG = 'FCD_METRICS_LOG'
+ENV_SUBJECT = 'FCD_SUBJECT'
+
+# stage names of commands run by these are the script names
+INTERPRETERS = ('python', 'bash', 'sh')
+
+# open stages of this process, VmHWM is only reset by the outermost one
+_depth = [0]
+
+
+def metrics_log(log=None):
+    return log or os.environ.get(ENV_LOG)
+
+
+def read_proc_io():
+    """I/O counters of this process incl. finished children, zeros if /proc is not available"""
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines() if line)
+        return {key: int(value) for key, value in io.items()}
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def reset_peak_rss():
+    """Resets VmHWM of this process (Linux >= 4.0), returns False if not possible"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss_mb():
+    """Peak RSS of this process since the last reset (VmHWM), else since process start"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is given in kB on Linux, in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024. ** 2 if sys.platform == 'darwin' else maxrss / 1024.
+
+
+def rss_mb(rusage):
+    return rusage.ru_maxrss / 1024. ** 2 if sys.platform == 'darwin' else rusage.ru_maxrss / 1024.
+
+
+def snapshot():
+    return {'time': time.time(), 'wall': time.perf_counter(),
+            'self': resource.getrusage(resource.RUSAGE_SELF),
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN),
+            'io': read_proc_io()}
+
+
+def measure(start, end):
+    """Resource usage between two snapshots"""
+    io_start, io_end = start['io'], end['io']
+
+    def io_delta(key):
+        return io_end.get(key, 0) - io_start.get(key, 0)
+
+    return OrderedDict([
+        ('wall_s', end['wall'] - start['wall']),
+        ('cpu_user_s', (end['self'].ru_utime - start['self'].ru_utime) +
+                       (end['children'].ru_utime - start['children'].ru_utime)),
+        ('cpu_sys_s', (end['self'].ru_stime - start['self'].ru_stime) +
+                      (end['children'].ru_stime - start['children'].ru_stime)),
+        ('read_bytes', io_delta('rchar')),
+        ('write_bytes', io_delta('wchar')),
+        ('disk_read_bytes', io_delta('read_bytes')),
+        ('disk_write_bytes', io_delta('write_bytes'))])
+
+
+def write_record(record, log=None):
+    """Appends one record as JSON line, lines below PIPE_BUF are written atomically by parallel jobs"""
+    log = metrics_log(log)
+    if not log:
+        return
+    log_dir = os.path.dirname(log)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    with open(log, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def base_record(name, subject, script, start):
+    return OrderedDict([('stage', name),
+                        ('subject', subject if subject is not None else os.environ.get(ENV_SUBJECT)),
+                        ('script', script or os.path.basename(sys.argv[0])),
+                        ('host', socket.gethostname()),
+                        ('pid', os.getpid()),
+                        ('start', start)])
+
+
+@contextmanager
+def stage(name, subject=None, script=None, log=None, **extra):
+    """Records the resources used by the enclosed block as one stage
+
+    Peak RSS is the peak of this process during the stage (if VmHWM can be reset,
+    otherwise the peak since process start) or of the largest child process,
+    whichever is larger. For nested stages, the peak of the inner stage is taken
+    since the start of the outermost one.
+
+    :param str name: stage name
+    :param str subject: subject ID (default: $FCD_SUBJECT)
+    :param str script: script name (default: name of the running script)
+    :param str log: metrics log (default: $FCD_METRICS_LOG, no recording if unset)
+    :param extra: additional fields of the record
+    """
+    if not metrics_log(log):
+        yield
+        return
+
+    if _depth[0] == 0:
+        reset_peak_rss()
+    _depth[0] += 1
+    start = snapshot()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        _depth[0] -= 1
+        end = snapshot()
+        record = base_record(name, subject, script, start['time'])
+        record.update(measure(start, end))
+        child_rss = rss_mb(end['children']) if end['children'].ru_maxrss > start['children'].ru_maxrss else 0
+        record['max_rss_mb'] = max(peak_rss_mb(), child_rss)
+        record['status'] = status
+        record.update(extra)
+        write_record(record, log)
+
+
+class Sections:
+    """Accumulates wall and CPU time of frequently entered sections (e.g. per slice)
+
+    Records only wall/CPU time and the number of calls per section, no RSS/IO.
+    flush() writes one record per section and resets the counters.
+    """
+
+    def __init__(self, subject=None, script=None, log=None):
+        self.subject = subject
+        self.script = script
+        self.log = log
+        self.start = time.time()
+        self.totals = OrderedDict()
+
+    @contextmanager
+    def __call__(self, name):
+        if not metrics_log(self.log):
+            yield
+            return
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            total = self.totals.setdefault(name, [0, 0., 0.])
+            total[0] += 1
+            total[1] += time.perf_counter() - wall
+            total[2] += time.process_time() - cpu
+
+    def flush(self, subject=None):
+        for name, (calls, wall, cpu) in self.totals.items():
+            record = base_record(name, subject or self.subject, self.script, self.start)
+            record.update([('wall_s', wall), ('cpu_user_s', cpu), ('calls', calls), ('status', 'ok')])
+            write_record(record, self.log)
+        self.totals = OrderedDict()
+        self.start = time.time()
+
+
+def command_name(cmd):
+    """Name of the program run by cmd: skips a leading 'env VAR=value ...' and names interpreters by their script
+
+    e.g. 'env FSLOUTPUTTYPE=NIFTI_GZ flirt ...' -> flirt, 'python3 -u robust_weights.py ...' -> robust_weights.py
+    """
+    args = list(cmd)
+    if args and os.path.basename(args[0]) == 'env':
+        args = args[1:]
+        while args and ('=' in args[0] or args[0].startswith('-')):
+            args = args[1:]
+    if args and os.path.basename(args[0]).rstrip('0123456789.') in INTERPRETERS:
+        # interpreter options up to the script, 'python -m module' is named by the module, '-c code' not at all
+        for i, arg in enumerate(args[1:], 1):
+            if arg == '-m' or not arg.startswith('-'):
+                args = args[i + (arg == '-m'):] or args
+                break
+            if arg == '-c':
+                break
+    return os.path.basename(args[0]) if args else os.path.basename(cmd[0])
+
+
+def run_command(cmd, name=None, subject=None, log=None):
+    """Runs a command as stage (used as $timecmd in the shell scripts), returns its exit code"""
+    name = name or command_name(cmd)
+    if not metrics_log(log):
+        return subprocess.call(cmd)
+
+    start = snapshot()
+    try:
+        proc = subprocess.Popen(cmd)
+    except OSError as e:
+        print('{}: {}'.format(cmd[0], e), file=sys.stderr)
+        return 127
+    # wait4 gives the exact peak RSS of this command, RUSAGE_CHILDREN only the max. of all children
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') \
+        else (status >> 8 if os.WIFEXITED(status) else -os.WTERMSIG(status))
+    end = snapshot()
+
+    record = base_record(name, subject, command_name(cmd), start['time'])
+    record.update(measure(start, end))
+    record['cpu_user_s'], record['cpu_sys_s'] = rusage.ru_utime, rusage.ru_stime
+    record['max_rss_mb'] = rss_mb(rusage)
+    record['status'] = 'ok' if proc.returncode == 0 else 'failed'
+    record['cmd'] = ' '.join(cmd)
+    write_record(record, log)
+    return proc.returncode
+
+
+def read_records(logs):
+    records = []
+    for log in logs:
+        with open(log) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    return records
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    pos = (len(values) - 1) * q
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def aggregate(records, by='stage'):
+    """Per group (stage, subject or script): count, wall time statistics and resource totals/peaks
+
+    wall_share is relative to the summed wall time of all records, i.e. nested
+    stages (e.g. 'nifti' and its 'to_nifti' records) are counted on each level.
+    """
+    groups = OrderedDict()
+    for record in records:
+        groups.setdefault(str(record.get(by)), []).append(record)
+
+    total_wall = sum(r.get('wall_s', 0) for r in records) or 1.
+    rows = []
+    for key, group in groups.items():
+        wall = [r.get('wall_s', 0) for r in group]
+        rows.append(OrderedDict([
+            (by, key),
+            ('n', sum(r.get('calls', 1) for r in group)),
+            ('subjects', len({r.get('subject') for r in group})),
+            ('failed', sum(r.get('status') == 'failed' for r in group)),
+            ('wall_total_s', sum(wall)),
+            ('wall_share', sum(wall) / total_wall),
+            ('wall_median_s', percentile(wall, 0.5)),
+            ('wall_p95_s', percentile(wall, 0.95)),
+            ('cpu_total_s', sum(r.get('cpu_user_s', 0) + r.get('cpu_sys_s', 0) for r in group)),
+            ('max_rss_mb', max(r.get('max_rss_mb', 0.) for r in group)),
+            ('read_mb', sum(r.get('read_bytes', 0) for r in group) / 1024. ** 2),
+            ('write_mb', sum(r.get('write_bytes', 0) for r in group) / 1024. ** 2)]))
+    return sorted(rows, key=lambda row: -row['wall_total_s'])
+
+
+def print_table(rows, sep=None):
+    if not rows:
+        print('No records')
+        return
+    keys = list(rows[0])
+    if sep:
+        print(sep.join(keys))
+        for row in rows:
+            print(sep.join(str(row[k]) for k in keys))
+        return
+    width = max(len(str(row[keys[0]])) for row in rows + [{keys[0]: keys[0]}])
+    print('{:<{w}s}'.format(keys[0], w=width) + ''.join('{:>14s}'.format(k) for k in keys[1:]))
+    for row in rows:
+        values = ['{:>14.3f}'.format(row[k]) if isinstance(row[k], float) else '{:>14d}'.format(row[k])
+                  for k in keys[1:]]
+        print('{:<{w}s}'.format(str(row[keys[0]]), w=width) + ''.join(values))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pipeline stage instrumentation')
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    subparsers.required = True
+
+    run = subparsers.add_parser("run", help="run a command and record it as stage")
+    run.add_argument("--stage", default=None, help="stage name (default: command name)")
+    run.add_argument("--subject", default=None, help="subject ID (default: ${})".format(ENV_SUBJECT))
+    run.add_argument("--log", default=None, help="metrics log (default: ${})".format(ENV_LOG))
+    run.add_argument("cmd", nargs=argparse.REMAINDER, help="command, after '--'")
+
+    report = subparsers.add_parser("report", help="aggregate metrics logs across the cohort")
+    report.add_argument("logs", nargs='+', help="metrics logs (JSON lines)")
+    report.add_argument("--by", default='stage', choices=['stage', 'subject', 'script'],
+                        help="group records by (default: stage)")
+    report.add_argument("--stage", default=None, help="only records of this stage")
+    report.add_argument("--csv", action="store_true", help="comma separated output")
+    report.add_argument("--json", action="store_true", help="JSON output")
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        cmd = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+        if not cmd:
+            parser.error('no command given')
+        sys.exit(run_command(cmd, args.stage, args.subject, args.log))
+
+    records = read_records(args.logs)
+    if args.stage:
+        records = [r for r in records if r.get('stage') == args.stage]
+    rows = aggregate(records, args.by)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(rows, ',' if args.csv else None)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,8 @@
 Created on Tue Apr  7 23:21:47 2020
 
 @author: bdavid
+
+One hard-coded subject; qc_gifs.py renders GIFs and preview mosaics for whole cohorts.
 """
 
 
@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
 Created on Thu Nov 22 12:02:04 2018
@@ -10,8 +10,6 @@ import os
 import sys, getopt
 import numpy as np
 import nibabel as nib
-import scipy.misc
-import matplotlib.pyplot as plt
 from PIL import Image
 from PIL import ImageStat
 import warnings
@@ -20,11 +18,26 @@ warnings.filterwarnings("ignore")
 
 def show_slices(slices):
     """ Function to display row of image slices """
+    import matplotlib.pyplot as plt
     fig, axes = plt.subplots(1, len(slices))
     for i, slice in enumerate(slices):
         axes[i].imshow(slice.T, cmap="gray", origin="lower")
 
 
+def toimage(data, cmin, cmax):
+    """scipy.misc.toimage(data, cmin=cmin, cmax=cmax) of a 2D array (removed in SciPy 1.2), with
+    scipy's bytescale: uint8 data is kept as is, a flat range (cmax == cmin) is scaled by 255"""
+    data = np.asarray(data)
+    if data.dtype != np.uint8:
+        cscale = cmax - cmin
+        if cscale < 0:
+            raise ValueError("`cmax` should be larger than `cmin`.")
+        elif cscale == 0:
+            cscale = 1
+        data = (((data - cmin) * (255.0 / cscale)).clip(0, 255) + 0.5).astype(np.uint8)
+    return Image.frombytes('L', (data.shape[1], data.shape[0]), data.tobytes())
+
+
 def image_padding(img, outsize):
     """ Function to pad and scale image to desired size"""
     
@@ -46,19 +59,19 @@ def image_padding(img, outsize):
 def save_to_png(filepath, prefix, outtype, outsize, outdir, cutoff):
     """Function to save NIFTI slicewise as png with right scaling
     and in radiological convention (left is right, right is left)"""
-    img=nib.load(filepath)
-    data=img.get_data()
-    
     if not os.path.exists(filepath):
-        print 'Filepath "'+filepath+'" does not exist. Exiting'
+        print('Filepath "'+filepath+'" does not exist. Exiting')
         sys.exit(2)
+
+    img=nib.load(filepath)
+    data=np.asanyarray(img.dataobj)
     
     if not os.path.exists(outdir): os.makedirs(outdir)
     
-    print "Producing images for prefix: "+prefix    
+    print("Producing images for prefix: "+prefix)
     for i in range(np.size(data,1)):
         imgname=outdir+"/"+prefix+"_slice"+str("%03d" % (i,))+"."+outtype.lower()
-        sliceimg=scipy.misc.toimage(np.fliplr(np.flipud(data[:,i,:].T)), cmin=0.0, cmax=data.max())
+        sliceimg=toimage(np.fliplr(np.flipud(data[:,i,:].T)), cmin=0.0, cmax=data.max())
         sliceimg=image_padding(sliceimg, outsize)
         if ImageStat.Stat(sliceimg).mean[0] >= cutoff: sliceimg.save(imgname,outtype.upper())
 
@@ -72,12 +85,12 @@ def main(argv):
     try:
         opts, args = getopt.getopt(argv,"hi:p:t:s:o:c:",["infile=","prefix=","output_type=","outsize=","outdir=","cutoff="])
     except getopt.GetoptError:
-      print 'nii_2_png.py -i <inputfile_path> -p <prefix_output> -t <output_type (e.g. PNG)> -s <output_size> -o <output_directory> -c <intensity cutoff>'
+      print('nii_2_png.py -i <inputfile_path> -p <prefix_output> -t <output_type (e.g. PNG)> -s <output_size> -o <output_directory> -c <intensity cutoff>')
       sys.exit(2)
       
     for opt, arg in opts:
         if opt == '-h':
-            print 'nii_2_png.py -i <inputfile_path> -p <prefix_output> -t <output_type (e.g. PNG)> -s <output_size> -o <output_directory> -c <intensity cutoff>'
+            print('nii_2_png.py -i <inputfile_path> -p <prefix_output> -t <output_type (e.g. PNG)> -s <output_size> -o <output_directory> -c <intensity cutoff>')
             sys.exit()
         elif opt in ("-i", "--infile"):
             filepath = arg
@@ -93,7 +106,9 @@ def main(argv):
             cutoff = int(arg)
 
     save_to_png(filepath, prefix, outtype, outsize, outdir, cutoff)
-    
-main(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
 
         
\ No newline at end of file
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+QC GIFs and preview mosaics for a whole cohort (make_gifs.py / make_gifs_two-way.py
+for all subjects at once).
+
+Every column (e.g. T1, FLAIR, synthetic FLAIR) is given as a directory with either
+one NIfTI volume per subject (<sbj>_*.nii[.gz], e.g. gan_input_T1) or the PNG slices
+of nii_2_png.py (<sbj>_*.png). A subject's columns are loaded once as uint8 slice
+arrays (N, H, W), all frames are built with a single fancy-indexing/concatenate
+step and written directly with imageio, i.e. without PIL pasting and the PNG
+encode/decode round trip per frame. Subjects are rendered in parallel.
+
+Per subject, <out_dir>/<sbj>_qc.gif runs from slice --offset down to the first slice
+and back, like make_gifs.py. <out_dir>/<sbj>_mosaic.png shows --mosaic_slices
+evenly spaced frames, downsampled by --mosaic_scale, for a fast review of many subjects.
+
+Example (layout of make_gifs_two-way.py):
+    python3 qc_gifs.py --columns png_cor/FLAIR/test png_cor/T1/test png_cor/synth_FLAIR/test \\
+            png_cor/synth_T1/test --titles FLAIR T1 "synth FLAIR" "synth T1" --out_dir qc --processes 8
+
+@author: bdavid
+"""
+
+import os
+import sys
+import glob
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import nibabel as nib
+import imageio
+from PIL import Image, ImageDraw, ImageFont
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'postprocessing'))
+from volume_ops import volume_to_slices
+
+# -------- USER INPUT (defaults) ----------
+
+#set offset to not show face in GIFs
+OFFSET = 190
+DURATION = 0.08
+MOSAIC_SLICES = 16
+MOSAIC_SCALE = 2
+PROCESSES = os.cpu_count() or 1
+
+#-------------------------------
+
+NII_EXT = ('.nii', '.nii.gz')
+TITLE_HEIGHT = 16
+
+
+def load_column(directory, sbj):
+    """uint8 slices (N, H, W) of a subject from a NIfTI volume or PNG slices"""
+    files = sorted(glob.glob(os.path.join(directory, sbj + '_*')))
+    volumes = [f for f in files if f.endswith(NII_EXT)]
+    if volumes:
+        return volume_to_slices(nib.load(volumes[0]).dataobj)
+    pngs = [f for f in files if f.endswith('.png')]
+    if not pngs:
+        raise IOError('No image for subject {} in {}'.format(sbj, directory))
+    return np.stack([np.asarray(Image.open(f).convert('L')) for f in pngs])
+
+
+def pad_to(slices, height, width):
+    """Center zero padding of slices (N, H, W) to (N, height, width)"""
+    dh, dw = height - slices.shape[1], width - slices.shape[2]
+    if dh == 0 and dw == 0:
+        return slices
+    return np.pad(slices, ((0, 0), (dh // 2, dh - dh // 2), (dw // 2, dw - dw // 2)))
+
+
+def title_strip(titles, width):
+    """Header row with the column titles, drawn once per subject"""
+    strip = Image.new('L', (width * len(titles), TITLE_HEIGHT), color=0)
+    draw = ImageDraw.Draw(strip)
+    font = ImageFont.load_default()
+    for i, title in enumerate(titles):
+        draw.text((i * width + 4, 2), title, font=font, fill=255)
+    return np.asarray(strip)
+
+
+def subject_frames(columns, sbj, offset=OFFSET, titles=None):
+    """GIF frames (N, H, W*columns) of a subject, slice offset down to 0 and back up"""
+    stacks = [load_column(d, sbj) for d in columns]
+    n = min(len(s) for s in stacks)
+    height = max(s.shape[1] for s in stacks)
+    width = max(s.shape[2] for s in stacks)
+    # like make_gifs.py: list[offset::-1] followed by its reverse
+    down = np.arange(min(offset, n - 1), -1, -1)
+    index = np.concatenate([down, down[::-1]])
+    frames = np.concatenate([pad_to(s[:n], height, width)[index] for s in stacks], axis=2)
+    if titles:
+        header = np.broadcast_to(title_strip(titles, width), (len(frames), TITLE_HEIGHT, frames.shape[2]))
+        frames = np.concatenate([header, frames], axis=1)
+    return frames
+
+
+def mosaic(frames, n_slices=MOSAIC_SLICES, scale=MOSAIC_SCALE):
+    """Grid of n_slices evenly spaced frames, downsampled by block averaging with factor scale"""
+    frames = frames[:len(frames) // 2 + 1]  # the second half of the GIF repeats the first
+    picks = frames[np.linspace(0, len(frames) - 1, min(n_slices, len(frames))).round().astype(int)]
+    n, h, w = picks.shape
+    h, w = h // scale * scale, w // scale * scale
+    small = picks[:, :h, :w].reshape(n, h // scale, scale, w // scale, scale).mean(axis=(2, 4))
+    cols = int(np.ceil(np.sqrt(n)))
+    rows = int(np.ceil(n / cols))
+    grid = np.zeros((rows * cols,) + small.shape[1:], dtype=np.uint8)
+    grid[:n] = small.round().astype(np.uint8)
+    return grid.reshape(rows, cols, h // scale, w // scale).transpose(0, 2, 1, 3).reshape(rows * h // scale,
+                                                                                        cols * w // scale)
+
+
+def render_subject(sbj, args):
+    try:
+        frames = subject_frames(args.columns, sbj, args.offset, args.titles)
+    except IOError as e:
+        return sbj, str(e)
+    if not args.no_gif:
+        imageio.mimsave(os.path.join(args.out_dir, sbj + '_qc.gif'), list(frames), duration=args.duration)
+    if args.mosaic_slices > 0:
+        Image.fromarray(mosaic(frames, args.mosaic_slices, args.mosaic_scale)).save(
+            os.path.join(args.out_dir, sbj + '_mosaic.png'))
+    return sbj, None
+
+
+def _render(job):
+    return render_subject(*job)
+
+
+def list_subjects(directory):
+    """Subject IDs (file name up to the first '_') found in a column directory"""
+    files = glob.glob(os.path.join(directory, '*_*'))
+    return sorted({os.path.basename(f).split('_')[0] for f in files if f.endswith(NII_EXT + ('.png',))})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='QC GIFs and preview mosaics for a cohort')
+    parser.add_argument("--columns", nargs='+', required=True,
+                        help="directories of the columns (left to right), NIfTI volumes or PNG slices per subject")
+    parser.add_argument("--titles", nargs='+', default=None, help="column titles")
+    parser.add_argument("--out_dir", required=True, help="output directory")
+    parser.add_argument("--subjects", nargs='+', default=None,
+                        help="subject IDs (default: all subjects of the first column)")
+    parser.add_argument("--offset", type=int, default=OFFSET,
+                        help="first slice of the GIF, to not show the face (default={})".format(OFFSET))
+    parser.add_argument("--duration", type=float, default=DURATION,
+                        help="seconds per GIF frame (default={})".format(DURATION))
+    parser.add_argument("--mosaic_slices", type=int, default=MOSAIC_SLICES,
+                        help="slices in the preview mosaic, 0 for none (default={})".format(MOSAIC_SLICES))
+    parser.add_argument("--mosaic_scale", type=int, default=MOSAIC_SCALE,
+                        help="downsampling factor of the mosaic (default={})".format(MOSAIC_SCALE))
+    parser.add_argument("--no_gif", action="store_true", default=False, help="only write the mosaics")
+    parser.add_argument("--processes", type=int, default=PROCESSES,
+                        help="subjects rendered in parallel (default={})".format(PROCESSES))
+    args = parser.parse_args()
+
+    if args.titles and len(args.titles) != len(args.columns):
+        parser.error('--titles needs one title per column')
+    os.makedirs(args.out_dir, exist_ok=True)
+    subjects = args.subjects or list_subjects(args.columns[0])
+    print('Rendering {} subjects'.format(len(subjects)))
+
+    jobs = [(sbj, args) for sbj in subjects]
+    if args.processes > 1 and len(jobs) > 1:
+        with Pool(min(args.processes, len(jobs))) as pool:
+            results = list(pool.imap_unordered(_render, jobs))
+    else:
+        results = [_render(job) for job in jobs]
+    for sbj, error in results:
+        if error:
+            print('Skipped {}: {}'.format(sbj, error))
+
+
+if __name__ == "__main__":
+    main()